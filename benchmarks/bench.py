@@ -0,0 +1,249 @@
+"""Offline benchmarks for ZiggoNext against local stand-ins of the OESP api and mqtt broker.
+
+Measures startup time, message-to-info latency, messages/sec and memory per box:
+
+    python benchmarks/bench.py --boxes 1 10 100 --json baseline.json
+    python benchmarks/bench.py --compare baseline.json
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ziggonext import ZiggoNext, ZiggoNextMetricsRegistry  # noqa: E402
+from ziggonext.const import COUNTRY_URLS_HTTP, COUNTRY_URLS_MQTT, COUNTRY_URLS_PERSONALIZATION_FORMAT  # noqa: E402
+
+from stubs import FakeMqttBroker, FakeOespApi, HOUSEHOLD_ID  # noqa: E402
+
+COUNTRY_CODE = "bench"
+READY_TIMEOUT = 60
+
+
+def _register_country(api: FakeOespApi, broker: FakeMqttBroker):
+    """Points the bench country code at the local stand-ins"""
+    COUNTRY_URLS_HTTP[COUNTRY_CODE] = api.oespUrl
+    COUNTRY_URLS_PERSONALIZATION_FORMAT[COUNTRY_CODE] = api.devicesUrlFormat
+    COUNTRY_URLS_MQTT[COUNTRY_CODE] = broker.host
+
+
+def _wait(predicate, timeout: float = READY_TIMEOUT):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Benchmark condition not reached within {timeout}s".format(timeout=timeout))
+        time.sleep(0.0005)
+
+
+def _client(args, broker, metrics=None) -> ZiggoNext:
+    return ZiggoNext(
+        "bench", "bench", COUNTRY_CODE, metrics=metrics,
+        mqttOptions={"port": broker.port, "transport": "tcp", "tls": False},
+    )
+
+
+def _all_playing(client: ZiggoNext) -> bool:
+    return all(box.info.channelId is not None for box in client.settop_boxes.values())
+
+
+def bench_startup(args, broker, logger, metrics) -> tuple:
+    """Seconds until initialize returns and until every box reported what it plays"""
+    started = time.perf_counter()
+    client = _client(args, broker, metrics)
+    client.initialize(logger, concurrent=args.concurrent)
+    initialized = time.perf_counter() - started
+    _wait(lambda: _all_playing(client))
+    return client, {
+        "initialize": initialized,
+        "ready": time.perf_counter() - started,
+        "stages": dict(client.timings),
+    }
+
+
+def bench_latency(args, broker, client: ZiggoNext) -> dict:
+    """Seconds from publishing a uiStatus at the broker until box.info changed"""
+    changed = threading.Event()
+    expected = {}
+
+    def on_change(change):
+        if change.field == "channelId" and expected.get(change.boxId) == change.newValue:
+            changed.set()
+
+    remove = client.add_listener(on_change)
+    replyTopic = HOUSEHOLD_ID + "/" + client.mqttClient.mqttClientId
+    boxIds = list(client.settop_boxes)
+    samples = []
+    try:
+        for index in range(args.samples):
+            boxId = boxIds[index % len(boxIds)]
+            current = client.settop_boxes[boxId].info.channelId
+            serviceId = next(s for s in broker.serviceIds[index % 2::2] if s != current)
+            expected.clear()
+            expected[boxId] = serviceId
+            changed.clear()
+            sent = time.perf_counter()
+            broker.inject([(replyTopic, broker.status_payload(boxId, serviceId))])
+            if not changed.wait(READY_TIMEOUT):
+                raise TimeoutError("Box {box} did not apply a status".format(box=boxId))
+            samples.append(time.perf_counter() - sent)
+    finally:
+        remove()
+    samples.sort()
+    return {
+        "mean": statistics.mean(samples),
+        "p50": samples[len(samples) // 2],
+        "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        "max": samples[-1],
+    }
+
+
+def bench_throughput(args, broker, client: ZiggoNext) -> dict:
+    """Status messages per second applied to box.info, in total and per box"""
+    boxes = list(client.settop_boxes.values())
+    replyTopic = HOUSEHOLD_ID + "/" + client.mqttClient.mqttClientId
+    messages = []
+    for index in range(args.messages):
+        serviceId = broker.serviceIds[index % len(broker.serviceIds)]
+        for box in boxes:
+            messages.append((replyTopic, broker.status_payload(box.box_id, serviceId)))
+    baseline = sum(box.updateCount for box in boxes)
+    target = baseline + len(messages)
+    started = time.perf_counter()
+    broker.inject(messages)
+    _wait(lambda: sum(box.updateCount for box in boxes) >= target)
+    elapsed = time.perf_counter() - started
+    return {
+        "messages": len(messages),
+        "seconds": elapsed,
+        "perSecond": len(messages) / elapsed,
+        "perSecondPerBox": args.messages / elapsed,
+    }
+
+
+def bench_memory(args, broker, logger) -> dict:
+    """Bytes allocated by a client with all boxes playing, per box"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        client = _client(args, broker)
+        client.initialize(logger, concurrent=args.concurrent)
+        _wait(lambda: _all_playing(client))
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    client.close()
+    boxes = len(client.settop_boxes)
+    return {"total": current, "peak": peak, "perBox": current / boxes}
+
+
+def run(args, boxes: int, logger) -> dict:
+    api = FakeOespApi(boxes, args.channels, args.api_latency / 1000, args.api_host, args.api_port).start()
+    broker = FakeMqttBroker(api.boxIds, api.serviceIds, args.broker_host, args.broker_port).start()
+    _register_country(api, broker)
+    metrics = ZiggoNextMetricsRegistry() if args.prometheus else None
+    try:
+        client, startup = bench_startup(args, broker, logger, metrics)
+        try:
+            result = {
+                "boxes": boxes,
+                "startup": startup,
+                "latency": bench_latency(args, broker, client),
+                "throughput": bench_throughput(args, broker, client),
+            }
+        finally:
+            client.close()
+        if not args.skip_memory:
+            result["memory"] = bench_memory(args, broker, logger)
+        result["apiRequests"] = dict(api.requests)
+        if metrics is not None:
+            result["prometheus"] = metrics.to_prometheus()
+        return result
+    finally:
+        broker.stop()
+        api.stop()
+
+
+def _summary(result: dict) -> str:
+    line = (
+        "{boxes:>4} boxes  startup {init:7.1f}ms  ready {ready:7.1f}ms  "
+        "latency p50 {p50:6.2f}ms p99 {p99:6.2f}ms  {rate:9.0f} msg/s ({perBox:8.0f}/box)"
+    ).format(
+        boxes=result["boxes"],
+        init=result["startup"]["initialize"] * 1000,
+        ready=result["startup"]["ready"] * 1000,
+        p50=result["latency"]["p50"] * 1000,
+        p99=result["latency"]["p99"] * 1000,
+        rate=result["throughput"]["perSecond"],
+        perBox=result["throughput"]["perSecondPerBox"],
+    )
+    if "memory" in result:
+        line += "  {kb:7.1f}KiB/box".format(kb=result["memory"]["perBox"] / 1024)
+    return line
+
+
+def _compare(results: list, baselinePath: str):
+    with open(baselinePath) as fp:
+        baseline = {result["boxes"]: result for result in json.load(fp)["results"]}
+    metrics = (
+        ("ready", lambda r: r["startup"]["ready"]),
+        ("latency p50", lambda r: r["latency"]["p50"]),
+        ("msg/s", lambda r: r["throughput"]["perSecond"]),
+        ("bytes/box", lambda r: r.get("memory", {}).get("perBox")),
+    )
+    for result in results:
+        before = baseline.get(result["boxes"])
+        if before is None:
+            continue
+        changes = []
+        for name, value in metrics:
+            old, new = value(before), value(result)
+            if old and new:
+                changes.append("{name} {change:+.1f}%".format(name=name, change=(new - old) / old * 100))
+        print("{boxes:>4} boxes vs baseline: {changes}".format(boxes=result["boxes"], changes=", ".join(changes)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--boxes", type=int, nargs="+", default=[1, 10, 100], help="box counts to benchmark")
+    parser.add_argument("--channels", type=int, default=50, help="channels in the lineup")
+    parser.add_argument("--samples", type=int, default=200, help="latency samples per run")
+    parser.add_argument("--messages", type=int, default=200, help="status messages per box for throughput")
+    parser.add_argument("--api-latency", type=float, default=0, help="added latency per api call in ms")
+    parser.add_argument("--api-host", default="127.0.0.1")
+    parser.add_argument("--api-port", type=int, default=0)
+    parser.add_argument("--broker-host", default="127.0.0.1")
+    parser.add_argument("--broker-port", type=int, default=0)
+    parser.add_argument("--concurrent", action="store_true", help="initialize with concurrent stages")
+    parser.add_argument("--skip-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--prometheus", action="store_true", help="collect and print library metrics")
+    parser.add_argument("--json", metavar="PATH", help="write results as json")
+    parser.add_argument("--compare", metavar="PATH", help="compare with results of an earlier --json run")
+    args = parser.parse_args(argv)
+
+    logger = logging.getLogger("ziggonext.bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    results = []
+    for boxes in args.boxes:
+        result = run(args, boxes, logger)
+        results.append(result)
+        print(_summary(result))
+        if args.prometheus:
+            print(result["prometheus"])
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({"python": sys.version, "results": results}, fp, indent=2)
+    if args.compare:
+        _compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""Local stand-ins for the OESP http api and the Ziggo mqtt broker, used by the benchmarks."""
+import asyncio
+import base64
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+HOUSEHOLD_ID = "bench-household"
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def box_ids(count: int) -> list:
+    return ["3C36E4-EOSSTB-{index:012d}".format(index=index) for index in range(count)]
+
+
+def service_ids(count: int) -> list:
+    return ["NL_000{index:03d}_019{index:03d}".format(index=index) for index in range(1, count + 1)]
+
+
+def event_id(serviceId: str) -> str:
+    return "crid:~~2F~~2Fbench~~2F" + serviceId
+
+
+def _token(lifetime: float = 3600) -> str:
+    """Unsigned JWT whose exp claim lies lifetime seconds ahead"""
+    def encode(part):
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b"=").decode()
+    return encode({"alg": "none"}) + "." + encode({"exp": int(time.time() + lifetime)}) + "."
+
+
+class FakeOespApi:
+    """Threaded http server answering session, tokens/jwt, channels, listings and devices calls."""
+
+    def __init__(self, boxes: int, channels: int = 50, latency: float = 0, host: str = "127.0.0.1", port: int = 0):
+        self.boxIds = box_ids(boxes)
+        self.serviceIds = service_ids(channels)
+        self.latency = latency
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return "http://{host}:{port}".format(host=host, port=port)
+
+    @property
+    def oespUrl(self) -> str:
+        return self.url + "/oesp/v3/NL/nld/web"
+
+    @property
+    def devicesUrlFormat(self) -> str:
+        return self.url + "/personalization-service/v1/customer/{household_id}/devices"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="bench-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def _session(self, body):
+        return 200, {"customer": {"householdId": HOUSEHOLD_ID}, "oespToken": "bench-oesp-token"}
+
+    def _jwt(self):
+        return 200, {"token": _token()}
+
+    def _channels(self):
+        channels = []
+        for number, serviceId in enumerate(self.serviceIds, 1):
+            channels.append({
+                "title": "Channel " + str(number),
+                "channelNumber": number,
+                "stationSchedules": [{"station": {
+                    "id": "station-" + serviceId,
+                    "serviceId": serviceId,
+                    "images": [
+                        {"assetType": "imageStream", "url": "https://images.example/stream/" + serviceId},
+                        {"assetType": "station-logo-small", "url": "https://images.example/logo/" + serviceId},
+                    ],
+                }}],
+            })
+        return 200, {"channels": channels}
+
+    def _listing(self, listingId):
+        now = int(time.time() * 1000)
+        return 200, {
+            "startTime": now - 600000,
+            "endTime": now + 1200000,
+            "program": {"title": "Program " + listingId[-6:], "images": [{"url": "https://images.example/" + listingId}]},
+        }
+
+    def _schedule(self, query):
+        now = int(time.time() * 1000)
+        stationIds = query.get("byStationId", [""])[0].split(",")
+        listings = [
+            {
+                "id": event_id(stationId[len("station-"):]),
+                "stationId": stationId,
+                "startTime": now - 600000,
+                "endTime": now + 1200000,
+                "program": {"title": "Program " + stationId[-6:], "images": []},
+            }
+            for stationId in stationIds if stationId.startswith("station-")
+        ]
+        return 200, {"listings": listings, "totalResults": len(listings)}
+
+    def _devices(self):
+        return 200, [
+            {"deviceId": boxId, "platformType": "EOS", "settings": {"deviceFriendlyName": "Box " + str(index)}}
+            for index, boxId in enumerate(self.boxIds)
+        ]
+
+    def _route(self, method, path, body, query=None):
+        if method == "POST" and path.endswith("/session"):
+            return "session", self._session(body)
+        if path.endswith("/tokens/jwt"):
+            return "tokens/jwt", self._jwt()
+        if path.endswith("/channels"):
+            return "channels", self._channels()
+        match = re.search(r"/listings/([^/]+)$", path)
+        if match:
+            return "listings", self._listing(match.group(1))
+        if path.endswith("/listings"):
+            return "listings", self._schedule(query or {})
+        if path.endswith("/devices"):
+            return "devices", self._devices()
+        return "other", (404, {"error": "not found"})
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                path, _, query = self.path.partition("?")
+                endpoint, (status, content) = api._route(method, path, body, parse_qs(query))
+                api._count(endpoint)
+                if api.latency:
+                    time.sleep(api.latency)
+                payload = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _topic_matches(pattern: str, topic: str) -> bool:
+    patternParts = pattern.split("/")
+    topicParts = topic.split("/")
+    for index, part in enumerate(patternParts):
+        if part == "#":
+            return True
+        if index >= len(topicParts):
+            return False
+        if part != "+" and part != topicParts[index]:
+            return False
+    return len(patternParts) == len(topicParts)
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _string(data: bytes, offset: int):
+    length = int.from_bytes(data[offset:offset + 2], "big")
+    return data[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+
+def _publish_packet(topic: str, payload: bytes) -> bytes:
+    encodedTopic = topic.encode()
+    body = len(encodedTopic).to_bytes(2, "big") + encodedTopic + payload
+    return bytes([PUBLISH << 4]) + _encode_length(len(body)) + body
+
+
+class _Session:
+    def __init__(self, writer):
+        self.writer = writer
+        self.subscriptions = set()
+
+
+class FakeMqttBroker:
+    """Minimal MQTT 3.1.1 broker (QoS 0, plain tcp) with emulated EOS settop boxes.
+
+    Boxes announce ONLINE_RUNNING on their status topic when subscribed to,
+    answer CPE.getUiStatus on the reply topic of the requester and follow
+    CPE.pushToTV and channel up/down keys.
+    """
+
+    def __init__(self, boxIds, serviceIds, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.serviceIds = list(serviceIds)
+        self.channels = {boxId: 0 for boxId in boxIds}
+        self.received = 0
+        self.connects = 0
+        self.refuseConnects = 0
+        self._sessions = []
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._started = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="bench-broker", daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _shutdown(self):
+        self._server.close()
+        for session in list(self._sessions):
+            session.writer.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._serve, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        self._loop.run_forever()
+
+    def status_payload(self, boxId: str, serviceId: str = None, speed: int = 1) -> bytes:
+        """CPE.uiStatus message of a box watching a channel"""
+        serviceId = serviceId or self.serviceIds[self.channels[boxId]]
+        return json.dumps({
+            "source": boxId,
+            "type": "CPE.uiStatus",
+            "status": {
+                "uiStatus": "mainUI",
+                "playerState": {
+                    "sourceType": "linear",
+                    "speed": speed,
+                    "source": {"channelId": serviceId, "eventId": event_id(serviceId)},
+                },
+            },
+        }).encode()
+
+    def drop_connections(self):
+        """Closes all client connections, as a broker restart would"""
+        self._loop.call_soon_threadsafe(self._drop_connections)
+
+    def _drop_connections(self):
+        for session in list(self._sessions):
+            session.writer.close()
+
+    def inject(self, messages):
+        """Publishes (topic, payload) pairs from outside the broker thread"""
+        self._loop.call_soon_threadsafe(self._publish_all, list(messages))
+
+    def _publish_all(self, messages):
+        for topic, payload in messages:
+            self._publish(topic, payload)
+
+    def _publish(self, topic: str, payload: bytes):
+        packet = None
+        for session in self._sessions:
+            if any(_topic_matches(pattern, topic) for pattern in session.subscriptions):
+                packet = packet or _publish_packet(topic, payload)
+                session.writer.write(packet)
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header[0], await reader.readexactly(length)
+
+    async def _serve(self, reader, writer):
+        session = _Session(writer)
+        self._sessions.append(session)
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                packetType = header >> 4
+                if packetType == CONNECT:
+                    self.connects += 1
+                    if self.refuseConnects:
+                        self.refuseConnects -= 1
+                        writer.write(bytes([CONNACK << 4, 2, 0, 5]))
+                        break
+                    writer.write(bytes([CONNACK << 4, 2, 0, 0]))
+                elif packetType == PUBLISH:
+                    self._on_publish(writer, header, body)
+                elif packetType == SUBSCRIBE:
+                    self._on_subscribe(session, body)
+                elif packetType == UNSUBSCRIBE:
+                    self._on_unsubscribe(session, body)
+                elif packetType == PINGREQ:
+                    writer.write(bytes([PINGRESP << 4, 0]))
+                elif packetType == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._sessions.remove(session)
+            writer.close()
+
+    def _on_publish(self, writer, header, body):
+        topic, offset = _string(body, 0)
+        if (header >> 1) & 3:
+            writer.write(bytes([PUBACK << 4, 2]) + body[offset:offset + 2])
+            offset += 2
+        payload = body[offset:]
+        self.received += 1
+        self._publish(topic, payload)
+        parts = topic.split("/")
+        if len(parts) == 2 and parts[1] in self.channels:
+            self._on_box_command(parts[0], parts[1], json.loads(payload))
+
+    def _on_box_command(self, householdId, boxId, command):
+        commandType = command.get("type")
+        if commandType == "CPE.pushToTV":
+            serviceId = command["status"]["source"]["channelId"]
+            if serviceId in self.serviceIds:
+                self.channels[boxId] = self.serviceIds.index(serviceId)
+        elif commandType == "CPE.KeyEvent":
+            key = command["status"]["w3cKey"]
+            step = {"ChannelUp": 1, "ChannelDown": -1}.get(key, 0)
+            self.channels[boxId] = (self.channels[boxId] + step) % len(self.serviceIds)
+        elif commandType == "CPE.getUiStatus":
+            self._publish(householdId + "/" + command["source"], self.status_payload(boxId))
+
+    def _on_subscribe(self, session, body):
+        packetId = body[:2]
+        offset = 2
+        topics = []
+        while offset < len(body):
+            topic, offset = _string(body, offset)
+            offset += 1
+            topics.append(topic)
+        session.subscriptions.update(topics)
+        session.writer.write(bytes([SUBACK << 4]) + _encode_length(2 + len(topics)) + packetId + bytes(len(topics)))
+        for topic in topics:
+            parts = topic.split("/")
+            if len(parts) == 3 and parts[2] == "status" and parts[1] in self.channels:
+                state = {"deviceType": "STB", "source": parts[1], "state": "ONLINE_RUNNING"}
+                session.writer.write(_publish_packet(topic, json.dumps(state).encode()))
+
+    def _on_unsubscribe(self, session, body):
+        offset = 2
+        while offset < len(body):
+            topic, offset = _string(body, offset)
+            session.subscriptions.discard(topic)
+        session.writer.write(bytes([UNSUBACK << 4, 2]) + body[:2])
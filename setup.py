@@ -31,6 +31,7 @@ setuptools.setup(
     packages=setuptools.find_packages(include=["ziggonext"]),
     license="MIT license",
     install_requires=["paho-mqtt>=1.5.0", "requests>=2.22.0"],
+    extras_require={"async": ["aiohttp>=3.6.0"], "speedups": ["orjson>=3.0.0"], "thumbnails": ["Pillow>=7.0.0"]},
     keywords=["ziggonext", "api", "settopbox"],
     classifiers=[
         "Development Status :: 3 - Alpha",
@@ -45,6 +46,7 @@ setuptools.setup(
         "Topic :: Software Development :: Libraries :: Python Modules",
     ],
     python_requires='>=3.6',
+    entry_points={"console_scripts": ["ziggonext=ziggonext.cli:main"]},
     zip_safe=False,
     include_package_data=True,
 )
\ No newline at end of file
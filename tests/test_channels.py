@@ -0,0 +1,62 @@
+from ziggonext.channels import ZiggoChannelIndex
+from ziggonext.models import ZiggoChannel
+
+
+def _lineup():
+    channels = [
+        ZiggoChannel("NL_1", "NPO 1", None, None, "1"),
+        ZiggoChannel("NL_2", "NPO 2", None, None, "2"),
+        ZiggoChannel("NL_3", "RTL 4", None, None, "4"),
+        ZiggoChannel("NL_4", "Ons Télé", None, None, "12"),
+        ZiggoChannel("NL_5", "Radio", None, None, "R1"),
+        ZiggoChannel("NL_6", "Net5", None, None, "9"),
+    ]
+    return {channel.serviceId: channel for channel in channels}
+
+
+def test_lookup_by_service_id_and_number():
+    index = ZiggoChannelIndex(_lineup())
+    assert index.by_service_id("NL_3").title == "RTL 4"
+    assert index.by_service_id("missing") is None
+    assert index.by_number(4).serviceId == "NL_3"
+    assert index.by_number("12").serviceId == "NL_4"
+    assert index.by_number(99) is None
+
+
+def test_lookup_by_title_exact_then_normalized():
+    index = ZiggoChannelIndex(_lineup())
+    assert index.by_title("NPO 1").serviceId == "NL_1"
+    assert index.by_title("  ons   tele ").serviceId == "NL_4"
+    assert index.by_title("rtl 4").serviceId == "NL_3"
+    assert index.by_title("BBC One") is None
+
+
+def test_neighbor_follows_channel_numbers_and_wraps():
+    index = ZiggoChannelIndex(_lineup())
+    assert index.neighbor("NL_2").serviceId == "NL_3"
+    assert index.neighbor("NL_3").serviceId == "NL_6"
+    assert index.neighbor("NL_4").serviceId == "NL_1"
+    assert index.neighbor("NL_1", -1).serviceId == "NL_4"
+    assert index.neighbor("NL_1", 3).serviceId == "NL_6"
+
+
+def test_neighbor_skips_channels_without_numeric_number():
+    index = ZiggoChannelIndex(_lineup())
+    assert index.neighbor("NL_5") is None
+    assert all(index.neighbor("NL_1", offset).serviceId != "NL_5" for offset in range(6))
+
+
+def test_search_prefix_matches_first_then_fuzzy():
+    index = ZiggoChannelIndex(_lineup())
+    assert [c.serviceId for c in index.search("npo")] == ["NL_1", "NL_2"]
+    assert [c.serviceId for c in index.search("npo", limit=1)] == ["NL_1"]
+    assert index.search("rtl 5")[0].serviceId == "NL_3"
+    assert index.search("zzzz") == []
+
+
+def test_rebuild_replaces_previous_lineup():
+    index = ZiggoChannelIndex(_lineup())
+    index.build({"NL_9": ZiggoChannel("NL_9", "Veronica", None, None, "7")})
+    assert index.by_service_id("NL_1") is None
+    assert index.by_title("veronica").serviceId == "NL_9"
+    assert index.neighbor("NL_9").serviceId == "NL_9"
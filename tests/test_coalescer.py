@@ -0,0 +1,130 @@
+from ziggonext import coalescer
+from ziggonext.coalescer import ZiggoNextStatusCoalescer
+
+
+class FakeTimer:
+    def __init__(self, delay, callback):
+        self.delay = delay
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        assert not self.cancelled
+        self.callback()
+
+
+class Timers:
+    """Timer factory for the coalescer that fires only when the test says so"""
+
+    def __init__(self):
+        self.started = []
+
+    def __call__(self, delay, callback):
+        timer = FakeTimer(delay, callback)
+        self.started.append(timer)
+        return timer
+
+    def active(self, delay):
+        return [timer for timer in self.started if timer.delay == delay and not timer.cancelled]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _coalescer(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(coalescer.time, "monotonic", clock)
+    sent = []
+    timers = Timers()
+    statusRequests = ZiggoNextStatusCoalescer(lambda: sent.append(clock.now), debounce=0.3, freshness=1.0, replyTimeout=3.0, timer=timers)
+    return statusRequests, sent, timers, clock
+
+
+def test_one_request_in_flight(monkeypatch):
+    statusRequests, sent, timers, clock = _coalescer(monkeypatch)
+    statusRequests.request()
+    statusRequests.request()
+    statusRequests.request(force=True)
+    assert len(sent) == 1
+    assert len(timers.active(3.0)) == 1
+
+
+def test_forced_request_in_flight_sends_trailing_request_after_reply(monkeypatch):
+    statusRequests, sent, timers, clock = _coalescer(monkeypatch)
+    statusRequests.request()
+    statusRequests.request(force=True)
+    statusRequests.request(force=True)
+    statusRequests.status_received()
+    assert len(sent) == 1
+    assert timers.active(3.0) == []
+    (debounce,) = timers.active(0.3)
+    debounce.fire()
+    assert len(sent) == 2
+
+
+def test_unforced_request_in_flight_has_no_trailing_request(monkeypatch):
+    statusRequests, sent, timers, clock = _coalescer(monkeypatch)
+    statusRequests.request()
+    statusRequests.request()
+    statusRequests.status_received()
+    assert timers.active(0.3) == []
+    assert len(sent) == 1
+
+
+def test_burst_during_debounce_restarts_it(monkeypatch):
+    statusRequests, sent, timers, clock = _coalescer(monkeypatch)
+    statusRequests.request()
+    statusRequests.request(force=True)
+    statusRequests.status_received()
+    (first,) = timers.active(0.3)
+    statusRequests.request(force=True)
+    statusRequests.request(force=True)
+    assert first.cancelled
+    (last,) = timers.active(0.3)
+    last.fire()
+    assert len(sent) == 2
+
+
+def test_fresh_status_skips_unforced_request(monkeypatch):
+    statusRequests, sent, timers, clock = _coalescer(monkeypatch)
+    statusRequests.status_received()
+    clock.now += 0.5
+    statusRequests.request()
+    assert sent == []
+    statusRequests.request(force=True)
+    assert len(sent) == 1
+
+
+def test_stale_status_allows_request(monkeypatch):
+    statusRequests, sent, timers, clock = _coalescer(monkeypatch)
+    statusRequests.status_received()
+    clock.now += 1.5
+    statusRequests.request()
+    assert len(sent) == 1
+
+
+def test_reply_timeout_frees_the_slot(monkeypatch):
+    statusRequests, sent, timers, clock = _coalescer(monkeypatch)
+    statusRequests.request()
+    (reply,) = timers.active(3.0)
+    reply.fire()
+    statusRequests.request()
+    assert len(sent) == 2
+
+
+def test_cancel_stops_timers(monkeypatch):
+    statusRequests, sent, timers, clock = _coalescer(monkeypatch)
+    statusRequests.request()
+    statusRequests.request(force=True)
+    statusRequests.cancel()
+    assert all(timer.cancelled for timer in timers.started)
+    statusRequests.status_received()
+    assert timers.active(0.3) == []
@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+from ziggonext.commands import KeyCommand, TuneCommand, WaitCommand, ZiggoNextCommandQueue, keys
+from ziggonext.models import ZiggoNextBoxPlayingInfo
+
+
+class FakeBox:
+    """Box that answers commands the way the status handlers of ZiggoNextBox report them"""
+
+    name = "Box"
+    box_id = "box"
+
+    def __init__(self, answer: bool = True):
+        self.answer = answer
+        self.statusCount = 0
+        self.updateCount = 0
+        self.info = ZiggoNextBoxPlayingInfo()
+        self.pressed = []
+        self.commands = None
+
+    def _press_key(self, key):
+        self.pressed.append(key)
+        if self.answer:
+            threading.Timer(0.01, self.status).start()
+
+    def _push_channel(self, serviceId):
+        self.info = self.info.replace(channelId=serviceId)
+        self.enrichment()
+
+    def status(self):
+        self.statusCount += 1
+        self.updateCount += 1
+        self.commands.notify()
+
+    def enrichment(self):
+        self.updateCount += 1
+        self.commands.notify()
+
+
+def _queue(box, interval=0.01):
+    box.commands = ZiggoNextCommandQueue(box, logging.getLogger("test"), interval=interval)
+    return box.commands
+
+
+def test_key_commands_run_in_order_once_acknowledged():
+    box = FakeBox()
+    queue = _queue(box)
+    assert queue.submit(keys("ChannelUp", "ChannelUp", "Power")).result(2) is True
+    assert box.pressed == ["ChannelUp", "ChannelUp", "Power"]
+    assert box.statusCount == 3
+
+
+def test_status_during_pacing_does_not_acknowledge_the_next_key():
+    box = FakeBox(answer=False)
+    queue = _queue(box, interval=0.3)
+    queue._lastPublish = time.monotonic()
+    threading.Timer(0.1, box.status).start()
+    with pytest.raises(TimeoutError):
+        queue.submit(KeyCommand("Power", timeout=0.3)).result(2)
+    assert box.pressed == ["Power"]
+
+
+def test_enrichment_does_not_acknowledge_a_key():
+    box = FakeBox(answer=False)
+    queue = _queue(box)
+    future = queue.submit(KeyCommand("Power", timeout=0.3))
+    time.sleep(0.05)
+    box.enrichment()
+    with pytest.raises(TimeoutError):
+        future.result(2)
+
+
+def test_key_with_predicate_waits_for_it():
+    box = FakeBox()
+    queue = _queue(box)
+    future = queue.submit(KeyCommand("Power", until=lambda b: b.statusCount >= 2, timeout=1))
+    time.sleep(0.1)
+    assert not future.done()
+    box.status()
+    assert future.result(2) is True
+
+
+def test_tune_is_done_when_the_box_plays_the_channel():
+    box = FakeBox()
+    queue = _queue(box)
+    assert queue.submit(TuneCommand("NL_1")).result(2) is True
+    assert box.info.channelId == "NL_1"
+
+
+def test_failed_batch_does_not_stop_the_next_one():
+    box = FakeBox()
+    queue = _queue(box)
+    failing = queue.submit(WaitCommand(lambda b: False, timeout=0.05))
+    following = queue.submit(KeyCommand("Power"))
+    with pytest.raises(TimeoutError):
+        failing.result(2)
+    assert following.result(2) is True
+
+
+def test_stop_cancels_running_and_queued_batches():
+    box = FakeBox()
+    queue = _queue(box)
+    running = queue.submit(WaitCommand(lambda b: False, timeout=10))
+    queued = queue.submit(KeyCommand("Power"))
+    time.sleep(0.05)
+    queue.stop()
+    with pytest.raises(CancelledError):
+        running.result(2)
+    assert queued.cancelled()
+    with pytest.raises(RuntimeError):
+        queue.submit(KeyCommand("Power"))
@@ -1,6 +1,57 @@
 """Python client for Ziggo Next."""
+import importlib
+import sys
 
-from .ziggonext import ZiggoNext
-from .ziggonextbox import ZiggoNextBox
+from .snapshot import ZiggoNextSnapshotStore
+from .models import ZiggoNextBoxChange
+from .metrics import ZiggoNextMetrics, ZiggoNextMetricsRegistry
+from .commands import KeyCommand, TuneCommand, WaitCommand
 from .const import ONLINE_RUNNING, ONLINE_STANDBY
-from .exceptions import ZiggoNextAuthenticationError, ZiggoNextConnectionError
\ No newline at end of file
+from .exceptions import ZiggoNextAuthenticationError, ZiggoNextConnectionError, ZiggoNextChannelNotFoundError
+
+# Loaded on first access, so importing the package does not pull in requests, paho-mqtt or aiohttp
+_LAZY_IMPORTS = {
+    "ZiggoNext": ".ziggonext",
+    "ZiggoNextManager": ".manager",
+    "ZiggoNextRecorder": ".recorder",
+    "ZiggoNextReplayer": ".replay",
+    "ZiggoNextArtworkCache": ".artwork",
+    "ZiggoNextBox": ".ziggonextbox",
+    "AsyncZiggoNext": ".asyncziggonext",
+    "AsyncZiggoNextBox": ".asyncziggonextbox",
+}
+
+
+__all__ = [
+    "ZiggoNextSnapshotStore",
+    "ZiggoNextBoxChange",
+    "ZiggoNextMetrics",
+    "ZiggoNextMetricsRegistry",
+    "KeyCommand",
+    "TuneCommand",
+    "WaitCommand",
+    "ONLINE_RUNNING",
+    "ONLINE_STANDBY",
+    "ZiggoNextAuthenticationError",
+    "ZiggoNextConnectionError",
+    "ZiggoNextChannelNotFoundError",
+] + list(_LAZY_IMPORTS)
+
+
+def __getattr__(name):
+    module = _LAZY_IMPORTS.get(name)
+    if module is None:
+        raise AttributeError("module {module!r} has no attribute {name!r}".format(module=__name__, name=name))
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_IMPORTS))
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    # module __getattr__ needs python 3.7
+    for _name in _LAZY_IMPORTS:
+        __getattr__(_name)
@@ -0,0 +1,6 @@
+"""Runs the ziggonext command with python -m ziggonext."""
+import sys
+
+from .cli import main
+
+sys.exit(main())
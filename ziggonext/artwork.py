@@ -0,0 +1,322 @@
+"""Local cache of Ziggo Next artwork."""
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from logging import Logger
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+from .transport import ZiggoNextTransport
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+from .exceptions import ZiggoNextConnectionError
+
+DEFAULT_ARTWORK_MAX_BYTES = 200 * 1024 * 1024
+DEFAULT_ARTWORK_MAX_AGE = 24 * 60 * 60
+DEFAULT_THUMBNAIL_SIZE = (320, 180)
+INDEX_SAVE_INTERVAL = 30
+
+
+def _extension(content: bytes) -> str:
+    """File extension matching the image format of the content"""
+    if content.startswith(b"\x89PNG"):
+        return ".png"
+    if content.startswith(b"\xff\xd8"):
+        return ".jpg"
+    if content.startswith(b"GIF8"):
+        return ".gif"
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return ".webp"
+    if content.lstrip()[:5] in (b"<?xml", b"<svg "):
+        return ".svg"
+    return ""
+
+
+def _channel_images(channels: dict) -> list:
+    """Stream images and logos of a lineup"""
+    urls = []
+    for channel in channels.values():
+        for url in (channel.streamImage, channel.logoImage):
+            if url:
+                urls.append(url)
+    return urls
+
+
+def _with_local_images(channels: dict, artwork) -> dict:
+    """Copies of the channels carrying the local paths of their images that are cached"""
+    return {
+        serviceId: channel.replace(
+            localStreamImage=artwork.peek(channel.streamImage),
+            localLogoImage=artwork.peek(channel.logoImage),
+        )
+        for serviceId, channel in channels.items()
+    }
+
+
+class _ArtworkEntry:
+    __slots__ = ("digest", "fileName", "size", "etag", "lastModified", "checkedAt")
+
+    def __init__(self, digest, fileName, size, etag=None, lastModified=None, checkedAt=0.0):
+        self.digest = digest
+        self.fileName = fileName
+        self.size = size
+        self.etag = etag
+        self.lastModified = lastModified
+        self.checkedAt = checkedAt
+
+
+class ZiggoNextArtworkCache:
+    """Content-addressed on-disk cache of channel logos, stream images and program art.
+
+    Images are stored once per content hash and evicted least recently used
+    beyond maxBytes. Entries older than maxAge are revalidated with
+    If-None-Match/If-Modified-Since before use; when that fails the stored
+    image is served. The index is written at most every INDEX_SAVE_INTERVAL
+    seconds, after a prefetch and on flush(). Thumbnails need Pillow
+    (ziggonext[thumbnails]).
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory: str, transport: ZiggoNextTransport, logger: Logger, maxBytes: int = DEFAULT_ARTWORK_MAX_BYTES, maxAge: float = DEFAULT_ARTWORK_MAX_AGE, thumbnailSize: tuple = DEFAULT_THUMBNAIL_SIZE, metrics: ZiggoNextMetrics = NULL_METRICS):
+        self.directory = directory
+        self.transport = transport
+        self.logger = logger
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.thumbnailSize = thumbnailSize
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._blobRefs = {}
+        self._blobSizes = {}
+        self._inFlight = {}
+        self._size = 0
+        self._indexSavedAt = time.monotonic()
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "thumbs"), exist_ok=True)
+        self._load_index()
+
+    @property
+    def size(self) -> int:
+        """Bytes on disk of images and thumbnails"""
+        return self._size
+
+    def peek(self, url: str) -> str:
+        """Local path of a cached image, without network access"""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            self._entries.move_to_end(url)
+            return self._blob_path(entry.fileName)
+
+    def path(self, url: str) -> str:
+        """Local path of the image, fetched or revalidated when needed, None when it can't be fetched"""
+        if not url:
+            return None
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+                if time.time() - entry.checkedAt < self.maxAge:
+                    self.metrics.increment("ziggonext_artwork_cache_total", result="hit")
+                    return self._blob_path(entry.fileName)
+            inFlight = self._inFlight.get(url)
+            if inFlight is None:
+                self._inFlight[url] = threading.Event()
+        if inFlight is not None:
+            inFlight.wait()
+            return self.peek(url)
+        try:
+            return self._fetch(url, entry)
+        finally:
+            with self._lock:
+                self._inFlight.pop(url).set()
+
+    def get_bytes(self, url: str) -> bytes:
+        """Content of the image, None when it can't be fetched"""
+        path = self.path(url)
+        if path is None:
+            return None
+        with open(path, "rb") as fp:
+            return fp.read()
+
+    def thumbnail(self, url: str, size: tuple = None) -> str:
+        """Local path of a thumbnail of the image fitting in size, made once per image"""
+        if Image is None:
+            raise ImportError("Thumbnails require Pillow, install ziggonext[thumbnails]")
+        size = size or self.thumbnailSize
+        path = self.path(url)
+        if path is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            digest = entry.digest
+        with Image.open(path) as image:
+            image.thumbnail(size)
+            keepAlpha = image.mode in ("RGBA", "LA", "P")
+            thumbPath = self._thumb_path(digest, size, ".png" if keepAlpha else ".jpg")
+            if os.path.exists(thumbPath):
+                return thumbPath
+            output = io.BytesIO()
+            if keepAlpha:
+                image.save(output, "PNG", optimize=True)
+            else:
+                image.convert("RGB").save(output, "JPEG", quality=85)
+        content = output.getvalue()
+        with self._lock:
+            if digest not in self._blobRefs:
+                return None
+            if not os.path.exists(thumbPath):
+                _write_atomic(thumbPath, content)
+                self._blobSizes[digest] += len(content)
+                self._size += len(content)
+                self._evict()
+            return thumbPath if digest in self._blobRefs else None
+
+    def prefetch(self, urls):
+        """Fetches the images not cached yet, e.g. all logos after loading the channels"""
+        fetched = 0
+        for url in dict.fromkeys(urls):
+            if self.peek(url) is None and self.path(url) is not None:
+                fetched += 1
+        if fetched:
+            self.logger.debug("Prefetched %s images.", fetched)
+            self.flush()
+        return fetched
+
+    def flush(self):
+        """Writes the index with the current usage order"""
+        with self._lock:
+            self._save_index()
+
+    def _fetch(self, url: str, entry: _ArtworkEntry) -> str:
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.lastModified:
+                headers["If-Modified-Since"] = entry.lastModified
+        try:
+            response = self.transport.get(url, headers=headers)
+        except ZiggoNextConnectionError as ex:
+            self.logger.debug("Could not fetch image %s: %s", url, ex)
+            return self.peek(url)
+        if response.status_code == 304 and entry is not None:
+            self.metrics.increment("ziggonext_artwork_cache_total", result="revalidated")
+            with self._lock:
+                entry.checkedAt = time.time()
+                return self._blob_path(entry.fileName)
+        if response.status_code != 200:
+            self.logger.debug("Could not fetch image %s: %s", url, response.status_code)
+            return self.peek(url)
+        self.metrics.increment("ziggonext_artwork_cache_total", result="miss")
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+        fileName = digest + _extension(content)
+        with self._lock:
+            if digest not in self._blobRefs:
+                _write_atomic(self._blob_path(fileName), content)
+                self._blobRefs[digest] = 0
+                self._blobSizes[digest] = len(content)
+                self._size += len(content)
+            self._blobRefs[digest] += 1
+            self._remove(url)
+            self._entries[url] = _ArtworkEntry(
+                digest, fileName, len(content),
+                response.headers.get("ETag"), response.headers.get("Last-Modified"), time.time(),
+            )
+            self._evict()
+            if time.monotonic() - self._indexSavedAt >= INDEX_SAVE_INTERVAL:
+                self._save_index()
+            return self._blob_path(fileName) if url in self._entries else None
+
+    def _evict(self):
+        """Drops the least recently used images until the cache fits in maxBytes"""
+        while self._size > self.maxBytes and self._entries:
+            url = next(iter(self._entries))
+            self._remove(url)
+            self.metrics.increment("ziggonext_artwork_cache_total", result="evicted")
+
+    def _remove(self, url: str):
+        """Forgets an url, deleting its image and thumbnails once no other url refers to them"""
+        entry = self._entries.pop(url, None)
+        if entry is None:
+            return
+        self._blobRefs[entry.digest] -= 1
+        if self._blobRefs[entry.digest] > 0:
+            return
+        del self._blobRefs[entry.digest]
+        self._size -= self._blobSizes.pop(entry.digest)
+        _unlink(self._blob_path(entry.fileName))
+        thumbs = os.path.join(self.directory, "thumbs")
+        for name in os.listdir(thumbs):
+            if name.startswith(entry.digest):
+                _unlink(os.path.join(thumbs, name))
+
+    def _blob_path(self, fileName: str) -> str:
+        return os.path.join(self.directory, "blobs", fileName)
+
+    def _thumb_path(self, digest: str, size: tuple, extension: str) -> str:
+        name = "{digest}-{width}x{height}{extension}".format(digest=digest, width=size[0], height=size[1], extension=extension)
+        return os.path.join(self.directory, "thumbs", name)
+
+    def _index_path(self) -> str:
+        return os.path.join(self.directory, "index.json")
+
+    def _load_index(self):
+        """Restores the entries whose image is still on disk, least recently used first"""
+        try:
+            with open(self._index_path(), encoding="utf-8") as fp:
+                content = json.load(fp)
+        except (OSError, ValueError):
+            return
+        if content.get("version") != self.FORMAT_VERSION:
+            return
+        thumbSizes = {}
+        for name in os.listdir(os.path.join(self.directory, "thumbs")):
+            digest = name.split("-", 1)[0]
+            thumbSizes[digest] = thumbSizes.get(digest, 0) + os.path.getsize(os.path.join(self.directory, "thumbs", name))
+        for url, digest, fileName, size, etag, lastModified, checkedAt in content["entries"]:
+            if not os.path.exists(self._blob_path(fileName)):
+                continue
+            self._entries[url] = _ArtworkEntry(digest, fileName, size, etag, lastModified, checkedAt)
+            if digest not in self._blobRefs:
+                self._blobRefs[digest] = 0
+                self._blobSizes[digest] = size + thumbSizes.get(digest, 0)
+                self._size += self._blobSizes[digest]
+            self._blobRefs[digest] += 1
+
+    def _save_index(self):
+        content = {
+            "version": self.FORMAT_VERSION,
+            "entries": [
+                [url, e.digest, e.fileName, e.size, e.etag, e.lastModified, e.checkedAt]
+                for url, e in self._entries.items()
+            ],
+        }
+        _write_atomic(self._index_path(), json.dumps(content, separators=(",", ":")).encode("utf-8"))
+        self._indexSavedAt = time.monotonic()
+
+
+def _write_atomic(path: str, content: bytes):
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "wb") as fp:
+        fp.write(content)
+    os.replace(tmpPath, path)
+
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
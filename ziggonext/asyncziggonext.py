@@ -0,0 +1,530 @@
+"""Asyncio client for Ziggo Next."""
+import asyncio
+import time
+from logging import Logger
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from .models import ZiggoNextSession
+from .asyncziggonextbox import AsyncZiggoNextBox
+from .mqttclient import AsyncZiggoNextMqttClient
+from .listings import AsyncZiggoNextListingCache
+from .channels import ZiggoChannelIndex, ZiggoChannelCache
+from .events import ZiggoNextListeners
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+from .transport import _endpoint, _async_get, _async_timeout
+from .epg import _listings_params, _parse_listings_page
+from .sessionstore import ZiggoNextSessionStore, ZiggoNextStoredSession
+from .snapshot import ZiggoNextSnapshotStore, _snapshot_signature
+from .artwork import ZiggoNextArtworkCache, _channel_images, _with_local_images
+from .exceptions import ZiggoNextConnectionError, ZiggoNextAuthenticationError, ZiggoNextChannelNotFoundError
+from .ziggonext import (
+    TOKEN_REFRESH_RETRY_DELAY,
+    ZAP_PREFETCH_NEIGHBORS,
+    _airing,
+    _token_refresh_delay,
+    _raise_api_error,
+    _raise_session_error,
+    _SessionRejectedError,
+    _parse_session,
+    _parse_settop_boxes,
+    _parse_channels,
+)
+from .const import (
+    ONLINE_RUNNING,
+    ONLINE_STANDBY,
+    MEDIA_KEY_PLAY_PAUSE,
+    MEDIA_KEY_CHANNEL_DOWN,
+    MEDIA_KEY_CHANNEL_UP,
+    MEDIA_KEY_POWER,
+    COUNTRY_URLS_HTTP,
+    COUNTRY_URLS_PERSONALIZATION_FORMAT
+)
+
+
+class AsyncZiggoNext:
+    """Asyncio variant of ZiggoNext, driving all boxes from one event loop."""
+    logger: Logger
+    session: ZiggoNextSession
+    def __init__(self, username: str, password: str, country_code: str = "nl", httpSession=None, channelCache: ZiggoChannelCache = None, sessionStore: ZiggoNextSessionStore = None, metrics: ZiggoNextMetrics = None, mqttOptions: dict = None, snapshotStore: ZiggoNextSnapshotStore = None, artworkCache: ZiggoNextArtworkCache = None) -> None:
+        """Initialize connection with Ziggo Next
+
+        mqttOptions (port, transport, tls) override how the mqtt broker is reached.
+        A snapshotStore restores the boxes with their last known state on start, marked stale until confirmed.
+        An artworkCache keeps channel logos and program art on disk, box info then carries localImage.
+        """
+        self.metrics = metrics or NULL_METRICS
+        self.mqttOptions = mqttOptions or {}
+        if httpSession is None and aiohttp is None:
+            raise ImportError("AsyncZiggoNext requires aiohttp, install ziggonext[async]")
+        self.username = username
+        self.password = password
+        self.token = None
+        self.session = None
+        self.logger = None
+        self.settop_boxes = {}
+        self.channels = {}
+        self.channelIndex = ZiggoChannelIndex()
+        self.channelCache = channelCache
+        self._channelsEtag = None
+        self._channelsLastModified = None
+        self.sessionStore = sessionStore
+        self._tokenLock = asyncio.Lock()
+        self._tokenRefreshHandle = None
+        self._sessionRestored = False
+        self.mqttClient = None
+        self.listings = None
+        self.timings = {}
+        self._listeners = ZiggoNextListeners(None)
+        self._country_code = country_code
+        self._httpSession = httpSession
+        self._ownsHttpSession = httpSession is None
+        self.snapshotStore = snapshotStore
+        self._snapshotSignature = None
+        self._snapshotHandle = None
+        self.artwork = artworkCache
+        self._nowListings = {}
+
+    async def get_session(self):
+        """Get Ziggo Next Session information"""
+        payload = {"username": self.username, "password": self.password}
+        try:
+            async with self._httpSession.post(self._api_url_session, json=payload) as response:
+                content = await response.json()
+                ok = response.status < 400
+        except (Exception):
+            raise ZiggoNextConnectionError("Unknown connection failure")
+
+        self.logger.debug(content)
+        if not ok:
+            _raise_session_error(content)
+        self.session = _parse_session(content)
+
+    async def get_session_and_token(self):
+        """Get session and token from Ziggo Next, reusing a stored session while it is valid"""
+        async with self._tokenLock:
+            self._sessionRestored = await self._restore_session()
+            if not self._sessionRestored:
+                await self.get_session()
+                await self._get_token()
+            self._save_session()
+        self._schedule_token_refresh()
+
+    async def _renew_session(self):
+        """Drops a stored session the api rejected, e.g. after a password change, and logs in again"""
+        self.logger.debug("Stored session rejected, logging in again.")
+        async with self._tokenLock:
+            try:
+                self.sessionStore.remove(self._session_key())
+            except OSError as ex:
+                self.logger.error("Could not remove stored session: %s", ex)
+            self._sessionRestored = False
+            await self.get_session()
+            await self._get_token()
+            self._save_session()
+        self._schedule_token_refresh()
+
+    async def refresh_token(self) -> str:
+        """Fetch a new token before the current one expires and hand it to the mqtt client"""
+        async with self._tokenLock:
+            try:
+                await self._get_token()
+            except ZiggoNextConnectionError:
+                self.logger.debug("Token refresh failed, starting a new session.")
+                try:
+                    await self.get_session()
+                    await self._get_token()
+                except (ZiggoNextConnectionError, ZiggoNextAuthenticationError) as ex:
+                    self.logger.error("Could not refresh token: %s", ex)
+                    self._schedule_token_refresh(TOKEN_REFRESH_RETRY_DELAY)
+                    return self.token
+            self._save_session()
+        if self.mqttClient is not None:
+            self.mqttClient.update_token(self.token)
+        self._schedule_token_refresh()
+        return self.token
+
+    def _session_key(self) -> str:
+        return self._country_code + ":" + self.username
+
+    async def _restore_session(self) -> bool:
+        """Reuses the stored session, fetching only a new token when that one expired"""
+        if self.sessionStore is None:
+            return False
+        stored = self.sessionStore.load(self._session_key())
+        if stored is None:
+            return False
+        self.session = stored.session
+        if stored.token_valid():
+            self.token = stored.token
+            self.logger.debug("Reusing stored session and token.")
+            return True
+        try:
+            await self._get_token()
+        except ZiggoNextConnectionError:
+            self.logger.debug("Stored session expired.")
+            return False
+        return True
+
+    def _save_session(self):
+        if self.sessionStore is None:
+            return
+        try:
+            self.sessionStore.save(self._session_key(), ZiggoNextStoredSession(self.session, self.token))
+        except OSError as ex:
+            self.logger.error("Could not store session: %s", ex)
+
+    def _schedule_token_refresh(self, delay: float = None):
+        """Schedules refresh_token shortly before the token expires"""
+        if delay is None:
+            delay = _token_refresh_delay(self.token)
+            if delay is None:
+                return
+        if self._tokenRefreshHandle is not None:
+            self._tokenRefreshHandle.cancel()
+        loop = asyncio.get_event_loop()
+        self._tokenRefreshHandle = loop.call_later(delay, lambda: loop.create_task(self.refresh_token()))
+
+    async def _register_settop_boxes(self):
+        """Get settopxes"""
+        snapshot = self._load_snapshot()
+        try:
+            boxes = await self._fetch_settop_boxes()
+        except ZiggoNextConnectionError:
+            if not snapshot:
+                raise
+            self.logger.warning("Could not fetch settop boxes, using the snapshot.")
+            boxes = [(box_id, name) for box_id, (name, state, info) in snapshot.items()]
+        self.mqttClient = AsyncZiggoNextMqttClient(self.session.householdId, self.token, self._country_code, self.logger, self.refresh_token, self.metrics, **self.mqttOptions)
+        for box_id, name in boxes:
+            box = AsyncZiggoNextBox(box_id, name, self.session.householdId, self.mqttClient, self.listings, self.logger, metrics=self.metrics)
+            box.channels = self.channels
+            box.artwork = self.artwork
+            if box_id in snapshot:
+                box._restore(snapshot[box_id][1], snapshot[box_id][2])
+            box.add_listener(self._listeners.notify)
+            self.settop_boxes[box_id] = box
+        self._schedule_snapshot()
+
+    async def _fetch_settop_boxes(self) -> list:
+        """Boxes of the household, logging in again once when the api rejects a stored session"""
+        try:
+            return await self._get_settop_boxes()
+        except _SessionRejectedError:
+            if not self._sessionRestored:
+                raise
+        await self._renew_session()
+        return await self._get_settop_boxes()
+
+    async def _get_settop_boxes(self) -> list:
+        self._api_url_settop_boxes =  COUNTRY_URLS_PERSONALIZATION_FORMAT[self._country_code].format(household_id=self.session.householdId)
+        return list(_parse_settop_boxes(await self._do_api_call(self.session, self._api_url_settop_boxes)))
+
+    def _load_snapshot(self) -> dict:
+        if self.snapshotStore is None:
+            return {}
+        return self.snapshotStore.load(self._session_key())
+
+    def save_snapshot(self):
+        """Writes the boxes with their state and playing info to the snapshot store, if anything changed"""
+        if self.snapshotStore is None or not self.settop_boxes:
+            return
+        boxes = list(self.settop_boxes.values())
+        signature = _snapshot_signature(boxes)
+        if signature == self._snapshotSignature:
+            return
+        try:
+            self.snapshotStore.store(self._session_key(), boxes)
+        except OSError as ex:
+            self.logger.error("Could not save snapshot: %s", ex)
+            return
+        self._snapshotSignature = signature
+
+    def _schedule_snapshot(self):
+        """Saves the snapshot every snapshotStore.interval seconds"""
+        if self.snapshotStore is None:
+            return
+        def tick():
+            self.save_snapshot()
+            self._schedule_snapshot()
+        self._snapshotHandle = self.mqttClient.call_later(self.snapshotStore.interval, tick)
+
+    async def _do_api_call(self, session, url):
+        """Executes api call and returns json object"""
+        headers = {
+            "X-OESP-Token": session.oespToken,
+            "X-OESP-Username": self.username,
+        }
+        with self.metrics.span("ziggonext_http_request", method="GET", endpoint=_endpoint(url)):
+            response, content = await _async_get(self._httpSession, url, headers=headers)
+        if response.status == 200:
+            return content
+        _raise_api_error(response.status)
+
+    async def _get_token(self):
+        """Get token from Ziggo Next"""
+        jsonResult = await self._do_api_call(self.session, self._api_url_token)
+        self.token = jsonResult["token"]
+        self.logger.debug("Fetched a token: %s", jsonResult)
+
+    async def initialize(self, logger):
+        """Get token and start mqtt client for receiving data from Ziggo Next
+
+        Channels load concurrently with the session, token and devices.
+        Stage durations end up in self.timings.
+        """
+        baseUrl = COUNTRY_URLS_HTTP[self._country_code]
+        self._api_url_session =  baseUrl + "/session"
+        self._api_url_token =  baseUrl + "/tokens/jwt"
+        self._api_url_channels =  baseUrl + "/channels"
+        self._api_url_listings = baseUrl + "/listings"
+        self.logger = logger
+        self._listeners.logger = logger
+        if self._httpSession is None:
+            self._httpSession = aiohttp.ClientSession(timeout=_async_timeout())
+        self.listings = AsyncZiggoNextListingCache(baseUrl + "/listings/{id}", logger, self._httpSession, metrics=self.metrics)
+        self.timings = {}
+        started = time.perf_counter()
+        await asyncio.gather(
+            self._timed("channels", self._initialize_channels()),
+            self._initialize_session_and_devices(),
+        )
+        for box in self.settop_boxes.values():
+            box.channels = self.channels
+        await self._timed("mqtt", self.mqttClient.connect())
+        self.timings["total"] = time.perf_counter() - started
+        self.logger.debug("Initialized in %s", self.timings)
+
+    async def _initialize_session_and_devices(self):
+        await self._timed("session", self.get_session_and_token())
+        await self._timed("devices", self._register_settop_boxes())
+
+    async def _timed(self, stage: str, coro):
+        """Awaits an initialization stage and records its duration"""
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.timings[stage] = time.perf_counter() - started
+
+    async def _initialize_channels(self):
+        """Restores the lineup from cache and refreshes it in the background, or loads it"""
+        if self._restore_channels():
+            asyncio.get_event_loop().create_task(self.load_channels())
+        else:
+            await self.load_channels()
+
+    async def close(self):
+        """Disconnects from mqtt and closes the http session if it is owned by this client"""
+        if self._tokenRefreshHandle is not None:
+            self._tokenRefreshHandle.cancel()
+            self._tokenRefreshHandle = None
+        if self._snapshotHandle is not None:
+            self._snapshotHandle.cancel()
+            self._snapshotHandle = None
+        self.save_snapshot()
+        if self.artwork is not None:
+            self.artwork.flush()
+        for box in self.settop_boxes.values():
+            box.close()
+        if self.mqttClient is not None:
+            await self.mqttClient.disconnect()
+        if self._ownsHttpSession and self._httpSession is not None:
+            await self._httpSession.close()
+            self._httpSession = None
+
+    def add_listener(self, callback):
+        """Calls callback(ZiggoNextBoxChange) on every real change of any box, returns a function to remove it"""
+        return self._listeners.add(callback)
+
+    def changes(self):
+        """Async iterator of ZiggoNextBoxChange events of all boxes"""
+        return self._listeners.changes()
+
+    def run_commands(self, box_id, commands) -> asyncio.Future:
+        """Queue a command or macro for the settop box, the future resolves once the box acknowledged it"""
+        return self.settop_boxes[box_id].commands.submit(commands)
+
+    async def _send_key_to_box(self, box_id: str, key: str):
+        await self.settop_boxes[box_id].send_key_to_box(key)
+
+    async def select_source(self, source, box_id):
+        """Changes te channel from the settopbox"""
+        await self._select_channel(self.channelIndex.by_title(source), source, box_id)
+
+    async def select_source_by_number(self, channelNumber, box_id):
+        """Changes the channel from the settopbox by channel number"""
+        await self._select_channel(self.channelIndex.by_number(channelNumber), channelNumber, box_id)
+
+    async def select_source_by_service_id(self, serviceId, box_id):
+        """Changes the channel from the settopbox by serviceId"""
+        await self._select_channel(self.channelIndex.by_service_id(serviceId), serviceId, box_id)
+
+    async def _select_channel(self, channel, key, box_id):
+        if channel is None:
+            raise ZiggoNextChannelNotFoundError("Channel not found: " + str(key))
+        await self.settop_boxes[box_id].set_channel(channel.serviceId)
+
+    def search_channels(self, query: str, limit: int = 10):
+        """Channels matching the query by title prefix or fuzzy match, for pickers"""
+        return self.channelIndex.search(query, limit)
+
+    async def pause(self, box_id):
+        """Pauses the given settopbox"""
+        box = self.settop_boxes[box_id]
+        if box.state == ONLINE_RUNNING and not box.info.paused:
+            await self._send_key_to_box(box_id, MEDIA_KEY_PLAY_PAUSE)
+
+    async def play(self, box_id):
+        """Resumes the settopbox"""
+        box = self.settop_boxes[box_id]
+        if box.state == ONLINE_RUNNING and box.info.paused:
+            await self._send_key_to_box(box_id, MEDIA_KEY_PLAY_PAUSE)
+
+    async def next_channel(self, box_id):
+        """Select the next channel for given settop box."""
+        box = self.settop_boxes[box_id]
+        if box.state == ONLINE_RUNNING:
+            await self._send_key_to_box(box_id, MEDIA_KEY_CHANNEL_UP)
+
+    async def previous_channel(self, box_id):
+        """Select the previous channel for given settop box."""
+        box = self.settop_boxes[box_id]
+        if box.state == ONLINE_RUNNING:
+            await self._send_key_to_box(box_id, MEDIA_KEY_CHANNEL_DOWN)
+
+    async def zap(self, box_id, offset: int = 1):
+        """Tunes offset channels up, or down when negative, in channel number order
+
+        The target channel is worked out locally and tuned directly, box info
+        shows it right away and the listings of its neighbors are prefetched.
+        Without a known current channel a single step falls back to a key press.
+        """
+        box = self.settop_boxes[box_id]
+        if box.state != ONLINE_RUNNING:
+            return
+        channel = self.channelIndex.neighbor(box.info.channelId, offset)
+        if channel is None:
+            if offset not in (1, -1):
+                raise ZiggoNextChannelNotFoundError("Current channel of box {box} is unknown".format(box=box_id))
+            await self._send_key_to_box(box_id, MEDIA_KEY_CHANNEL_UP if offset > 0 else MEDIA_KEY_CHANNEL_DOWN)
+            return
+        listing = self._nowListings.get(channel.serviceId)
+        await box.tune(channel, listing if listing is not None and _airing(listing, time.time()) else None)
+        asyncio.get_event_loop().create_task(self.prefetch_neighbors(channel.serviceId))
+
+    async def prefetch_neighbors(self, serviceId: str, distance: int = ZAP_PREFETCH_NEIGHBORS):
+        """Fetches what airs now on a channel and the channels next to it, so zapping there needs no lookup"""
+        now = time.time()
+        stations = {}
+        for offset in range(-distance, distance + 1):
+            channel = self.channelIndex.neighbor(serviceId, offset)
+            if channel is None or not channel.stationId:
+                continue
+            listing = self._nowListings.get(channel.serviceId)
+            if listing is None or not _airing(listing, now):
+                stations[channel.stationId] = channel.serviceId
+        if not stations:
+            return
+        params = _listings_params(list(stations), now, now)
+        try:
+            response, content = await _async_get(self._httpSession, self._api_url_listings, params=params)
+        except ZiggoNextConnectionError as ex:
+            self.logger.warning("Can't retrieve listings: %s", ex)
+            return
+        if response.status != 200:
+            self.logger.warning("Can't retrieve listings: %s", response.status)
+            return
+        for listing in _parse_listings_page(content, stations):
+            if _airing(listing, now):
+                self._nowListings[listing.channelId] = listing
+                self.listings.put(listing)
+
+    async def turn_on(self, box_id):
+        """Turn the settop box on."""
+        box = self.settop_boxes[box_id]
+        if box.state == ONLINE_STANDBY:
+            await self._send_key_to_box(box_id, MEDIA_KEY_POWER)
+
+    async def turn_off(self, box_id):
+        """Turn the settop box off."""
+        box = self.settop_boxes[box_id]
+        if box.state == ONLINE_RUNNING:
+            await self._send_key_to_box(box_id, MEDIA_KEY_POWER)
+            await box.turn_off()
+
+    def is_available(self, box_id):
+        box = self.settop_boxes[box_id]
+        state = box.state
+        return (state == ONLINE_RUNNING or state == ONLINE_STANDBY)
+
+    async def load_channels(self):
+        """Refresh channels list for now-playing data."""
+        try:
+            response, content = await _async_get(self._httpSession, self._api_url_channels, headers=self._channel_validators())
+        except ZiggoNextConnectionError as ex:
+            self.logger.error("Can't retrieve channels: %s", ex)
+            return
+        if response.status == 304:
+            self.logger.debug("Channels unchanged.")
+            return
+        if response.status != 200:
+            self.logger.error("Can't retrieve channels...")
+            return
+        self._channelsEtag = response.headers.get("ETag")
+        self._channelsLastModified = response.headers.get("Last-Modified")
+        self._set_channels(_parse_channels(content))
+        self.logger.debug("Updated channels.")
+        if self.channelCache is not None:
+            try:
+                self.channelCache.store(self._country_code, self.channels, self._channelsEtag, self._channelsLastModified)
+            except OSError as ex:
+                self.logger.error("Could not cache channels: %s", ex)
+
+    def _restore_channels(self) -> bool:
+        """Loads the lineup from the channel cache, if there is one"""
+        if self.channelCache is None:
+            return False
+        cached = self.channelCache.load(self._country_code)
+        if cached is None:
+            return False
+        channels, self._channelsEtag, self._channelsLastModified = cached
+        self._set_channels(channels)
+        self.logger.debug("Restored channels from cache.")
+        return True
+
+    def _channel_validators(self) -> dict:
+        """Conditional request headers for refreshing the current lineup"""
+        headers = {}
+        if not self.channels:
+            return headers
+        if self._channelsEtag:
+            headers["If-None-Match"] = self._channelsEtag
+        if self._channelsLastModified:
+            headers["If-Modified-Since"] = self._channelsLastModified
+        return headers
+
+    def _set_channels(self, channels):
+        if self.artwork is not None:
+            channels = _with_local_images(channels, self.artwork)
+        self._apply_channels(channels)
+        if self.artwork is not None:
+            asyncio.get_event_loop().create_task(self.prefetch_artwork())
+
+    def _apply_channels(self, channels):
+        self.channels = channels
+        self.channelIndex.build(channels)
+        for box in self.settop_boxes.values():
+            box.channels = channels
+
+    async def prefetch_artwork(self) -> int:
+        """Downloads the stream images and logos of all channels into the artwork cache, then adds their local paths to the channels"""
+        channels = self.channels
+        loop = asyncio.get_event_loop()
+        fetched = await loop.run_in_executor(None, self.artwork.prefetch, _channel_images(channels))
+        if fetched and self.channels is channels:
+            self._apply_channels(_with_local_images(channels, self.artwork))
+        return fetched
@@ -0,0 +1,58 @@
+"""AsyncZiggoNextBox"""
+import asyncio
+from logging import Logger
+from .ziggonextbox import ZiggoNextBox
+from .mqttclient import AsyncZiggoNextMqttClient
+from .listings import AsyncZiggoNextListingCache
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+from .commands import AsyncZiggoNextCommandQueue
+
+
+class AsyncZiggoNextBox(ZiggoNextBox):
+    """Settop box handled on an asyncio event loop."""
+
+    def __init__(self, box_id:str, name:str, householdId:str, mqttClient:AsyncZiggoNextMqttClient, listings:AsyncZiggoNextListingCache, logger:Logger, loop:asyncio.AbstractEventLoop = None, metrics:ZiggoNextMetrics = NULL_METRICS):
+        super().__init__(box_id, name, householdId, mqttClient, listings, logger, metrics=metrics)
+        self._loop = loop or asyncio.get_event_loop()
+
+    @property
+    def commands(self) -> AsyncZiggoNextCommandQueue:
+        """Command queue of this box, started on first use"""
+        if self._commands is None:
+            self._commands = AsyncZiggoNextCommandQueue(self, self.logger, self._loop)
+        return self._commands
+
+    def _schedule_enrichment(self, statusPayload, listingId, version):
+        """Fetches listing metadata in a task on the event loop"""
+        self._loop.create_task(self._enrich_settop_box(statusPayload, listingId, version))
+
+    async def _enrich_settop_box(self, statusPayload, listingId, version):
+        """Fetches listing metadata for a status, unless a newer status arrived"""
+        if version != self._statusVersion:
+            return
+        listing = await self.listings.get(listingId)
+        self._apply_enrichment(statusPayload, listing, version)
+
+    def _schedule_artwork(self, image, version):
+        """Fetches an image into the artwork cache off the event loop"""
+        self._loop.create_task(self._fetch_artwork(image, version))
+
+    async def _fetch_artwork(self, image, version):
+        localImage = await self._loop.run_in_executor(None, self.artwork.path, image)
+        if localImage is not None:
+            self._apply_artwork(image, localImage, version)
+
+    async def send_key_to_box(self, key: str):
+        """Sends emulated (remote) key press to settopbox"""
+        super().send_key_to_box(key)
+
+    async def set_channel(self, serviceId):
+        """Tunes the settopbox to the given channel"""
+        super().set_channel(serviceId)
+
+    async def tune(self, channel, listing=None):
+        """Tunes directly to the channel and shows it in info right away, the box status confirms it later"""
+        super().tune(channel, listing)
+
+    async def turn_off(self):
+        super().turn_off()
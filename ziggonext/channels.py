@@ -0,0 +1,158 @@
+"""Channel lookup for Ziggo Next."""
+import bisect
+import difflib
+import json
+import os
+import tempfile
+import threading
+import unicodedata
+
+from .models import ZiggoChannel
+
+
+def _normalize_title(title: str) -> str:
+    """Case- and accent-insensitive form of a channel title"""
+    decomposed = unicodedata.normalize("NFKD", title)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+
+def _number_order(channel: ZiggoChannel):
+    """Sort key of a channel by numeric channel number"""
+    return int(channel.channelNumber), channel.serviceId
+
+
+class ZiggoChannelIndex:
+    """Lookup tables for a channel lineup by title, channel number and serviceId."""
+
+    def __init__(self, channels: dict = None):
+        self._byServiceId = {}
+        self._byTitle = {}
+        self._byNormalizedTitle = {}
+        self._byNumber = {}
+        self._normalizedTitles = []
+        self._ordered = []
+        self._positions = {}
+        if channels:
+            self.build(channels)
+
+    def build(self, channels: dict):
+        """Rebuilds the indexes for a serviceId to ZiggoChannel map"""
+        byServiceId = dict(channels)
+        byTitle = {}
+        byNormalizedTitle = {}
+        byNumber = {}
+        for channel in channels.values():
+            byTitle.setdefault(channel.title, channel)
+            byNormalizedTitle.setdefault(_normalize_title(channel.title), channel)
+            if channel.channelNumber is not None:
+                byNumber.setdefault(str(channel.channelNumber), channel)
+        self._byServiceId = byServiceId
+        self._byTitle = byTitle
+        self._byNormalizedTitle = byNormalizedTitle
+        self._byNumber = byNumber
+        self._normalizedTitles = sorted(byNormalizedTitle)
+        ordered = sorted(
+            (c for c in channels.values() if str(c.channelNumber).isdigit()), key=_number_order
+        )
+        self._ordered = ordered
+        self._positions = {c.serviceId: position for position, c in enumerate(ordered)}
+
+    def by_service_id(self, serviceId: str) -> ZiggoChannel:
+        """Channel with the given serviceId, or None"""
+        return self._byServiceId.get(serviceId)
+
+    def by_title(self, title: str) -> ZiggoChannel:
+        """Channel with the given title, compared exactly first and normalized second"""
+        channel = self._byTitle.get(title)
+        if channel is None:
+            channel = self._byNormalizedTitle.get(_normalize_title(title))
+        return channel
+
+    def by_number(self, channelNumber) -> ZiggoChannel:
+        """Channel with the given channel number, or None"""
+        return self._byNumber.get(str(channelNumber))
+
+    def neighbor(self, serviceId: str, offset: int = 1) -> ZiggoChannel:
+        """Channel offset places up (or down) from the given one in channel number order, wrapping around, or None"""
+        position = self._positions.get(serviceId)
+        if position is None:
+            return None
+        return self._ordered[(position + offset) % len(self._ordered)]
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """Channels whose title starts with the query, followed by close fuzzy matches"""
+        normalized = _normalize_title(query)
+        matches = []
+        position = bisect.bisect_left(self._normalizedTitles, normalized)
+        while (
+            position < len(self._normalizedTitles)
+            and len(matches) < limit
+            and self._normalizedTitles[position].startswith(normalized)
+        ):
+            matches.append(self._normalizedTitles[position])
+            position += 1
+        if len(matches) < limit:
+            for title in difflib.get_close_matches(
+                normalized, self._normalizedTitles, n=limit, cutoff=0.6
+            ):
+                if title not in matches:
+                    matches.append(title)
+        return [self._byNormalizedTitle[title] for title in matches[:limit]]
+
+
+class ZiggoChannelCache:
+    """On-disk cache of parsed channel lineups, one file per country code."""
+
+    FORMAT_VERSION = 2
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _path(self, country_code: str) -> str:
+        return os.path.join(self.directory, "channels-{country}.json".format(country=country_code))
+
+    def load(self, country_code: str):
+        """Returns the stored lineup with its ETag and Last-Modified, or None"""
+        try:
+            with open(self._path(country_code), encoding="utf-8") as fp:
+                content = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if content.get("version") != self.FORMAT_VERSION:
+            return None
+        channels = {}
+        for serviceId, title, streamImage, logoImage, channelNumber, stationId in content["channels"]:
+            channels[serviceId] = ZiggoChannel(serviceId, title, streamImage, logoImage, channelNumber, stationId)
+        return channels, content.get("etag"), content.get("lastModified")
+
+    def store(self, country_code: str, channels: dict, etag: str = None, lastModified: str = None):
+        """Writes the lineup and its validators, replacing the previous file atomically"""
+        content = {
+            "version": self.FORMAT_VERSION,
+            "etag": etag,
+            "lastModified": lastModified,
+            "channels": [
+                [c.serviceId, c.title, c.streamImage, c.logoImage, c.channelNumber, c.stationId]
+                for c in channels.values()
+            ],
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(country_code)
+        with self._lock:
+            fd, tmpPath = tempfile.mkstemp(dir=self.directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                    json.dump(content, fp, separators=(",", ":"))
+                os.replace(tmpPath, path)
+            except BaseException:
+                _unlink(tmpPath)
+                raise
+
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
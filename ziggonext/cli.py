@@ -0,0 +1,272 @@
+"""Command line interface for Ziggo Next."""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from .channels import ZiggoChannelCache, ZiggoChannelIndex, _number_order
+from .snapshot import ZiggoNextSnapshotStore
+from .const import ONLINE_STANDBY, UNKNOWN
+from .exceptions import ZiggoNextAuthenticationError, ZiggoNextConnectionError, ZiggoNextChannelNotFoundError
+
+DEFAULT_STATUS_TIMEOUT = 5.0
+DEFAULT_COMMAND_TIMEOUT = 10.0
+
+
+class _CliError(Exception):
+    pass
+
+
+def _default_cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "ziggonext")
+
+
+def _print_json(value):
+    sys.stdout.write(json.dumps(value, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def _channel_json(channel) -> dict:
+    return {
+        "serviceId": channel.serviceId,
+        "channelNumber": channel.channelNumber,
+        "title": channel.title,
+        "logoImage": channel.logoImage,
+        "streamImage": channel.streamImage,
+    }
+
+
+def _box_json(box_id, name, state, info, stale) -> dict:
+    return {
+        "boxId": box_id,
+        "name": name,
+        "state": state,
+        "stale": stale,
+        "info": {field: getattr(info, field) for field in info.__slots__},
+    }
+
+
+def _change_json(change) -> dict:
+    values = {field: getattr(change, field) for field in change.__slots__}
+    values["time"] = round(time.time(), 3)
+    return values
+
+
+def _lineup_order(channels: dict) -> list:
+    """Channels by channel number, the ones without a number last"""
+    numbered = [c for c in channels.values() if str(c.channelNumber).isdigit()]
+    others = [c for c in channels.values() if not str(c.channelNumber).isdigit()]
+    return sorted(numbered, key=_number_order) + others
+
+
+def _settled(box) -> bool:
+    """Whether the box reported its live state, and its playing info with listing when it is running"""
+    if box.stale or box.state == UNKNOWN:
+        return False
+    return box.state == ONLINE_STANDBY or box.info.title is not None
+
+
+class _Cli:
+    """Runs one command, loading only what that command needs."""
+
+    def __init__(self, args, logger: logging.Logger):
+        self.args = args
+        self.logger = logger
+        self.client = None
+
+    def _key(self) -> str:
+        return self.args.country + ":" + self._username()
+
+    def _username(self) -> str:
+        if not self.args.username:
+            raise _CliError("No username, pass --username or set ZIGGONEXT_USERNAME")
+        return self.args.username
+
+    def _snapshot_store(self) -> ZiggoNextSnapshotStore:
+        return ZiggoNextSnapshotStore(self.args.cache_dir)
+
+    def _client(self):
+        """ZiggoNext with the session store, channel cache and snapshot store of the cache directory"""
+        from .ziggonext import ZiggoNext
+        from .sessionstore import ZiggoNextFileSessionStore
+
+        username = self._username()
+        if not self.args.password:
+            raise _CliError("No password, pass --password or set ZIGGONEXT_PASSWORD")
+        self.client = ZiggoNext(
+            username, self.args.password, self.args.country,
+            channelCache=ZiggoChannelCache(self.args.cache_dir),
+            sessionStore=ZiggoNextFileSessionStore(os.path.join(self.args.cache_dir, "sessions.json")),
+            snapshotStore=self._snapshot_store(),
+        )
+        return self.client
+
+    def _initialize(self, lazyMqtt: bool):
+        client = self._client()
+        client.initialize(self.logger, lazyMqtt=lazyMqtt)
+        return client
+
+    def _boxes(self, client, boxRef: str = None, single: bool = False) -> list:
+        """Boxes matching an id or name, all of them without one"""
+        boxes = sorted(client.settop_boxes.values(), key=lambda box: box.box_id)
+        if boxRef is not None:
+            boxes = [box for box in boxes if boxRef in (box.box_id, box.name)]
+            if not boxes:
+                raise _CliError("No box {box}".format(box=boxRef))
+        if single and len(boxes) > 1:
+            raise _CliError("Several boxes, pass one of: " + ", ".join(box.box_id for box in boxes))
+        if not boxes:
+            raise _CliError("No settop boxes")
+        return boxes
+
+    def channels(self):
+        channels = None
+        if not self.args.refresh:
+            cached = ZiggoChannelCache(self.args.cache_dir).load(self.args.country)
+            if cached is not None:
+                channels = cached[0]
+        if channels is None:
+            from .ziggonext import ZiggoNext
+
+            self.client = ZiggoNext(None, None, self.args.country, channelCache=ZiggoChannelCache(self.args.cache_dir))
+            self.client.load_lineup(self.logger, refresh=self.args.refresh)
+            channels = self.client.channels
+        if not channels:
+            raise _CliError("Could not load channels")
+        if self.args.search:
+            matches = ZiggoChannelIndex(channels).search(self.args.search, self.args.limit)
+        else:
+            matches = _lineup_order(channels)
+        _print_json([_channel_json(channel) for channel in matches])
+
+    def status(self):
+        if self.args.cached:
+            snapshot = self._snapshot_store().load(self._key())
+            if not snapshot:
+                raise _CliError("No snapshot, run status without --cached first")
+            boxes = [
+                _box_json(box_id, name, state, info, True)
+                for box_id, (name, state, info) in sorted(snapshot.items())
+                if self.args.box in (None, box_id, name)
+            ]
+            _print_json(boxes)
+            return
+        client = self._initialize(lazyMqtt=False)
+        boxes = self._boxes(client, self.args.box)
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline and not all(_settled(box) for box in boxes):
+            time.sleep(0.05)
+        _print_json([_box_json(box.box_id, box.name, box.state, box.info, not _settled(box)) for box in boxes])
+
+    def watch(self):
+        client = self._initialize(lazyMqtt=False)
+        boxIds = {box.box_id for box in self._boxes(client, self.args.box)}
+        finished = threading.Event()
+        lock = threading.Lock()
+        seen = [0]
+
+        def on_change(change):
+            if change.boxId not in boxIds:
+                return
+            with lock:
+                if finished.is_set():
+                    return
+                _print_json(_change_json(change))
+                seen[0] += 1
+                if self.args.count and seen[0] >= self.args.count:
+                    finished.set()
+
+        client.add_listener(on_change)
+        try:
+            finished.wait(self.args.timeout)
+        except KeyboardInterrupt:
+            pass
+
+    def tune(self):
+        from .commands import TuneCommand
+
+        client = self._initialize(lazyMqtt=True)
+        box = self._boxes(client, self.args.box, single=True)[0]
+        ref = self.args.channel
+        channel = client.channelIndex.by_service_id(ref)
+        if channel is None and ref.isdigit():
+            channel = client.channelIndex.by_number(ref)
+        if channel is None:
+            channel = client.channelIndex.by_title(ref)
+        if channel is None:
+            raise ZiggoNextChannelNotFoundError("Channel not found: " + ref)
+        client.run_commands(box.box_id, TuneCommand(channel.serviceId, timeout=self.args.timeout)).result()
+        _print_json({"boxId": box.box_id, "channel": _channel_json(channel), "info": _box_json(box.box_id, box.name, box.state, box.info, box.stale)["info"]})
+
+    def key(self):
+        from .commands import KeyCommand
+
+        client = self._initialize(lazyMqtt=True)
+        box = self._boxes(client, self.args.box, single=True)[0]
+        client.run_commands(box.box_id, KeyCommand(self.args.key, timeout=self.args.timeout)).result()
+        _print_json({"boxId": box.box_id, "key": self.args.key, "state": box.state})
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="ziggonext", description="Control Ziggo Next settop boxes, printing json.")
+    parser.add_argument("--username", default=os.environ.get("ZIGGONEXT_USERNAME"), help="account, default $ZIGGONEXT_USERNAME")
+    parser.add_argument("--password", default=os.environ.get("ZIGGONEXT_PASSWORD"), help="password, default $ZIGGONEXT_PASSWORD")
+    parser.add_argument("--country", default=os.environ.get("ZIGGONEXT_COUNTRY", "nl"), help="country code, default nl")
+    parser.add_argument("--cache-dir", default=_default_cache_dir(), help="session, lineup and snapshot cache")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log to stderr")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    status = commands.add_parser("status", help="state and playing info of the boxes")
+    status.add_argument("box", nargs="?", help="box id or name, default all")
+    status.add_argument("--cached", action="store_true", help="last snapshot, without network access")
+    status.add_argument("--timeout", type=float, default=DEFAULT_STATUS_TIMEOUT, help="seconds to wait for the boxes")
+
+    watch = commands.add_parser("watch", help="changes of the boxes as json lines")
+    watch.add_argument("box", nargs="?", help="box id or name, default all")
+    watch.add_argument("--count", type=int, help="stop after this many changes")
+    watch.add_argument("--timeout", type=float, help="stop after this many seconds")
+
+    tune = commands.add_parser("tune", help="tune a box to a channel")
+    tune.add_argument("channel", help="channel number, title or serviceId")
+    tune.add_argument("box", nargs="?", help="box id or name, required with several boxes")
+    tune.add_argument("--timeout", type=float, default=DEFAULT_COMMAND_TIMEOUT, help="seconds to wait for the box")
+
+    key = commands.add_parser("key", help="press a remote control key, e.g. MediaPlayPause or Power")
+    key.add_argument("key", help="w3c key name")
+    key.add_argument("box", nargs="?", help="box id or name, required with several boxes")
+    key.add_argument("--timeout", type=float, default=DEFAULT_COMMAND_TIMEOUT, help="seconds to wait for the box")
+
+    channels = commands.add_parser("channels", help="channel lineup, from the cache when possible")
+    channels.add_argument("search", nargs="?", help="title to search for")
+    channels.add_argument("--limit", type=int, default=10, help="maximum number of search results")
+    channels.add_argument("--refresh", action="store_true", help="check the api for a newer lineup")
+    return parser
+
+
+def main(argv=None) -> int:
+    """Entry point of the ziggonext command"""
+    args = _parser().parse_args(argv)
+    logger = logging.getLogger("ziggonext")
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
+    else:
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+    cli = _Cli(args, logger)
+    try:
+        getattr(cli, args.command)()
+    except (_CliError, ZiggoNextAuthenticationError, ZiggoNextConnectionError, ZiggoNextChannelNotFoundError, TimeoutError) as ex:
+        sys.stderr.write(json.dumps({"error": str(ex) or type(ex).__name__}) + "\n")
+        return 1
+    finally:
+        cli.close()
+    return 0
@@ -0,0 +1,97 @@
+"""Status request coalescing for Ziggo Next settop boxes."""
+import threading
+import time
+
+DEFAULT_DEBOUNCE = 0.3
+DEFAULT_FRESHNESS = 1.0
+DEFAULT_REPLY_TIMEOUT = 3.0
+
+
+def _start_timer(delay: float, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+class ZiggoNextStatusCoalescer:
+    """Keeps at most one CPE.getUiStatus in flight per box and folds bursts into one trailing request."""
+
+    def __init__(self, send, debounce: float = DEFAULT_DEBOUNCE, freshness: float = DEFAULT_FRESHNESS, replyTimeout: float = DEFAULT_REPLY_TIMEOUT, timer=None):
+        self._send = send
+        self._timer = timer or _start_timer
+        self.debounce = debounce
+        self.freshness = freshness
+        self.replyTimeout = replyTimeout
+        self._lock = threading.Lock()
+        self._inFlight = False
+        self._pending = False
+        self._lastStatus = None
+        self._replyTimer = None
+        self._debounceTimer = None
+
+    def request(self, force: bool = False):
+        """Asks for a status, unless one is on its way or, without force, one arrived just now
+
+        A forced request while one is on its way, e.g. after a key press, is
+        followed up by a trailing request once the reply arrives.
+        """
+        with self._lock:
+            if not force and self._lastStatus is not None and time.monotonic() - self._lastStatus < self.freshness:
+                return
+            if self._inFlight:
+                self._pending = self._pending or force
+                return
+            if self._debounceTimer is not None:
+                self._start_debounce()
+                return
+            self._send_locked()
+
+    def status_received(self):
+        """Marks the outstanding request as answered and sends the trailing request, if any"""
+        with self._lock:
+            self._lastStatus = time.monotonic()
+            self._finish_locked()
+
+    def cancel(self):
+        """Stops pending timers"""
+        with self._lock:
+            self._pending = False
+            for timer in (self._replyTimer, self._debounceTimer):
+                if timer is not None:
+                    timer.cancel()
+            self._replyTimer = None
+            self._debounceTimer = None
+            self._inFlight = False
+
+    def _send_locked(self):
+        self._inFlight = True
+        self._replyTimer = self._timer(self.replyTimeout, self._on_reply_timeout)
+        self._send()
+
+    def _finish_locked(self):
+        if self._replyTimer is not None:
+            self._replyTimer.cancel()
+            self._replyTimer = None
+        self._inFlight = False
+        if self._pending:
+            self._pending = False
+            self._start_debounce()
+
+    def _start_debounce(self):
+        if self._debounceTimer is not None:
+            self._debounceTimer.cancel()
+        self._debounceTimer = self._timer(self.debounce, self._on_debounce)
+
+    def _on_reply_timeout(self):
+        with self._lock:
+            self._replyTimer = None
+            self._finish_locked()
+
+    def _on_debounce(self):
+        with self._lock:
+            self._debounceTimer = None
+            if self._inFlight:
+                self._pending = True
+                return
+            self._send_locked()
@@ -0,0 +1,260 @@
+"""Command pipeline for Ziggo Next settop boxes."""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Executor, Future
+from logging import Logger
+
+from .const import ONLINE_RUNNING, ONLINE_STANDBY
+
+DEFAULT_COMMAND_INTERVAL = 0.25
+DEFAULT_COMMAND_TIMEOUT = 10
+DEFAULT_COMMAND_WORKERS = 4
+
+
+class ZiggoNextCommand:
+    """A step of a command batch, done once its predicate holds for the box."""
+
+    def __init__(self, timeout: float = DEFAULT_COMMAND_TIMEOUT):
+        self.timeout = timeout
+
+    def publish(self, box) -> bool:
+        """Sends the command to the box, returns whether anything was published"""
+        return False
+
+    def done(self, box, statusCount: int) -> bool:
+        """Whether the box reached the state this command waits for, statusCount is box.statusCount at publish"""
+        return True
+
+
+class KeyCommand(ZiggoNextCommand):
+    """Presses a key and waits for the next status, or until the predicate holds."""
+
+    def __init__(self, key: str, until=None, timeout: float = DEFAULT_COMMAND_TIMEOUT):
+        super().__init__(timeout)
+        self.key = key
+        self.until = until
+
+    def publish(self, box) -> bool:
+        box._press_key(self.key)
+        return True
+
+    def done(self, box, statusCount: int) -> bool:
+        if self.until is not None:
+            return self.until(box)
+        return box.statusCount > statusCount
+
+
+class TuneCommand(ZiggoNextCommand):
+    """Tunes to a channel with CPE.pushToTV and waits until the box plays it."""
+
+    def __init__(self, serviceId: str, timeout: float = DEFAULT_COMMAND_TIMEOUT):
+        super().__init__(timeout)
+        self.serviceId = serviceId
+
+    def publish(self, box) -> bool:
+        box._push_channel(self.serviceId)
+        return True
+
+    def done(self, box, statusCount: int) -> bool:
+        return box.info.channelId == self.serviceId
+
+
+class WaitCommand(ZiggoNextCommand):
+    """Waits until the predicate holds for the box."""
+
+    def __init__(self, predicate, timeout: float = DEFAULT_COMMAND_TIMEOUT):
+        super().__init__(timeout)
+        self.predicate = predicate
+
+    def done(self, box, statusCount: int) -> bool:
+        return self.predicate(box)
+
+
+def is_running(box) -> bool:
+    return box.state == ONLINE_RUNNING
+
+
+def is_standby(box) -> bool:
+    return box.state == ONLINE_STANDBY
+
+
+def keys(*keys) -> list:
+    """Macro pressing the keys in order, each after the previous one was acknowledged"""
+    return [KeyCommand(key) for key in keys]
+
+
+class ZiggoNextCommandQueue:
+    """Runs command batches for one box in order, paced and acknowledged by status updates.
+
+    Batches run on the given executor, one at a time, so boxes don't need a
+    thread of their own while idle. A batch holds its worker while it waits
+    for acknowledgements, so the executor should be dedicated to commands.
+    Without an executor a thread runs until the queue is empty.
+    """
+
+    def __init__(self, box, logger: Logger, executor: Executor = None, interval: float = DEFAULT_COMMAND_INTERVAL):
+        self._box = box
+        self.logger = logger
+        self.interval = interval
+        self._executor = executor
+        self._batches = deque()
+        self._condition = threading.Condition()
+        self._running = False
+        self._stopped = False
+        self._lastPublish = 0
+
+    def submit(self, commands) -> Future:
+        """Queues a command or a list of commands, the future resolves when the last one is done"""
+        if isinstance(commands, ZiggoNextCommand):
+            commands = [commands]
+        future = Future()
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Command queue of box {box} is stopped".format(box=self._box.name))
+            self._batches.append((list(commands), future))
+            if self._running:
+                return future
+            self._running = True
+        if self._executor is not None:
+            self._executor.submit(self._run)
+        else:
+            threading.Thread(target=self._run, name="ziggonext-commands-" + self._box.box_id, daemon=True).start()
+        return future
+
+    def notify(self):
+        """Wakes up the command waiting for a box state"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def stop(self):
+        """Cancels the queued batches and interrupts the running one"""
+        with self._condition:
+            self._stopped = True
+            batches, self._batches = self._batches, deque()
+            self._condition.notify_all()
+        for commands, future in batches:
+            future.cancel()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._batches:
+                    self._running = False
+                    return
+                commands, future = self._batches.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                for command in commands:
+                    self._execute(command)
+            except Exception as ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(True)
+
+    def _execute(self, command: ZiggoNextCommand):
+        wait = self._lastPublish + self.interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._check_stopped()
+        with self._condition:
+            statusCount = self._box.statusCount
+        if command.publish(self._box):
+            self._lastPublish = time.monotonic()
+        deadline = time.monotonic() + command.timeout
+        with self._condition:
+            while not command.done(self._box, statusCount):
+                self._check_stopped()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Box {box} did not acknowledge {command}".format(
+                        box=self._box.name, command=type(command).__name__
+                    ))
+                self._condition.wait(remaining)
+
+    def _check_stopped(self):
+        if self._stopped:
+            raise CancelledError()
+
+
+class AsyncZiggoNextCommandQueue:
+    """Runs command batches for one box in order in a task on the event loop, paced and acknowledged by status updates."""
+
+    def __init__(self, box, logger: Logger, loop: asyncio.AbstractEventLoop, interval: float = DEFAULT_COMMAND_INTERVAL):
+        self._box = box
+        self.logger = logger
+        self.interval = interval
+        self._loop = loop
+        self._batches = deque()
+        self._changed = asyncio.Event()
+        self._task = None
+        self._stopped = False
+        self._lastPublish = 0
+
+    def submit(self, commands) -> asyncio.Future:
+        """Queues a command or a list of commands, the future resolves when the last one is done"""
+        if isinstance(commands, ZiggoNextCommand):
+            commands = [commands]
+        if self._stopped:
+            raise RuntimeError("Command queue of box {box} is stopped".format(box=self._box.name))
+        future = self._loop.create_future()
+        self._batches.append((list(commands), future))
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+        return future
+
+    def notify(self):
+        """Wakes up the command waiting for a box state"""
+        self._changed.set()
+
+    def stop(self):
+        """Cancels the queued batches and the running one"""
+        self._stopped = True
+        batches, self._batches = self._batches, deque()
+        for commands, future in batches:
+            future.cancel()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        try:
+            while self._batches:
+                commands, future = self._batches.popleft()
+                if future.cancelled():
+                    continue
+                try:
+                    for command in commands:
+                        await self._execute(command)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as ex:
+                    if not future.cancelled():
+                        future.set_exception(ex)
+                else:
+                    if not future.cancelled():
+                        future.set_result(True)
+        finally:
+            self._task = None
+
+    async def _execute(self, command: ZiggoNextCommand):
+        wait = self._lastPublish + self.interval - self._loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        statusCount = self._box.statusCount
+        if command.publish(self._box):
+            self._lastPublish = self._loop.time()
+        deadline = self._loop.time() + command.timeout
+        while not command.done(self._box, statusCount):
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                raise TimeoutError("Box {box} did not acknowledge {command}".format(
+                    box=self._box.name, command=type(command).__name__
+                ))
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
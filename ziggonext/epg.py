@@ -0,0 +1,150 @@
+"""Electronic program guide for Ziggo Next."""
+import bisect
+import threading
+import time
+from logging import Logger
+
+from .models import ZiggoListing
+from .listings import _parse_listing
+from .transport import ZiggoNextTransport
+from .exceptions import ZiggoNextConnectionError
+
+DEFAULT_EPG_WINDOW = 4 * 3600
+DEFAULT_EPG_REFRESH_INTERVAL = 15 * 60
+EPG_STATIONS_PER_REQUEST = 20
+EPG_PAGE_SIZE = 250
+
+
+class ZiggoNextEpg:
+    """Prefetched listings per channel, indexed by start time for local now/next lookups."""
+
+    def __init__(self, url: str, transport: ZiggoNextTransport, logger: Logger, window: float = DEFAULT_EPG_WINDOW, refreshInterval: float = DEFAULT_EPG_REFRESH_INTERVAL):
+        self._url = url
+        self._transport = transport
+        self.logger = logger
+        self.window = window
+        self.refreshInterval = refreshInterval
+        self._byChannel = {}
+        self._byEventId = {}
+        self._timer = None
+        self._channelsProvider = None
+
+    def prefetch(self, channels: dict, timestamp: float = None):
+        """Fetches the listings airing between now and the end of the window for all channels"""
+        start = timestamp if timestamp is not None else time.time()
+        end = start + self.window
+        stations = {c.stationId: c.serviceId for c in channels.values() if c.stationId}
+        stationIds = list(stations)
+        entries = []
+        for offset in range(0, len(stationIds), EPG_STATIONS_PER_REQUEST):
+            batch = stationIds[offset:offset + EPG_STATIONS_PER_REQUEST]
+            entries.extend(self._fetch(batch, stations, start, end))
+        self._index(entries)
+        self.logger.debug("Prefetched %s listings for %s channels", len(entries), len(stationIds))
+
+    def _fetch(self, stationIds, stations, start, end):
+        """Fetches all pages of listings for a batch of stations"""
+        return _fetch_listings(self._transport, self._url, self.logger, stationIds, stations, start, end)
+
+    def _index(self, entries):
+        """Replaces the index with the given listings"""
+        byChannel = {}
+        byEventId = {}
+        for entry in entries:
+            if entry.startTime is None or entry.endTime is None:
+                continue
+            byChannel.setdefault(entry.channelId, []).append(entry)
+            byEventId[entry.listingId] = entry
+        index = {}
+        for channelId, channelEntries in byChannel.items():
+            channelEntries.sort(key=lambda entry: entry.startTime)
+            index[channelId] = ([entry.startTime for entry in channelEntries], channelEntries)
+        self._byChannel = index
+        self._byEventId = byEventId
+
+    def now(self, channelId: str, timestamp: float = None) -> ZiggoListing:
+        """Listing airing on the channel at the timestamp (default now), or None"""
+        timestamp = timestamp if timestamp is not None else time.time()
+        startTimes, entries = self._byChannel.get(channelId, ((), ()))
+        position = bisect.bisect_right(startTimes, timestamp) - 1
+        if position >= 0 and entries[position].endTime > timestamp:
+            return entries[position]
+        return None
+
+    def next(self, channelId: str, timestamp: float = None) -> ZiggoListing:
+        """First listing starting on the channel after the timestamp (default now), or None"""
+        timestamp = timestamp if timestamp is not None else time.time()
+        startTimes, entries = self._byChannel.get(channelId, ((), ()))
+        position = bisect.bisect_right(startTimes, timestamp)
+        if position < len(entries):
+            return entries[position]
+        return None
+
+    def by_event_id(self, eventId: str) -> ZiggoListing:
+        """Prefetched listing with the given eventId, or None"""
+        return self._byEventId.get(eventId)
+
+    def start(self, channelsProvider):
+        """Prefetches in the background and keeps the window rolling"""
+        self._channelsProvider = channelsProvider
+        self._schedule(0)
+
+    def stop(self):
+        """Stops the background refresh"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _schedule(self, delay):
+        self._timer = threading.Timer(delay, self._refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh(self):
+        try:
+            self.prefetch(self._channelsProvider())
+        finally:
+            if self._timer is not None:
+                self._schedule(self.refreshInterval)
+
+
+def _fetch_listings(transport: ZiggoNextTransport, url: str, logger: Logger, stationIds, stations, start, end) -> list:
+    """Fetches all pages of listings airing between start and end for stations, a stationId to serviceId map"""
+    entries = []
+    first = 1
+    while True:
+        try:
+            response = transport.get(url, params=_listings_params(stationIds, start, end, first))
+        except ZiggoNextConnectionError as ex:
+            logger.warning("Can't retrieve epg: %s", ex)
+            break
+        if response.status_code != 200:
+            logger.warning("Can't retrieve epg: %s", response.status_code)
+            break
+        content = response.json()
+        entries.extend(_parse_listings_page(content, stations))
+        first += EPG_PAGE_SIZE
+        if len(content.get("listings", [])) < EPG_PAGE_SIZE or first > content.get("totalResults", 0):
+            break
+    return entries
+
+
+def _listings_params(stationIds, start, end, first=1) -> dict:
+    """Query of a /listings page for the stations between start and end"""
+    return {
+        "byStationId": ",".join(stationIds),
+        "byEndTime": "{start}~".format(start=int(start * 1000)),
+        "byStartTime": "~{end}".format(end=int(end * 1000)),
+        "sort": "startTime",
+        "range": "{first}-{last}".format(first=first, last=first + EPG_PAGE_SIZE - 1),
+    }
+
+
+def _parse_listings_page(content, stations) -> list:
+    """Listings of a /listings page on known stations, tagged with their serviceId"""
+    entries = []
+    for listing in content.get("listings", []):
+        channelId = stations.get(listing.get("stationId"))
+        if channelId is not None:
+            entries.append(_parse_listing(listing["id"], listing, channelId))
+    return entries
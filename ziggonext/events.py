@@ -0,0 +1,63 @@
+"""State change notifications for Ziggo Next settop boxes."""
+import asyncio
+import threading
+from logging import Logger
+
+from .models import ZiggoNextBoxChange, ZiggoNextBoxPlayingInfo
+
+CHANGE_STATE = "state"
+CHANGE_SOURCE_TYPE = "sourceType"
+CHANGE_CHANNEL = "channelId"
+CHANGE_TITLE = "title"
+CHANGE_PAUSED = "paused"
+
+INFO_CHANGE_FIELDS = (CHANGE_SOURCE_TYPE, CHANGE_CHANNEL, CHANGE_TITLE, CHANGE_PAUSED)
+
+
+def _info_changes(boxId: str, old: ZiggoNextBoxPlayingInfo, new: ZiggoNextBoxPlayingInfo) -> list:
+    """Change events for the watched fields that differ between two snapshots"""
+    changes = []
+    for field in INFO_CHANGE_FIELDS:
+        oldValue = getattr(old, field)
+        newValue = getattr(new, field)
+        if oldValue != newValue:
+            changes.append(ZiggoNextBoxChange(boxId, field, oldValue, newValue, new.version))
+    return changes
+
+
+class ZiggoNextListeners:
+    """Callbacks interested in box changes, with an async iterator on top."""
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add(self, callback):
+        """Calls callback(change) for every change, returns a function that removes it again"""
+        with self._lock:
+            self._callbacks = self._callbacks + [callback]
+
+        def remove():
+            with self._lock:
+                self._callbacks = [c for c in self._callbacks if c is not callback]
+        return remove
+
+    def notify(self, change: ZiggoNextBoxChange):
+        """Hands the change to every callback, logging callbacks that fail"""
+        for callback in self._callbacks:
+            try:
+                callback(change)
+            except Exception:
+                self.logger.exception("Change listener failed")
+
+    async def changes(self):
+        """Async iterator of changes, delivered on the event loop of the caller"""
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        remove = self.add(lambda change: loop.call_soon_threadsafe(queue.put_nowait, change))
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            remove()
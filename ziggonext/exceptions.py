@@ -3,4 +3,7 @@ class ZiggoNextConnectionError(Exception):
     pass
 
 class ZiggoNextAuthenticationError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class ZiggoNextChannelNotFoundError(Exception):
+    pass
@@ -0,0 +1,135 @@
+"""Listing metadata cache for Ziggo Next."""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from logging import Logger
+
+from .models import ZiggoListing
+from .transport import ZiggoNextTransport, _async_get
+from .exceptions import ZiggoNextConnectionError
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+
+DEFAULT_LISTING_TTL = 3600
+DEFAULT_LISTING_CACHE_SIZE = 512
+
+
+class ZiggoNextListingCache:
+    """Shared TTL/LRU cache of listing metadata, keyed by eventId or recordingId."""
+
+    def __init__(self, url_format: str, logger: Logger, transport: ZiggoNextTransport, ttl: float = DEFAULT_LISTING_TTL, maxsize: int = DEFAULT_LISTING_CACHE_SIZE, metrics: ZiggoNextMetrics = NULL_METRICS):
+        self._url_format = url_format
+        self._transport = transport
+        self.metrics = metrics
+        self.logger = logger
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, listingId: str) -> ZiggoListing:
+        """Returns the listing from cache or fetches it once from the api"""
+        listing = self.peek(listingId)
+        if listing is None:
+            listing = self._fetch(listingId)
+            if listing is not None:
+                self.put(listing)
+        return listing
+
+    def peek(self, listingId: str) -> ZiggoListing:
+        """Returns the listing if it is cached and not expired"""
+        with self._lock:
+            entry = self._entries.get(listingId)
+            if entry is None:
+                self.metrics.increment("ziggonext_listing_cache_total", result="miss")
+                return None
+            expires, listing = entry
+            if expires <= time.monotonic():
+                del self._entries[listingId]
+                self.metrics.increment("ziggonext_listing_cache_total", result="expired")
+                return None
+            self._entries.move_to_end(listingId)
+        self.metrics.increment("ziggonext_listing_cache_total", result="hit")
+        return listing
+
+    def put(self, listing: ZiggoListing):
+        """Stores a listing, evicting the least recently used entries"""
+        with self._lock:
+            self._entries[listing.listingId] = (time.monotonic() + self.ttl, listing)
+            self._entries.move_to_end(listing.listingId)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all cached listings"""
+        with self._lock:
+            self._entries.clear()
+
+    def _fetch(self, listingId: str) -> ZiggoListing:
+        """Get listing from the api"""
+        self.logger.debug("retrieving listing %s", listingId)
+        try:
+            response = self._transport.get(self._url_format.format(id=listingId))
+        except ZiggoNextConnectionError as ex:
+            self.logger.warning("Can't retrieve listing %s: %s", listingId, ex)
+            return None
+        if response.status_code != 200:
+            return None
+        return _parse_listing(listingId, response.json())
+
+
+class AsyncZiggoNextListingCache(ZiggoNextListingCache):
+    """Listing cache fetching through an aiohttp client session."""
+
+    def __init__(self, url_format: str, logger: Logger, httpSession, ttl: float = DEFAULT_LISTING_TTL, maxsize: int = DEFAULT_LISTING_CACHE_SIZE, metrics: ZiggoNextMetrics = NULL_METRICS):
+        super().__init__(url_format, logger, None, ttl, maxsize, metrics)
+        self._httpSession = httpSession
+        self._inFlight = {}
+
+    async def get(self, listingId: str) -> ZiggoListing:
+        """Returns the listing from cache or fetches it once from the api, sharing the fetch with concurrent callers"""
+        listing = self.peek(listingId)
+        if listing is not None:
+            return listing
+        task = self._inFlight.get(listingId)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(listingId))
+            self._inFlight[listingId] = task
+            task.add_done_callback(lambda _: self._inFlight.pop(listingId, None))
+        listing = await asyncio.shield(task)
+        if listing is not None:
+            self.put(listing)
+        return listing
+
+    async def _fetch(self, listingId: str) -> ZiggoListing:
+        """Get listing from the api"""
+        self.logger.debug("retrieving listing %s", listingId)
+        with self.metrics.span("ziggonext_http_request", method="GET", endpoint="listings"):
+            try:
+                response, content = await _async_get(self._httpSession, self._url_format.format(id=listingId))
+            except ZiggoNextConnectionError as ex:
+                self.logger.warning("Can't retrieve listing %s: %s", listingId, ex)
+                return None
+        if response.status != 200:
+            return None
+        return _parse_listing(listingId, content)
+
+
+def _parse_listing(listingId, content, channelId=None) -> ZiggoListing:
+    """Creates a listing model from a /listings response"""
+    startTime = _epoch_seconds(content.get("startTime"))
+    endTime = _epoch_seconds(content.get("endTime"))
+    if "program" not in content:
+        return ZiggoListing(listingId, None, None, startTime, endTime, channelId)
+    program = content["program"]
+    image = None
+    if program.get("images"):
+        image = program["images"][0]["url"]
+    return ZiggoListing(listingId, program.get("title"), image, startTime, endTime, channelId)
+
+
+def _epoch_seconds(milliseconds) -> float:
+    """Converts an api timestamp in milliseconds to epoch seconds"""
+    if milliseconds is None:
+        return None
+    return milliseconds / 1000
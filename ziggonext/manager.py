@@ -0,0 +1,154 @@
+"""Many Ziggo Next accounts in one process."""
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import Logger
+
+from .ziggonext import ZiggoNext
+from .transport import ZiggoNextTransport
+from .listings import ZiggoNextListingCache
+from .channels import ZiggoChannelCache
+from .events import ZiggoNextListeners
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+from .mqttloop import ZiggoNextMqttLoop
+from .sessionstore import ZiggoNextSessionStore
+from .snapshot import ZiggoNextSnapshotStore
+from .artwork import ZiggoNextArtworkCache
+from .commands import DEFAULT_COMMAND_WORKERS
+from .const import COUNTRY_URLS_HTTP
+
+DEFAULT_MANAGER_WORKERS = 8
+
+
+class ZiggoNextManager:
+    """Hosts many ZiggoNext accounts on one http pool, one mqtt thread and a bounded worker pool.
+
+    Accounts in the same country share the channel lineup and listing cache.
+    An account that fails to authenticate is recorded in failures and does
+    not affect the others.
+    """
+
+    def __init__(self, logger: Logger, transport: ZiggoNextTransport = None, workers: int = DEFAULT_MANAGER_WORKERS, channelCache: ZiggoChannelCache = None, sessionStore: ZiggoNextSessionStore = None, metrics: ZiggoNextMetrics = None, mqttOptions: dict = None, snapshotStore: ZiggoNextSnapshotStore = None, artworkCache: ZiggoNextArtworkCache = None):
+        self.logger = logger
+        self.metrics = metrics or NULL_METRICS
+        self.transport = transport or ZiggoNextTransport(pool_size=workers, metrics=self.metrics)
+        self.channelCache = channelCache
+        self.sessionStore = sessionStore
+        self.snapshotStore = snapshotStore
+        self.artworkCache = artworkCache
+        self.mqttOptions = mqttOptions or {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ziggonext-worker")
+        self.commandExecutor = ThreadPoolExecutor(max_workers=DEFAULT_COMMAND_WORKERS, thread_name_prefix="ziggonext-commands")
+        self.mqttLoop = ZiggoNextMqttLoop(logger, self.executor)
+        self.accounts = {}
+        self.failures = {}
+        self._lineups = {}
+        self._listings = {}
+        self._lock = threading.Lock()
+        self._listeners = ZiggoNextListeners(logger)
+
+    def add_account(self, username: str, password: str, country_code: str = "nl") -> Future:
+        """Initializes an account on the worker pool, the future resolves to its ZiggoNext"""
+        key = _account_key(username, country_code)
+        client = ZiggoNext(
+            username, password, country_code,
+            transport=self.transport,
+            channelCache=self.channelCache,
+            sessionStore=self.sessionStore,
+            snapshotStore=self.snapshotStore,
+            artworkCache=self.artworkCache,
+            metrics=self.metrics,
+            mqttOptions=self.mqttOptions,
+            executor=self.executor,
+            mqttLoop=self.mqttLoop,
+            commandExecutor=self.commandExecutor,
+        )
+        with self._lock:
+            if key in self.accounts:
+                raise ValueError("Account {key} is already managed".format(key=key))
+            self.accounts[key] = client
+            self.failures.pop(key, None)
+        return self.executor.submit(self._initialize, key, client)
+
+    def _initialize(self, key: str, client: ZiggoNext) -> ZiggoNext:
+        country_code = client._country_code
+        client.listings = self._listing_cache(country_code)
+        lineup = self._lineups.get(country_code)
+        if lineup is not None:
+            client.use_lineup(*lineup)
+        else:
+            client._lineupListener = functools.partial(self._share_lineup, client)
+        try:
+            client.initialize(self.logger)
+        except Exception as ex:
+            # Whatever failed, the account is dropped and its mqtt client stops retrying
+            self.logger.error("Account %s failed to initialize: %s", key, ex)
+            with self._lock:
+                if self.accounts.get(key) is client:
+                    del self.accounts[key]
+                self.failures[key] = ex
+            client.close()
+            raise
+        client.add_listener(self._listeners.notify)
+        return client
+
+    def _share_lineup(self, source: ZiggoNext, channels: dict, channelIndex):
+        """Hands a lineup loaded or refreshed by one account to the other accounts in its country"""
+        country_code = source._country_code
+        with self._lock:
+            self._lineups[country_code] = (channels, channelIndex)
+            clients = [
+                client for client in self.accounts.values()
+                if client is not source and client._country_code == country_code
+            ]
+        for client in clients:
+            # Runs inside the source's channel refresh, one failing account must not stop it or the others
+            try:
+                client.use_lineup(channels, channelIndex)
+            except Exception as ex:
+                self.logger.error("Could not share the lineup with account %s: %s", _account_key(client.username, country_code), ex)
+
+    def _listing_cache(self, country_code: str) -> ZiggoNextListingCache:
+        with self._lock:
+            listings = self._listings.get(country_code)
+            if listings is None:
+                listings = ZiggoNextListingCache(
+                    COUNTRY_URLS_HTTP[country_code] + "/listings/{id}", self.logger, self.transport, metrics=self.metrics
+                )
+                self._listings[country_code] = listings
+            return listings
+
+    def account(self, username: str, country_code: str = "nl") -> ZiggoNext:
+        """The managed ZiggoNext of an account"""
+        return self.accounts[_account_key(username, country_code)]
+
+    def remove_account(self, username: str, country_code: str = "nl"):
+        """Disconnects an account and stops managing it"""
+        with self._lock:
+            client = self.accounts.pop(_account_key(username, country_code), None)
+        if client is not None:
+            client.close()
+
+    def add_listener(self, callback):
+        """Calls callback(ZiggoNextBoxChange) on every change of any box of any account, returns a function to remove it"""
+        return self._listeners.add(callback)
+
+    def changes(self):
+        """Async iterator of ZiggoNextBoxChange events of all accounts"""
+        return self._listeners.changes()
+
+    def close(self):
+        """Closes all accounts and stops the shared threads"""
+        with self._lock:
+            clients = list(self.accounts.values())
+            self.accounts.clear()
+        for client in clients:
+            client.close()
+        self.mqttLoop.stop()
+        self.executor.shutdown(wait=False)
+        self.commandExecutor.shutdown(wait=False)
+        self.transport.close()
+
+
+def _account_key(username: str, country_code: str) -> str:
+    return country_code + ":" + username
@@ -0,0 +1,137 @@
+"""Instrumentation hooks for Ziggo Next."""
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class ZiggoNextMetrics:
+    """Instrumentation surface, doing nothing; the default when metrics are disabled."""
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """Adds value to a counter"""
+
+    def observe(self, name: str, value: float, **labels):
+        """Records a value in a histogram"""
+
+    def span(self, name: str, **labels):
+        """Context manager timing a block of work"""
+        return _NULL_SPAN
+
+
+NULL_METRICS = ZiggoNextMetrics()
+
+
+class _Span:
+    __slots__ = ("_registry", "_name", "_labels", "_started")
+
+    def __init__(self, registry, name, labels):
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        duration = time.perf_counter() - self._started
+        labels = dict(self._labels)
+        if excType is not None:
+            labels["error"] = excType.__name__
+        self._registry.observe(self._name + "_seconds", duration, **labels)
+        for hook in self._registry.spanHooks:
+            hook(self._name, labels, duration)
+        return False
+
+
+class ZiggoNextMetricsRegistry(ZiggoNextMetrics):
+    """In-process counters and histograms with span hooks and a Prometheus text exporter."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.spanHooks = []
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0, 0.0]
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                histogram[0][position] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def span(self, name: str, **labels):
+        return _Span(self, name, labels)
+
+    def counter(self, name: str, **labels) -> float:
+        """Current value of a counter"""
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def to_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append("# TYPE {name} counter".format(name=name))
+                typed.add(name)
+            lines.append("{name}{labels} {value}".format(name=name, labels=_format_labels(labels), value=_format_value(value)))
+        for (name, labels), (bucketCounts, count, total) in histograms:
+            if name not in typed:
+                lines.append("# TYPE {name} histogram".format(name=name))
+                typed.add(name)
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets, bucketCounts):
+                cumulative += bucketCount
+                lines.append("{name}_bucket{labels} {value}".format(
+                    name=name, labels=_format_labels(labels + (("le", _format_value(bound)),)), value=cumulative
+                ))
+            lines.append("{name}_bucket{labels} {value}".format(
+                name=name, labels=_format_labels(labels + (("le", "+Inf"),)), value=count
+            ))
+            lines.append("{name}_sum{labels} {value}".format(name=name, labels=_format_labels(labels), value=_format_value(total)))
+            lines.append("{name}_count{labels} {value}".format(name=name, labels=_format_labels(labels), value=count))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{key}="{value}"'.format(key=key, value=str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
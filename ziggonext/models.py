@@ -1,55 +1,150 @@
 """Python client for Ziggo Next."""
-class ZiggoNextSession:
+class _FrozenModel:
+    """Base for immutable models with __slots__; changes produce a new instance via replace."""
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{model} is immutable".format(model=type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{model} is immutable".format(model=type(self).__name__))
+
+    def _set(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __copy__(self):
+        return self
+
+    def __reduce__(self):
+        return _restore_model, (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+    def replace(self, **changes):
+        """Returns a copy with the given fields changed"""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        clone = object.__new__(type(self))
+        clone._set(**values)
+        return clone
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self):
+        fields = ", ".join("{name}={value!r}".format(name=name, value=getattr(self, name)) for name in self.__slots__)
+        return "{model}({fields})".format(model=type(self).__name__, fields=fields)
+
+def _restore_model(model, values):
+    """Rebuilds a frozen model from its slot values, for pickle and deepcopy"""
+    instance = object.__new__(model)
+    instance._set(**dict(zip(model.__slots__, values)))
+    return instance
+
+class ZiggoNextSession(_FrozenModel):
+    __slots__ = ("householdId", "oespToken")
     householdId: str
     oespToken: str
 
     def __init__(self, houseHoldId, oespToken):
-        self.householdId = houseHoldId
-        self.oespToken = oespToken
+        self._set(householdId=houseHoldId, oespToken=oespToken)
 
-class ZiggoNextBoxPlayingInfo:
+class ZiggoNextBoxPlayingInfo(_FrozenModel):
+    """Snapshot of what a box plays; a new snapshot with a higher version replaces it on every change."""
+    __slots__ = (
+        "version",
+        "channelId",
+        "title",
+        "image",
+        "sourceType",
+        "paused",
+        "channelTitle",
+        "startTime",
+        "endTime",
+        "nextTitle",
+        "localImage",
+    )
+    version: int
     channelId: str
     title: str
     image: str
     sourceType: str
     paused: bool
+    channelTitle: str
+    startTime: float
+    endTime: float
+    nextTitle: str
+    localImage: str
 
-    def __init__(self):
-        self.channelId = None
-        self.title = None
-        self.image = None
-        self.sourceType = None
-        self.paused = False
-        self.channelTitle = None
-
-    def setPaused(self, paused: bool):
-        self.paused = paused
+    def __init__(self, version=0, channelId=None, title=None, image=None, sourceType=None, paused=False, channelTitle=None, startTime=None, endTime=None, nextTitle=None, localImage=None):
+        self._set(
+            version=version,
+            channelId=channelId,
+            title=title,
+            image=image,
+            sourceType=sourceType,
+            paused=paused,
+            channelTitle=channelTitle,
+            startTime=startTime,
+            endTime=endTime,
+            nextTitle=nextTitle,
+            localImage=localImage,
+        )
 
-    def setChannel(self, channelId):
-        self.channelId = channelId
-
-    def setTitle(self, title):
-        self.title = title
-
-    def setChannelTitle(self, title):
-        self.channelTitle = title
-
-    def setImage(self, image):
-        self.image = image
-
-    def setSourceType(self, sourceType):
-        self.sourceType = sourceType
-
-class ZiggoChannel:
+class ZiggoChannel(_FrozenModel):
+    __slots__ = ("serviceId", "title", "streamImage", "logoImage", "channelNumber", "stationId", "localStreamImage", "localLogoImage")
     serviceId: str
     title: str
     streamImage: str
     logoImage: str
     channelNumber: str
+    stationId: str
+    localStreamImage: str
+    localLogoImage: str
+
+    def __init__(self, serviceId, title, streamImage, logoImage, channelNumber, stationId=None, localStreamImage=None, localLogoImage=None):
+        self._set(
+            serviceId=serviceId,
+            title=title,
+            streamImage=streamImage,
+            logoImage=logoImage,
+            channelNumber=channelNumber,
+            stationId=stationId,
+            localStreamImage=localStreamImage,
+            localLogoImage=localLogoImage,
+        )
+
+class ZiggoListing(_FrozenModel):
+    __slots__ = ("listingId", "title", "image", "startTime", "endTime", "channelId")
+    listingId: str
+    title: str
+    image: str
+    startTime: float
+    endTime: float
+    channelId: str
+
+    def __init__(self, listingId, title, image, startTime=None, endTime=None, channelId=None):
+        self._set(
+            listingId=listingId,
+            title=title,
+            image=image,
+            startTime=startTime,
+            endTime=endTime,
+            channelId=channelId,
+        )
+
+class ZiggoNextBoxChange(_FrozenModel):
+    """A watched field of a box that changed, with the info version that changed it."""
+    __slots__ = ("boxId", "field", "oldValue", "newValue", "version")
+    boxId: str
+    field: str
+    oldValue: object
+    newValue: object
+    version: int
 
-    def __init__(self, serviceId, title, streamImage, logoImage, channelNumber):
-        self.serviceId = serviceId
-        self.title = title
-        self.streamImage = streamImage
-        self.logoImage = logoImage
-        self.channelNumber = channelNumber
\ No newline at end of file
+    def __init__(self, boxId, field, oldValue, newValue, version=None):
+        self._set(boxId=boxId, field=field, oldValue=oldValue, newValue=newValue, version=version)
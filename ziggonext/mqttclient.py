@@ -0,0 +1,351 @@
+"""Shared mqtt connection for Ziggo Next settop boxes."""
+import asyncio
+import json
+import random
+import threading
+from logging import Logger
+
+import paho.mqtt.client as mqtt
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # pragma: no cover
+    _json_loads = json.loads
+
+from .const import COUNTRY_URLS_MQTT
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+from .mqttloop import ZiggoNextMqttLoop, _backoff_delay, RECONNECT_MAX_DELAY
+from .recorder import ZiggoNextRecorder
+from .exceptions import ZiggoNextConnectionError
+
+DEFAULT_PORT = 443
+DEFAULT_TRANSPORT = "websockets"
+DEFAULT_CONNECT_TIMEOUT = 10
+NETWORK_LOOP_TIMEOUT = 1.0
+CONNACK_REFUSED_TOKEN = (mqtt.CONNACK_REFUSED_BAD_USERNAME_PASSWORD, mqtt.CONNACK_REFUSED_NOT_AUTHORIZED)
+
+
+def _makeId(stringLength=10):
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+    return "".join(random.choice(letters) for i in range(stringLength))
+
+
+class ZiggoNextMqttClient:
+    """Single mqtt connection per household, routing messages to the settop boxes."""
+
+    def __init__(self, householdId: str, token: str, country_code: str, logger: Logger, tokenRefresher=None, metrics: ZiggoNextMetrics = NULL_METRICS, port: int = DEFAULT_PORT, transport: str = DEFAULT_TRANSPORT, tls: bool = True, mqttLoop: ZiggoNextMqttLoop = None, recorder: ZiggoNextRecorder = None):
+        self.metrics = metrics
+        self.recorder = recorder
+        self._mqttLoop = mqttLoop
+        self._householdId = householdId
+        self._token = token
+        self._tokenRefresher = tokenRefresher
+        self.logger = logger
+        self._mqtt_broker = COUNTRY_URLS_MQTT[country_code]
+        self._mqtt_port = port
+        self._boxes = {}
+        self._statusTopics = {}
+        self._subscriptions = set()
+        self.mqttClientConnected = False
+        self.connectError = None
+        self._connectRequested = False
+        self._connectedEvent = threading.Event()
+        self._connectedBefore = False
+        self._tokenRejected = False
+        self._reconnectAttempts = 0
+        self.mqttClientId = _makeId(30)
+        self._replyTopic = householdId + "/" + self.mqttClientId
+        self.mqttClient = mqtt.Client(self.mqttClientId, transport=transport)
+        self.mqttClient.username_pw_set(householdId, token)
+        if tls:
+            self.mqttClient.tls_set()
+        self.mqttClient.on_connect = self._on_mqtt_client_connect
+        self.mqttClient.on_disconnect = self._on_mqtt_client_disconnect
+        self.mqttClient.on_message = self._on_mqtt_client_message
+        # A failing callback is logged instead of ending the network loop
+        self.mqttClient.suppress_exceptions = True
+        self.mqttClient.on_log = self._on_mqtt_client_log
+        self.mqttClient.reconnect_delay_set(_backoff_delay(0), RECONNECT_MAX_DELAY)
+        if mqttLoop is not None:
+            mqttLoop.attach(self.mqttClient)
+
+    def register_box(self, box):
+        """Routes the status topic of the box and replies from the box to the given box"""
+        self._boxes[box.box_id] = box
+        topic = self._householdId + "/" + box.box_id + "/status"
+        self._statusTopics[topic] = box
+        self.subscribe(topic)
+
+    def connect(self):
+        """Connects to the mqtt broker and starts the network loop"""
+        self._connectRequested = True
+        try:
+            if self._mqttLoop is not None:
+                self._mqttLoop.connect(self.mqttClient, self._mqtt_broker, self._mqtt_port, reconnect=self._reconnect)
+                return
+            self.mqttClient.connect(self._mqtt_broker, self._mqtt_port)
+        except (OSError, mqtt.WebsocketConnectionError) as ex:
+            self._connectRequested = False
+            raise ZiggoNextConnectionError("Could not connect to Mqtt server: " + str(ex)) from ex
+        self.mqttClient.loop_start()
+
+    def connect_async(self):
+        """Starts the network loop, which connects in the background"""
+        self._connectRequested = True
+        if self._mqttLoop is not None:
+            self._mqttLoop.connect(self.mqttClient, self._mqtt_broker, self._mqtt_port, blocking=False, reconnect=self._reconnect)
+            return
+        self.mqttClient.connect_async(self._mqtt_broker, self._mqtt_port)
+        self.mqttClient.loop_start()
+
+    def _prepare_reconnect(self):
+        """Picks a jittered first reconnect delay, which paho doubles per failed attempt, and refreshes a refused token"""
+        self.mqttClient.reconnect_delay_set(_backoff_delay(0), RECONNECT_MAX_DELAY)
+        if not self._tokenRejected or self._tokenRefresher is None:
+            return
+        try:
+            self.update_token(self._tokenRefresher())
+            self._tokenRejected = False
+        except Exception:
+            self.logger.exception("Could not refresh the mqtt token")
+
+    def _reconnect(self):
+        """Connects again, with a fresh token if the broker refused the previous one"""
+        if self._tokenRejected and self._tokenRefresher is not None:
+            self.update_token(self._tokenRefresher())
+            self._tokenRejected = False
+        self.mqttClient.reconnect()
+
+    def ensure_connected(self, timeout: float = DEFAULT_CONNECT_TIMEOUT) -> bool:
+        """Connects on first use when connecting was deferred, returns whether this call connected"""
+        if self._connectRequested:
+            return False
+        self.connect_async()
+        if not self._connectedEvent.wait(timeout):
+            self.logger.warning("Mqtt connection not established within %s seconds: %s", timeout, self.connectError)
+        return True
+
+    def disconnect(self):
+        """Disconnects from the mqtt broker and stops the network loop"""
+        self.mqttClient.disconnect()
+        if self._mqttLoop is not None:
+            self._mqttLoop.detach(self.mqttClient)
+        else:
+            self.mqttClient.loop_stop()
+
+    def call_later(self, delay: float, callback):
+        """Runs callback after delay seconds, returns a handle with cancel()"""
+        if self._mqttLoop is not None:
+            return self._mqttLoop.call_later(delay, callback)
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _on_mqtt_client_connect(self, client, userdata, flags, resultCode):
+        """Handling mqtt connect result"""
+        self.metrics.increment("ziggonext_mqtt_connects_total", result=resultCode)
+        if resultCode == mqtt.CONNACK_ACCEPTED:
+            self.logger.debug("Connected to mqtt client.")
+            self.mqttClientConnected = True
+            self.connectError = None
+            self._reconnectAttempts = 0
+            if self._mqttLoop is not None:
+                self._mqttLoop.connected(self.mqttClient)
+            payload = {
+                "source": self.mqttClientId,
+                "state": "ONLINE_RUNNING",
+                "deviceType": "HGO",
+            }
+            topic = self._householdId + "/" + self.mqttClientId + "/status"
+            self.publish(topic, json.dumps(payload))
+            self._subscriptions.add(self._replyTopic)
+            for topic in list(self._subscriptions):
+                self.mqttClient.subscribe(topic)
+                self.logger.debug("subscribed to topic: {topic}".format(topic=topic))
+            # Publishes waiting for the connection go out after the subscriptions, so replies are not missed
+            self._connectedEvent.set()
+            if self._connectedBefore:
+                self._resync()
+            self._connectedBefore = True
+            return
+        self.connectError = ZiggoNextConnectionError(
+            "Could not connect to Mqtt server: " + mqtt.connack_string(resultCode)
+        )
+        if resultCode in CONNACK_REFUSED_TOKEN:
+            self.logger.debug("Not authorized mqtt client, refreshing the token before reconnecting.")
+            self._tokenRejected = True
+        else:
+            self.logger.error("%s", self.connectError)
+
+    def _resync(self):
+        """Asks every box for its state once after a reconnect, missed updates are lost"""
+        for box in list(self._boxes.values()):
+            box._resync()
+
+    def update_token(self, token: str):
+        """Uses the token for the next (re)connect without dropping the current connection"""
+        self._token = token
+        self.mqttClient.username_pw_set(self._householdId, token)
+
+    def _on_mqtt_client_disconnect(self, client, userdata, resultCode):
+        """Set state to diconnect"""
+        self.logger.debug("Disconnected from mqtt client: %s", resultCode)
+        self.metrics.increment("ziggonext_mqtt_disconnects_total")
+        self.mqttClientConnected = False
+        self._connectedEvent.clear()
+        if self._mqttLoop is None and resultCode != mqtt.MQTT_ERR_SUCCESS:
+            self._prepare_reconnect()
+
+    def _on_mqtt_client_log(self, client, userdata, level, message):
+        """Surfaces the errors paho caught, e.g. a failing callback"""
+        if level == mqtt.MQTT_LOG_ERR:
+            self.logger.error("Mqtt client: %s", message)
+
+    def _on_mqtt_client_message(self, client, userdata, message):
+        """Routes a message by topic, decoding only messages for a registered box"""
+        if self.recorder is not None:
+            self.recorder.record_mqtt(message.topic, message.payload)
+        box = self._statusTopics.get(message.topic)
+        if box is None and message.topic != self._replyTopic:
+            self.metrics.increment("ziggonext_mqtt_messages_total", result="dropped")
+            return
+        try:
+            jsonPayload = _json_loads(message.payload)
+        except ValueError as ex:
+            self.metrics.increment("ziggonext_mqtt_messages_total", result="invalid")
+            self.logger.warning("Ignoring invalid mqtt message on %s: %s", message.topic, ex)
+            return
+        self.logger.debug(jsonPayload)
+        if box is None:
+            source = jsonPayload.get("source")
+            box = self._boxes.get(source) if isinstance(source, str) else None
+            if box is None:
+                self.metrics.increment("ziggonext_mqtt_messages_total", result="dropped")
+                return
+        self.metrics.increment("ziggonext_mqtt_messages_total", result="routed")
+        self._dispatch(box, jsonPayload)
+
+    def _dispatch(self, box, jsonPayload):
+        """Hands a message to its box, a failing message must not stop the network loop"""
+        try:
+            box._on_mqtt_message(jsonPayload)
+        except Exception:
+            self.logger.exception("Box %s could not handle %s", box.box_id, jsonPayload)
+
+    def subscribe(self, topic):
+        """Subscribes to mqtt topic"""
+        if topic in self._subscriptions:
+            return
+        self._subscriptions.add(topic)
+        if not self.mqttClientConnected:
+            return
+        self.mqttClient.subscribe(topic)
+        self.logger.debug("subscribed to topic: {topic}".format(topic=topic))
+
+    def publish(self, topic, payload):
+        """Publishes payload to mqtt topic"""
+        self.ensure_connected()
+        self.mqttClient.publish(topic, payload)
+
+
+class AsyncZiggoNextMqttClient(ZiggoNextMqttClient):
+    """Household mqtt connection driven by an asyncio event loop instead of a network thread."""
+
+    def __init__(self, householdId: str, token: str, country_code: str, logger: Logger, tokenRefresher=None, metrics: ZiggoNextMetrics = NULL_METRICS, loop: asyncio.AbstractEventLoop = None, **options):
+        super().__init__(householdId, token, country_code, logger, tokenRefresher, metrics, **options)
+        self._loop = loop or asyncio.get_event_loop()
+        self._miscTask = None
+        self.mqttClient.on_socket_open = self._on_socket_open
+        self.mqttClient.on_socket_close = self._on_socket_close
+        self.mqttClient.on_socket_register_write = self._on_socket_register_write
+        self.mqttClient.on_socket_unregister_write = self._on_socket_unregister_write
+
+    async def connect(self):
+        """Connects to the mqtt broker and lets the event loop handle the socket"""
+        self._connectRequested = True
+        try:
+            await self._loop.run_in_executor(None, self.mqttClient.connect, self._mqtt_broker, self._mqtt_port)
+        except (OSError, mqtt.WebsocketConnectionError) as ex:
+            self._connectRequested = False
+            raise ZiggoNextConnectionError("Could not connect to Mqtt server: " + str(ex)) from ex
+        if self._miscTask is None or self._miscTask.done():
+            self._miscTask = self._loop.create_task(self._misc_loop())
+
+    async def disconnect(self):
+        """Disconnects from the mqtt broker"""
+        self.mqttClient.disconnect()
+        if self._miscTask is not None:
+            self._miscTask.cancel()
+            self._miscTask = None
+
+    def ensure_connected(self, timeout: float = None) -> bool:
+        """The event loop must not block, connecting is left to connect()"""
+        return False
+
+    def _prepare_reconnect(self):
+        """Reconnecting and refreshing the token is left to the misc loop"""
+
+    def call_later(self, delay: float, callback):
+        """Runs callback on the event loop after delay seconds"""
+        return self._loop.call_later(delay, callback)
+
+    async def _misc_loop(self):
+        """Keepalive pings while connected, jittered exponential backoff reconnects while not"""
+        while True:
+            if self.mqttClient.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(NETWORK_LOOP_TIMEOUT)
+                continue
+            delay = _backoff_delay(self._reconnectAttempts)
+            self._reconnectAttempts += 1
+            self.logger.debug("Reconnecting to mqtt in %.1f seconds", delay)
+            await asyncio.sleep(delay)
+            try:
+                await self._reconnect_async()
+            except (OSError, ValueError, ZiggoNextConnectionError) as ex:
+                self.logger.debug("Mqtt reconnect failed: %s", ex)
+
+    async def _reconnect_async(self):
+        """Connects again, with a fresh token if the broker refused the previous one"""
+        if self._tokenRejected and self._tokenRefresher is not None:
+            self.update_token(await self._tokenRefresher())
+            self._tokenRejected = False
+        await self._loop.run_in_executor(None, self.mqttClient.reconnect)
+
+    def _in_loop(self, callback, *args):
+        """Runs callback on the event loop, right away when already on it so sockets are still open"""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._in_loop(self._loop.add_reader, sock, self._on_socket_readable, sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._in_loop(self._remove_socket, self._loop.remove_reader, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self._loop.add_writer, sock, self.mqttClient.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self._remove_socket, self._loop.remove_writer, sock)
+
+    def _remove_socket(self, remove, sock):
+        try:
+            remove(sock)
+        except (ValueError, OSError):
+            # closed before the event loop got to it
+            pass
+
+    def _on_socket_readable(self, sock):
+        """Reads all available data, including data already buffered by TLS"""
+        self.mqttClient.loop_read()
+        pending = getattr(sock, "pending", None)
+        while pending is not None and pending() and self.mqttClient.socket() is sock:
+            self.mqttClient.loop_read()
@@ -0,0 +1,262 @@
+"""Shared network loop for many Ziggo Next mqtt connections."""
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from logging import Logger
+
+DEFAULT_MISC_INTERVAL = 1.0
+DEFAULT_CONNECT_WORKERS = 2
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 120
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Exponential reconnect delay with jitter, so dropped clients don't reconnect in lockstep"""
+    delay = min(RECONNECT_MIN_DELAY * 2 ** attempt, RECONNECT_MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class _Timer:
+    """Handle of a callback scheduled on the loop."""
+    __slots__ = ("callback", "cancelled")
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ZiggoNextMqttLoop:
+    """One thread driving the sockets and timers of many paho clients instead of a thread per client.
+
+    Sockets are watched through the paho socket callbacks, connecting happens
+    on an executor so a slow broker never stalls the other connections.
+    """
+
+    def __init__(self, logger: Logger, executor: Executor = None, miscInterval: float = DEFAULT_MISC_INTERVAL):
+        self.logger = logger
+        self.miscInterval = miscInterval
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=DEFAULT_CONNECT_WORKERS, thread_name_prefix="ziggonext-mqtt-connect"
+        )
+        self._ownsExecutor = executor is None
+        self._selector = selectors.DefaultSelector()
+        self._clients = {}
+        self._calls = deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeReader, self._wakeWriter = socket.socketpair()
+        self._wakeReader.setblocking(False)
+        self._wakeWriter.setblocking(False)
+        self._selector.register(self._wakeReader, selectors.EVENT_READ)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ziggonext-mqtt-loop", daemon=True)
+        self._thread.start()
+
+    def attach(self, client):
+        """Lets the loop handle the sockets of a paho client, must happen before it connects"""
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def connect(self, client, host: str, port: int, blocking: bool = True, reconnect=None):
+        """Connects a client and keeps it connected until it is detached, reconnecting through reconnect()
+
+        A failing blocking connect raises and forgets the client, a background
+        connect keeps retrying with backoff.
+        """
+        state = [0, time.monotonic() + _backoff_delay(0), reconnect or client.reconnect]
+        self.call_soon(self._clients.setdefault, client, state)
+        if not blocking:
+            return self._executor.submit(self._connect, client, host, port)
+        try:
+            client.connect(host, port)
+        except Exception:
+            self.detach(client)
+            raise
+
+    def _connect(self, client, host: str, port: int):
+        try:
+            client.connect(host, port)
+        except Exception as ex:
+            self.logger.debug("Mqtt connect failed, retrying: %s", ex)
+
+    def connected(self, client):
+        """Resets the backoff of a client once the broker accepted it"""
+        self.call_soon(self._reset_backoff, client)
+
+    def _reset_backoff(self, client):
+        state = self._clients.get(client)
+        if state is not None:
+            state[0] = 0
+
+    def detach(self, client):
+        """Stops reconnecting a client, its socket is unregistered when it closes"""
+        self.call_soon(self._clients.pop, client, None)
+
+    def submit(self, func, *args):
+        """Runs blocking work off the loop thread"""
+        return self._executor.submit(func, *args)
+
+    def call_soon(self, callback, *args):
+        """Runs callback on the loop thread"""
+        if threading.current_thread() is self._thread:
+            callback(*args)
+            return
+        with self._lock:
+            self._calls.append((callback, args))
+        self._wakeup()
+
+    def call_later(self, delay: float, callback) -> _Timer:
+        """Runs callback on the loop thread after delay seconds, returns a handle with cancel()"""
+        timer = _Timer(callback)
+        with self._lock:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._sequence), timer))
+        self._wakeup()
+        return timer
+
+    def stop(self):
+        """Stops the loop thread"""
+        self._running = False
+        self._wakeup()
+        self._thread.join()
+        self._selector.close()
+        self._wakeReader.close()
+        self._wakeWriter.close()
+        if self._ownsExecutor:
+            self._executor.shutdown(wait=False)
+
+    def _wakeup(self):
+        try:
+            self._wakeWriter.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.call_soon(self._register, client, sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.call_soon(self._unregister, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.call_soon(self._modify, client, sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.call_soon(self._modify, client, sock, selectors.EVENT_READ)
+
+    def _register(self, client, sock):
+        try:
+            self._selector.register(sock, selectors.EVENT_READ, client)
+        except (KeyError, ValueError, OSError):
+            return
+
+    def _unregister(self, sock):
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _modify(self, client, sock, events):
+        try:
+            self._selector.modify(sock, events, client)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _run(self):
+        lastMisc = time.monotonic()
+        while self._running:
+            for key, mask in self._selector.select(self._timeout()):
+                if key.data is None:
+                    self._drain_wakeups()
+                else:
+                    self._service(key.data, key.fileobj, mask)
+            self._run_calls()
+            self._run_timers()
+            now = time.monotonic()
+            if now - lastMisc >= self.miscInterval:
+                lastMisc = now
+                self._run_misc(now)
+
+    def _timeout(self) -> float:
+        timeout = self.miscInterval
+        with self._lock:
+            if self._calls:
+                return 0
+            if self._timers:
+                timeout = min(timeout, max(self._timers[0][0] - time.monotonic(), 0))
+        return timeout
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeReader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _service(self, client, sock, mask):
+        """Reads and writes for one client, a failing client does not take down the others"""
+        if client.socket() is not sock:
+            return
+        try:
+            if mask & selectors.EVENT_READ:
+                client.loop_read()
+                pending = getattr(sock, "pending", None)
+                while pending is not None and pending() and client.socket() is sock:
+                    client.loop_read()
+            if mask & selectors.EVENT_WRITE and client.socket() is sock:
+                client.loop_write()
+        except Exception:
+            self.logger.exception("Mqtt client failed, reconnecting")
+            client.disconnect()
+
+    def _run_calls(self):
+        with self._lock:
+            calls, self._calls = self._calls, deque()
+        for callback, args in calls:
+            try:
+                callback(*args)
+            except Exception:
+                self.logger.exception("Mqtt loop callback failed")
+
+    def _run_timers(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._timers and self._timers[0][0] <= now:
+                due.append(heapq.heappop(self._timers)[2])
+        for timer in due:
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback()
+            except Exception:
+                self.logger.exception("Mqtt loop timer failed")
+
+    def _run_misc(self, now: float):
+        """Keepalive pings for connected clients and backed off reconnects for dropped ones"""
+        for client, state in list(self._clients.items()):
+            if client.socket() is not None:
+                client.loop_misc()
+                continue
+            attempts, nextAttempt, reconnect = state
+            if now < nextAttempt:
+                continue
+            state[0] = attempts + 1
+            state[1] = now + _backoff_delay(attempts)
+            self._executor.submit(self._reconnect, reconnect)
+
+    def _reconnect(self, reconnect):
+        try:
+            reconnect()
+        except Exception as ex:
+            self.logger.debug("Mqtt reconnect failed: %s", ex)
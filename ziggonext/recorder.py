@@ -0,0 +1,95 @@
+"""Capture of Ziggo Next mqtt and http traffic."""
+import base64
+import json
+import os
+import threading
+import time
+
+import requests
+
+RECORD_MQTT = "mqtt"
+RECORD_HTTP = "http"
+REDACTED_KEYS = ("oespToken", "token")
+REDACTED = "<redacted>"
+
+
+def _dumps(record) -> str:
+    return json.dumps(record, separators=(",", ":"), ensure_ascii=False)
+
+
+def _decode(payload):
+    if isinstance(payload, bytes):
+        return payload.decode("utf-8", "replace")
+    return payload
+
+
+def _redact(content):
+    """Copy of a json document with the credentials in REDACTED_KEYS replaced"""
+    if isinstance(content, dict):
+        return {key: REDACTED if key in REDACTED_KEYS else _redact(value) for key, value in content.items()}
+    if isinstance(content, list):
+        return [_redact(value) for value in content]
+    return content
+
+
+def _http_body(response: requests.Response):
+    """Body of a response for the log and its encoding: redacted json as text, anything else (images) as base64"""
+    content = response.content
+    if not content:
+        return "", None
+    try:
+        return _dumps(_redact(json.loads(content))), None
+    except ValueError:
+        return base64.b64encode(content).decode("ascii"), "base64"
+
+
+def read_log(path: str):
+    """Yields the records of a capture log in order, skipping a torn last line"""
+    with open(path, encoding="utf-8") as fp:
+        for line in fp:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+class ZiggoNextRecorder:
+    """Appends every inbound mqtt message and http response with its timestamp to a json-lines log.
+
+    The log is created readable by the owner only, and session and token values are redacted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._file = os.fdopen(fd, "a", encoding="utf-8")
+
+    def record_mqtt(self, topic: str, payload):
+        """Logs an mqtt message as received, before routing"""
+        self._write({"t": round(time.time(), 6), "k": RECORD_MQTT, "topic": topic, "payload": _decode(payload)})
+
+    def record_http(self, method: str, response: requests.Response):
+        """Logs an http response with the url it answered"""
+        body, encoding = _http_body(response)
+        record = {
+            "t": round(time.time(), 6),
+            "k": RECORD_HTTP,
+            "method": method,
+            "url": response.url,
+            "status": response.status_code,
+            "body": body,
+        }
+        if encoding is not None:
+            record["encoding"] = encoding
+        self._write(record)
+
+    def _write(self, record: dict):
+        line = _dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,204 @@
+"""Replay of captured Ziggo Next mqtt and http traffic."""
+import base64
+import json
+import threading
+import time
+from logging import Logger
+
+import requests
+
+from .listings import ZiggoNextListingCache
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+from .mqttclient import ZiggoNextMqttClient
+from .ziggonextbox import ZiggoNextBox
+from .ziggonext import _parse_channels, _parse_session, _parse_settop_boxes
+from .recorder import read_log, RECORD_HTTP, RECORD_MQTT
+
+
+class ZiggoNextReplayTransport:
+    """Transport answering requests with the responses of a capture log, in recorded order per url."""
+
+    def __init__(self, records):
+        self._responses = {}
+        self._lock = threading.Lock()
+        for record in records:
+            if record["k"] == RECORD_HTTP:
+                self._responses.setdefault((record["method"], record["url"]), []).append(record)
+
+    def get(self, url: str, headers: dict = None, params: dict = None) -> requests.Response:
+        return self.request("GET", url, params=params)
+
+    def post(self, url: str, json=None, headers: dict = None) -> requests.Response:
+        return self.request("POST", url)
+
+    def request(self, method: str, url: str, params: dict = None, **kwargs) -> requests.Response:
+        """The next recorded response for the url, the last one once they are used up, or a 404"""
+        url = requests.Request(method, url, params=params).prepare().url
+        with self._lock:
+            recorded = self._responses.get((method, url))
+            record = recorded.pop(0) if recorded and len(recorded) > 1 else (recorded[0] if recorded else None)
+        response = requests.Response()
+        response.url = url
+        if record is None:
+            response.status_code = 404
+            response._content = b"{}"
+        else:
+            response.status_code = record["status"]
+            response._content = _record_body(record)
+        response.encoding = "utf-8"
+        return response
+
+    def close(self):
+        pass
+
+
+def _record_body(record: dict) -> bytes:
+    if record.get("encoding") == "base64":
+        return base64.b64decode(record["body"])
+    return record["body"].encode("utf-8")
+
+
+def _json_object(payload: str) -> dict:
+    try:
+        content = json.loads(payload)
+    except ValueError:
+        return {}
+    return content if isinstance(content, dict) else {}
+
+
+class _NullTimer:
+    def cancel(self):
+        pass
+
+
+class _ReplayMqttClient(ZiggoNextMqttClient):
+    """Household mqtt client without a connection, collecting what the boxes publish."""
+
+    def __init__(self, householdId: str, logger: Logger, metrics: ZiggoNextMetrics = NULL_METRICS):
+        super().__init__(householdId, "", "nl", logger, metrics=metrics)
+        self.mqttClientConnected = True
+        self.published = []
+
+    def connect(self):
+        pass
+
+    def connect_async(self):
+        pass
+
+    def ensure_connected(self, timeout: float = None) -> bool:
+        return False
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topic):
+        self._subscriptions.add(topic)
+
+    def publish(self, topic, payload):
+        self.published.append((topic, payload))
+
+    def call_later(self, delay: float, callback):
+        return _NullTimer()
+
+    def _dispatch(self, box, jsonPayload):
+        # failures surface in the replayer instead of the log
+        box._on_mqtt_message(jsonPayload)
+
+
+class _Message:
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class ZiggoNextReplayer:
+    """Feeds a capture log back through ZiggoNextBox, at recorded speed or as fast as possible.
+
+    Boxes, channels and listings come from the recorded http responses; boxes
+    missing from them are taken from the status topics in the log.
+    """
+
+    def __init__(self, path: str, logger: Logger, metrics: ZiggoNextMetrics = None):
+        self.logger = logger
+        self.metrics = metrics or NULL_METRICS
+        self.records = list(read_log(path))
+        self.transport = ZiggoNextReplayTransport(self.records)
+        self.errors = []
+        self.householdId = self._household_id()
+        self.mqttClient = _ReplayMqttClient(self.householdId, logger, self.metrics)
+        self.listings = None
+        self.channels = {}
+        self.settop_boxes = {}
+        self._setup()
+
+    def _http_bodies(self, suffix: str, method: str = "GET"):
+        for record in self.records:
+            if record["k"] == RECORD_HTTP and record["method"] == method and record["status"] == 200 \
+                    and record["url"].split("?")[0].endswith(suffix):
+                yield record["url"], json.loads(record["body"])
+
+    def _household_id(self) -> str:
+        for url, body in self._http_bodies("/session", "POST"):
+            return _parse_session(body).householdId
+        for record in self.records:
+            if record["k"] == RECORD_MQTT:
+                return record["topic"].split("/")[0]
+        return ""
+
+    def _setup(self):
+        listingsUrl = "{id}"
+        for url, body in self._http_bodies("/channels"):
+            self.channels = _parse_channels(body)
+            listingsUrl = url.split("?")[0][:-len("/channels")] + "/listings/{id}"
+        self.listings = ZiggoNextListingCache(listingsUrl, self.logger, self.transport, metrics=self.metrics)
+        for url, body in self._http_bodies("/devices"):
+            for box_id, name in _parse_settop_boxes(body):
+                self._add_box(box_id, name)
+        for record in self.records:
+            parts = record["topic"].split("/") if record["k"] == RECORD_MQTT else ()
+            if len(parts) == 3 and parts[2] == "status" and parts[1] not in self.settop_boxes \
+                    and _json_object(record["payload"]).get("deviceType") == "STB":
+                self._add_box(parts[1], parts[1])
+
+    def _add_box(self, box_id: str, name: str):
+        if box_id in self.settop_boxes:
+            return
+        box = ZiggoNextBox(box_id, name, self.householdId, self.mqttClient, self.listings, self.logger, metrics=self.metrics)
+        box.channels = self.channels
+        self.settop_boxes[box_id] = box
+
+    def _message(self, record) -> _Message:
+        """The recorded message, with replies to the recording client routed to the replay client"""
+        topic = record["topic"]
+        if topic.count("/") == 1 and topic.split("/")[1] not in self.settop_boxes:
+            topic = self.mqttClient._replyTopic
+        return _Message(topic, record["payload"].encode("utf-8"))
+
+    def replay(self, speed: float = None, raiseErrors: bool = False) -> dict:
+        """Replays all mqtt messages, with speed 1 at recorded pace or as fast as possible without"""
+        messages = [record for record in self.records if record["k"] == RECORD_MQTT]
+        started = time.perf_counter()
+        firstRecorded = messages[0]["t"] if messages else 0
+        for index, record in enumerate(messages):
+            if speed:
+                delay = (record["t"] - firstRecorded) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                self.mqttClient._on_mqtt_client_message(None, None, self._message(record))
+            except Exception as ex:
+                if raiseErrors:
+                    raise
+                self.errors.append((index, record, ex))
+                self.logger.error("Replaying message %s failed: %r", index, ex)
+        seconds = time.perf_counter() - started
+        return {
+            "messages": len(messages),
+            "seconds": seconds,
+            "perSecond": len(messages) / seconds if seconds else 0,
+            "recordedSeconds": messages[-1]["t"] - firstRecorded if messages else 0,
+            "errors": len(self.errors),
+            "published": len(self.mqttClient.published),
+        }
@@ -0,0 +1,124 @@
+"""Session and token storage for Ziggo Next."""
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+
+from .models import ZiggoNextSession
+
+TOKEN_REFRESH_MARGIN = 120
+
+
+def _jwt_expiry(token: str) -> float:
+    """Expiry (epoch seconds) from the exp claim of a JWT, or None"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class ZiggoNextStoredSession:
+    """Session and JWT token of an account, with the moment the token expires."""
+    session: ZiggoNextSession
+    token: str
+    tokenExpiry: float
+
+    def __init__(self, session: ZiggoNextSession, token: str, tokenExpiry: float = None):
+        self.session = session
+        self.token = token
+        self.tokenExpiry = tokenExpiry if tokenExpiry is not None else _jwt_expiry(token)
+
+    def token_valid(self, margin: float = TOKEN_REFRESH_MARGIN) -> bool:
+        """Whether the token is still valid for at least margin seconds"""
+        if self.token is None or self.tokenExpiry is None:
+            return False
+        return self.tokenExpiry - margin > time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "householdId": self.session.householdId,
+            "oespToken": self.session.oespToken,
+            "token": self.token,
+            "tokenExpiry": self.tokenExpiry,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        session = ZiggoNextSession(data["householdId"], data["oespToken"])
+        return cls(session, data.get("token"), data.get("tokenExpiry"))
+
+
+class ZiggoNextSessionStore:
+    """Keeps sessions in memory, keyed by country code and username."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, key: str) -> ZiggoNextStoredSession:
+        """Returns the stored session for the key, or None"""
+        with self._lock:
+            return self._sessions.get(key)
+
+    def save(self, key: str, storedSession: ZiggoNextStoredSession):
+        """Stores the session for the key"""
+        with self._lock:
+            self._sessions[key] = storedSession
+
+    def remove(self, key: str):
+        """Forgets the session for the key"""
+        with self._lock:
+            self._sessions.pop(key, None)
+
+
+class ZiggoNextFileSessionStore(ZiggoNextSessionStore):
+    """Persists sessions to a json file so restarts can reuse them."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        try:
+            with open(path, encoding="utf-8") as fp:
+                content = json.load(fp)
+            self._sessions = {
+                key: ZiggoNextStoredSession.from_dict(data) for key, data in content.items()
+            }
+        except (OSError, ValueError, KeyError):
+            self._sessions = {}
+
+    def save(self, key: str, storedSession: ZiggoNextStoredSession):
+        super().save(key, storedSession)
+        self._write()
+
+    def remove(self, key: str):
+        super().remove(key)
+        self._write()
+
+    def _write(self):
+        """Writes all sessions, replacing the file atomically and readable by the owner only"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            content = {key: stored.to_dict() for key, stored in self._sessions.items()}
+            # mkstemp creates the file with mode 0600
+            fd, tmpPath = tempfile.mkstemp(dir=directory or None, prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                    json.dump(content, fp, separators=(",", ":"))
+                os.replace(tmpPath, self.path)
+            except BaseException:
+                _unlink(tmpPath)
+                raise
+
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,65 @@
+"""Warm-start snapshots of Ziggo Next settop boxes."""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .models import ZiggoNextBoxPlayingInfo
+
+DEFAULT_SNAPSHOT_INTERVAL = 60
+INFO_FIELDS = tuple(name for name in ZiggoNextBoxPlayingInfo.__slots__ if name != "version")
+
+
+class ZiggoNextSnapshotStore:
+    """On-disk snapshot of the boxes of an account with their last state and playing info, one file per account."""
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory: str, interval: float = DEFAULT_SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, "snapshot-{digest}.json".format(digest=digest))
+
+    def load(self, key: str) -> dict:
+        """Returns box id -> (name, state, info) of the stored snapshot, empty without one"""
+        try:
+            with open(self._path(key), encoding="utf-8") as fp:
+                content = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if content.get("version") != self.FORMAT_VERSION or content.get("key") != key:
+            return {}
+        boxes = {}
+        for boxId, name, state, info in content["boxes"]:
+            fields = {field: info.get(field) for field in INFO_FIELDS}
+            boxes[boxId] = (name, state, ZiggoNextBoxPlayingInfo(**fields))
+        return boxes
+
+    def store(self, key: str, boxes):
+        """Writes the boxes with their state and info, replacing the previous file atomically"""
+        content = {
+            "version": self.FORMAT_VERSION,
+            "key": key,
+            "savedAt": time.time(),
+            "boxes": [
+                [box.box_id, box.name, box.state, {field: getattr(box.info, field) for field in INFO_FIELDS}]
+                for box in boxes
+            ],
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmpPath = path + ".tmp"
+        with self._lock:
+            with open(tmpPath, "w", encoding="utf-8") as fp:
+                json.dump(content, fp, separators=(",", ":"))
+            os.replace(tmpPath, path)
+
+
+def _snapshot_signature(boxes) -> tuple:
+    """Changes whenever a box changes state or playing info"""
+    return tuple((box.box_id, box.state, box.info.version) for box in boxes)
@@ -0,0 +1,201 @@
+"""Http transport for Ziggo Next."""
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from .exceptions import ZiggoNextConnectionError
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+from .recorder import ZiggoNextRecorder
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 15
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_POOL_SIZE = 10
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+ENDPOINTS = ("session", "tokens/jwt", "channels", "listings", "devices")
+DEFAULT_RATE_BURST = 10
+ASYNC_CONNECTION_ERRORS = (asyncio.TimeoutError,) if aiohttp is None else (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def _endpoint(url: str) -> str:
+    """Low-cardinality name of the api endpoint of a url, for metrics"""
+    path = urlparse(url).path
+    for endpoint in ENDPOINTS:
+        if "/" + endpoint in path:
+            return endpoint
+    return "other"
+
+
+def _async_timeout(connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, read_timeout: float = DEFAULT_READ_TIMEOUT):
+    """aiohttp timeout matching the connect and read timeouts of the sync transport"""
+    return aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+
+
+async def _async_get(httpSession, url: str, **kwargs):
+    """GETs url with an aiohttp session, returning the response and its json body (None unless the status is 200)
+
+    Connection failures and timeouts raise ZiggoNextConnectionError, like the sync transport.
+    """
+    try:
+        async with httpSession.get(url, **kwargs) as response:
+            content = await response.json() if response.status == 200 else None
+    except ASYNC_CONNECTION_ERRORS as ex:
+        raise ZiggoNextConnectionError("Request failed: " + (str(ex) or type(ex).__name__)) from ex
+    return response, content
+
+
+def _retry_policy(retries, backoff_factor) -> Retry:
+    """Retry on connection errors and 5xx responses with exponential backoff"""
+    options = {
+        "total": retries,
+        "backoff_factor": backoff_factor,
+        "status_forcelist": RETRY_STATUS_CODES,
+        "raise_on_status": False,
+    }
+    try:
+        return Retry(allowed_methods=frozenset(["GET", "POST"]), **options)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(["GET", "POST"]), **options)
+
+
+def _flight_key(url: str, params: dict, headers: dict) -> tuple:
+    """Identity of a GET request, equal for requests that must get the same response"""
+    return (
+        url,
+        tuple(sorted((params or {}).items())),
+        tuple(sorted((headers or {}).items())),
+    )
+
+
+class _Flight:
+    __slots__ = ("done", "response", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class ZiggoNextRateLimiter:
+    """Token bucket allowing rate requests per second on average, with bursts of up to burst requests."""
+
+    def __init__(self, rate: float, burst: int = DEFAULT_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Takes a token, sleeping until one is available, returns the seconds waited"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class ZiggoNextTransport:
+    """Pooled keep-alive http session shared by ZiggoNext and its settop boxes.
+
+    Concurrent GETs of the same url, params and headers share one request and
+    its response. A rateLimiter spaces out the requests that do go out.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+        retries: int = DEFAULT_RETRIES,
+        backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        session: requests.Session = None,
+        metrics: ZiggoNextMetrics = NULL_METRICS,
+        recorder: ZiggoNextRecorder = None,
+        rateLimiter: ZiggoNextRateLimiter = None,
+        singleFlight: bool = True,
+    ):
+        self.metrics = metrics
+        self.recorder = recorder
+        self.rateLimiter = rateLimiter
+        self.singleFlight = singleFlight
+        self._flights = {}
+        self._flightsLock = threading.Lock()
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = session or requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=_retry_policy(retries, backoff_factor),
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def get(self, url: str, headers: dict = None, params: dict = None) -> requests.Response:
+        """Executes a GET request, or waits for the identical one already in flight"""
+        if not self.singleFlight:
+            return self.request("GET", url, headers=headers, params=params)
+        key = _flight_key(url, params, headers)
+        with self._flightsLock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self.metrics.increment("ziggonext_http_deduplicated_total", endpoint=_endpoint(url))
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+        try:
+            flight.response = self.request("GET", url, headers=headers, params=params)
+            return flight.response
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self._flightsLock:
+                del self._flights[key]
+            flight.done.set()
+
+    def post(self, url: str, json=None, headers: dict = None) -> requests.Response:
+        """Executes a POST request"""
+        return self.request("POST", url, json=json, headers=headers)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Executes a request, raising ZiggoNextConnectionError when the api can't be reached"""
+        endpoint = _endpoint(url)
+        if self.rateLimiter is not None:
+            waited = self.rateLimiter.acquire()
+            if waited > 0:
+                self.metrics.observe("ziggonext_http_throttle_seconds", waited, endpoint=endpoint)
+        with self.metrics.span("ziggonext_http_request", method=method, endpoint=endpoint):
+            try:
+                response = self._session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.RequestException as ex:
+                self.metrics.increment("ziggonext_http_errors_total", method=method, endpoint=endpoint)
+                raise ZiggoNextConnectionError("Request failed: " + str(ex)) from ex
+        self.metrics.increment("ziggonext_http_responses_total", method=method, endpoint=endpoint, status=response.status_code)
+        if self.recorder is not None:
+            self.recorder.record_http(method, response)
+        return response
+
+    def close(self):
+        """Closes all pooled connections"""
+        self._session.close()
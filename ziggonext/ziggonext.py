@@ -4,11 +4,25 @@ from logging import Logger
 import random
 import time
 import sys, traceback
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 
-import requests
 from .models import ZiggoNextSession, ZiggoChannel
 from .ziggonextbox import ZiggoNextBox
-from .exceptions import ZiggoNextConnectionError, ZiggoNextAuthenticationError
+from .mqttclient import ZiggoNextMqttClient
+from .mqttloop import ZiggoNextMqttLoop
+from .recorder import ZiggoNextRecorder
+from .snapshot import ZiggoNextSnapshotStore, _snapshot_signature
+from .commands import DEFAULT_COMMAND_WORKERS
+from .artwork import ZiggoNextArtworkCache, _channel_images, _with_local_images
+from .listings import ZiggoNextListingCache
+from .transport import ZiggoNextTransport
+from .channels import ZiggoChannelIndex, ZiggoChannelCache
+from .epg import ZiggoNextEpg, DEFAULT_EPG_WINDOW, DEFAULT_EPG_REFRESH_INTERVAL, _fetch_listings
+from .events import ZiggoNextListeners
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+from .sessionstore import ZiggoNextSessionStore, ZiggoNextStoredSession, _jwt_expiry, TOKEN_REFRESH_MARGIN
+from .exceptions import ZiggoNextConnectionError, ZiggoNextChannelNotFoundError, ZiggoNextAuthenticationError
 
 from .const import (
     BOX_PLAY_STATE_BUFFER,
@@ -27,6 +41,10 @@ from .const import (
 )
 
 DEFAULT_PORT = 443
+DEFAULT_ENRICHMENT_WORKERS = 4
+TOKEN_REFRESH_RETRY_DELAY = 60
+ZAP_PREFETCH_NEIGHBORS = 1
+BOX_STATUS_TIMEOUT = 5
 
 def _makeId(stringLength=10):
     letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
@@ -37,8 +55,22 @@ class ZiggoNext:
     """Main class for handling connections with Ziggo Next Settop boxes."""
     logger: Logger
     session: ZiggoNextSession
-    def __init__(self, username: str, password: str, country_code: str = "nl") -> None:
-        """Initialize connection with Ziggo Next"""
+    def __init__(self, username: str, password: str, country_code: str = "nl", transport: ZiggoNextTransport = None, channelCache: ZiggoChannelCache = None, sessionStore: ZiggoNextSessionStore = None, metrics: ZiggoNextMetrics = None, mqttOptions: dict = None, executor: Executor = None, mqttLoop: ZiggoNextMqttLoop = None, recorder: ZiggoNextRecorder = None, snapshotStore: ZiggoNextSnapshotStore = None, artworkCache: ZiggoNextArtworkCache = None, commandExecutor: Executor = None) -> None:
+        """Initialize connection with Ziggo Next
+
+        mqttOptions (port, transport, tls) override how the mqtt broker is reached.
+        A shared executor and mqttLoop let many accounts run on a fixed set of threads.
+        Command queues run on commandExecutor, kept apart so waiting commands can't starve token refreshes.
+        A recorder captures inbound mqtt messages and http responses for replay.
+        A snapshotStore restores the boxes with their last known state on start, marked stale until confirmed.
+        An artworkCache keeps channel logos and program art on disk, box info then carries localImage.
+        """
+        self.metrics = metrics or NULL_METRICS
+        self.mqttOptions = mqttOptions or {}
+        self.mqttLoop = mqttLoop
+        self.recorder = recorder
+        self._ownsTransport = transport is None
+        self.transport = transport or ZiggoNextTransport(metrics=self.metrics, recorder=recorder)
         self.username = username
         self.password = password
         self.token = None
@@ -46,42 +78,208 @@ class ZiggoNext:
         self.logger = None
         self.settop_boxes = {}
         self.channels = {}
+        self._boxesLock = threading.Lock()
+        self.channelIndex = ZiggoChannelIndex()
+        self.channelCache = channelCache
+        self._channelsEtag = None
+        self._channelsLastModified = None
+        self.sessionStore = sessionStore
+        self._tokenLock = threading.Lock()
+        self._tokenRefreshTimer = None
+        self._sessionRestored = False
+        self.mqttClient = None
+        self.listings = None
+        self.timings = {}
+        self.epg = None
+        self._listeners = ZiggoNextListeners(None)
         self._country_code = country_code
+        self._ownsExecutor = executor is None
+        self._enrichmentExecutor = executor or ThreadPoolExecutor(
+            max_workers=DEFAULT_ENRICHMENT_WORKERS, thread_name_prefix="ziggonext-enrichment"
+        )
+        self._ownsCommandExecutor = commandExecutor is None
+        self._commandExecutor = commandExecutor or ThreadPoolExecutor(
+            max_workers=DEFAULT_COMMAND_WORKERS, thread_name_prefix="ziggonext-commands"
+        )
+        self._sharedLineup = False
+        self._lineupListener = None
+        self.snapshotStore = snapshotStore
+        self._snapshotSignature = None
+        self._snapshotTimer = None
+        self.artwork = artworkCache
+        self._nowListings = {}
 
     def get_session(self):
         """Get Ziggo Next Session information"""
         payload = {"username": self.username, "password": self.password}
-        try:
-            response = requests.post(self._api_url_session, json=payload)
-        except (Exception):
-            raise ZiggoNextConnectionError("Unknown connection failure")
+        response = self.transport.post(self._api_url_session, json=payload)
 
         if not response.ok:
             status = response.json()
             self.logger.debug(status)
-            if status[0]['code'] == 'invalidCredentials':
-                raise ZiggoNextAuthenticationError("Invalid credentials")
-            raise ZiggoNextConnectionError("Connection failed: " + status)
+            _raise_session_error(status)
         else:
             session = response.json()
             self.logger.debug(session)
-            self.session = ZiggoNextSession(
-                session["customer"]["householdId"], session["oespToken"]
-            )
+            self.session = _parse_session(session)
 
     def get_session_and_token(self):
-        """Get session and token from Ziggo Next"""
-        self.get_session()
-        self._get_token()
+        """Get session and token from Ziggo Next, reusing a stored session while it is valid"""
+        with self._tokenLock:
+            self._sessionRestored = self._restore_session()
+            if not self._sessionRestored:
+                self.get_session()
+                self._get_token()
+            self._save_session()
+        self._schedule_token_refresh()
+
+    def _renew_session(self):
+        """Drops a stored session the api rejected, e.g. after a password change, and logs in again"""
+        self.logger.debug("Stored session rejected, logging in again.")
+        with self._tokenLock:
+            try:
+                self.sessionStore.remove(self._session_key())
+            except OSError as ex:
+                self.logger.error("Could not remove stored session: %s", ex)
+            self._sessionRestored = False
+            self.get_session()
+            self._get_token()
+            self._save_session()
+        self._schedule_token_refresh()
+
+    def refresh_token(self) -> str:
+        """Fetch a new token before the current one expires and hand it to the mqtt client"""
+        with self._tokenLock:
+            try:
+                self._get_token()
+            except ZiggoNextConnectionError:
+                self.logger.debug("Token refresh failed, starting a new session.")
+                try:
+                    self.get_session()
+                    self._get_token()
+                except (ZiggoNextConnectionError, ZiggoNextAuthenticationError) as ex:
+                    self.logger.error("Could not refresh token: %s", ex)
+                    self._schedule_token_refresh(TOKEN_REFRESH_RETRY_DELAY)
+                    return self.token
+            self._save_session()
+        if self.mqttClient is not None:
+            self.mqttClient.update_token(self.token)
+        self._schedule_token_refresh()
+        return self.token
+
+    def _session_key(self) -> str:
+        return self._country_code + ":" + self.username
+
+    def _restore_session(self) -> bool:
+        """Reuses the stored session, fetching only a new token when that one expired"""
+        if self.sessionStore is None:
+            return False
+        stored = self.sessionStore.load(self._session_key())
+        if stored is None:
+            return False
+        self.session = stored.session
+        if stored.token_valid():
+            self.token = stored.token
+            self.logger.debug("Reusing stored session and token.")
+            return True
+        try:
+            self._get_token()
+        except ZiggoNextConnectionError:
+            self.logger.debug("Stored session expired.")
+            return False
+        return True
+
+    def _save_session(self):
+        if self.sessionStore is None:
+            return
+        try:
+            self.sessionStore.save(self._session_key(), ZiggoNextStoredSession(self.session, self.token))
+        except OSError as ex:
+            self.logger.error("Could not store session: %s", ex)
+
+    def _schedule_token_refresh(self, delay: float = None):
+        """Schedules refresh_token shortly before the token expires"""
+        if delay is None:
+            delay = _token_refresh_delay(self.token)
+            if delay is None:
+                return
+        if self._tokenRefreshTimer is not None:
+            self._tokenRefreshTimer.cancel()
+        if self.mqttLoop is not None:
+            self._tokenRefreshTimer = self.mqttLoop.call_later(
+                delay, lambda: self._enrichmentExecutor.submit(self.refresh_token)
+            )
+            return
+        self._tokenRefreshTimer = threading.Timer(delay, self.refresh_token)
+        self._tokenRefreshTimer.daemon = True
+        self._tokenRefreshTimer.start()
 
     def _register_settop_boxes(self):
         """Get settopxes"""
-        jsonResult = self._do_api_call(self.session, self._api_url_settop_boxes)
-        for box in jsonResult:
-            if not box["platformType"] == "EOS":
-                continue
-            box_id = box["deviceId"]
-            self.settop_boxes[box_id] = ZiggoNextBox(box_id, box["settings"]["deviceFriendlyName"], self.session.householdId, self.token, self._country_code, self.logger)
+        snapshot = self._load_snapshot()
+        try:
+            boxes = self._fetch_settop_boxes()
+        except ZiggoNextConnectionError:
+            if not snapshot:
+                raise
+            self.logger.warning("Could not fetch settop boxes, using the snapshot.")
+            boxes = [(box_id, name) for box_id, (name, state, info) in snapshot.items()]
+        self.mqttClient = ZiggoNextMqttClient(self.session.householdId, self.token, self._country_code, self.logger, self.refresh_token, self.metrics, mqttLoop=self.mqttLoop, recorder=self.recorder, **self.mqttOptions)
+        for box_id, name in boxes:
+            box = ZiggoNextBox(box_id, name, self.session.householdId, self.mqttClient, self.listings, self.logger, self._enrichmentExecutor, self.metrics, self._commandExecutor)
+            box.epg = self.epg
+            box.artwork = self.artwork
+            if box_id in snapshot:
+                box._restore(snapshot[box_id][1], snapshot[box_id][2])
+            box.add_listener(self._listeners.notify)
+            # channels may load on another thread, the lock makes sure the box gets the latest lineup
+            with self._boxesLock:
+                box.channels = self.channels
+                self.settop_boxes[box_id] = box
+        self._schedule_snapshot()
+
+    def _fetch_settop_boxes(self) -> list:
+        """Boxes of the household, logging in again once when the api rejects a stored session"""
+        try:
+            return self._get_settop_boxes()
+        except _SessionRejectedError:
+            if not self._sessionRestored:
+                raise
+        self._renew_session()
+        return self._get_settop_boxes()
+
+    def _get_settop_boxes(self) -> list:
+        self._api_url_settop_boxes =  COUNTRY_URLS_PERSONALIZATION_FORMAT[self._country_code].format(household_id=self.session.householdId)
+        return list(_parse_settop_boxes(self._do_api_call(self.session, self._api_url_settop_boxes)))
+
+    def _load_snapshot(self) -> dict:
+        if self.snapshotStore is None:
+            return {}
+        return self.snapshotStore.load(self._session_key())
+
+    def save_snapshot(self):
+        """Writes the boxes with their state and playing info to the snapshot store, if anything changed"""
+        if self.snapshotStore is None or not self.settop_boxes:
+            return
+        boxes = list(self.settop_boxes.values())
+        signature = _snapshot_signature(boxes)
+        if signature == self._snapshotSignature:
+            return
+        try:
+            self.snapshotStore.store(self._session_key(), boxes)
+        except OSError as ex:
+            self.logger.error("Could not save snapshot: %s", ex)
+            return
+        self._snapshotSignature = signature
+
+    def _schedule_snapshot(self):
+        """Saves the snapshot every snapshotStore.interval seconds"""
+        if self.snapshotStore is None:
+            return
+        def tick():
+            self._enrichmentExecutor.submit(self.save_snapshot)
+            self._schedule_snapshot()
+        self._snapshotTimer = self.mqttClient.call_later(self.snapshotStore.interval, tick)
 
 
 
@@ -91,11 +289,10 @@ class ZiggoNext:
             "X-OESP-Token": session.oespToken,
             "X-OESP-Username": self.username,
         }
-        response = requests.get(url, headers=headers)
+        response = self.transport.get(url, headers=headers)
         if response.status_code == 200:
             return response.json()
-        else:
-            raise ZiggoNextConnectionError("API call failed: " + str(response.status_code))
+        _raise_api_error(response.status_code)
     
     def _get_token(self):
         """Get token from Ziggo Next"""
@@ -103,59 +300,230 @@ class ZiggoNext:
         self.token = jsonResult["token"]
         self.logger.debug("Fetched a token: %s", jsonResult)
         
-    def initialize(self, logger, enableMqttLogging: bool = True):
-        """Get token and start mqtt client for receiving data from Ziggo Next"""
+    def initialize(self, logger, enableMqttLogging: bool = True, concurrent: bool = False, lazyMqtt: bool = False):
+        """Get token and start mqtt client for receiving data from Ziggo Next
+
+        With concurrent, channels load while the session is set up and the mqtt
+        connection opens in the background. With lazyMqtt, the connection opens
+        on the first command instead; box state stays unknown until then, and
+        commands depending on it connect and wait for the first status.
+        Stage durations end up in self.timings.
+        """
+        self._prepare(logger)
+        self.timings = {}
+        started = time.perf_counter()
+        if concurrent:
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ziggonext-init") as executor:
+                channelsFuture = executor.submit(self._timed, "channels", self._initialize_channels)
+                self._timed("session", self.get_session_and_token)
+                self._timed("devices", self._register_settop_boxes)
+                channelsFuture.result()
+        else:
+            self._timed("session", self.get_session_and_token)
+            self._timed("devices", self._register_settop_boxes)
+            self._timed("channels", self._initialize_channels)
+        if not lazyMqtt:
+            if concurrent:
+                self._timed("mqtt", self.mqttClient.connect_async)
+            else:
+                self._timed("mqtt", self.mqttClient.connect)
+        self.timings["total"] = time.perf_counter() - started
+        self.logger.debug("Initialized in %s", self.timings)
+
+    def _prepare(self, logger):
+        """Sets up the api urls and the listing cache for the country"""
         baseUrl = COUNTRY_URLS_HTTP[self._country_code]
         self._api_url_session =  baseUrl + "/session"
         self._api_url_token =  baseUrl + "/tokens/jwt"
         self._api_url_channels =  baseUrl + "/channels"
         self.logger = logger
-        self.get_session_and_token()
-        self._api_url_settop_boxes =  COUNTRY_URLS_PERSONALIZATION_FORMAT[self._country_code].format(household_id=self.session.householdId)
-        self._register_settop_boxes()
-        self.load_channels()
+        self._listeners.logger = logger
+        self._api_url_listings = baseUrl + "/listings"
+        if self.listings is None:
+            self.listings = ZiggoNextListingCache(baseUrl + "/listings/{id}", logger, self.transport, metrics=self.metrics)
+
+    def load_lineup(self, logger, refresh: bool = False):
+        """Loads only the channel lineup, from the channel cache unless refresh, without a session or mqtt
+
+        A refresh of a cached lineup is a conditional request.
+        """
+        self._prepare(logger)
+        restored = self._restore_channels()
+        if refresh or not restored:
+            self.load_channels()
+
+    def _timed(self, stage: str, func):
+        """Runs an initialization stage and records its duration"""
+        started = time.perf_counter()
+        try:
+            return func()
+        finally:
+            self.timings[stage] = time.perf_counter() - started
+
+    def _initialize_channels(self):
+        """Restores the lineup from cache and refreshes it in the background, or loads it"""
+        if self._sharedLineup:
+            return
+        if self._restore_channels():
+            threading.Thread(target=self.load_channels, name="ziggonext-channels", daemon=True).start()
+        else:
+            self.load_channels()
+
+    def start_epg(self, window: float = DEFAULT_EPG_WINDOW, refreshInterval: float = DEFAULT_EPG_REFRESH_INTERVAL):
+        """Prefetch listings for all channels and resolve now/next locally from then on"""
+        if self.epg is not None:
+            self.epg.stop()
+        self.epg = ZiggoNextEpg(self._api_url_listings, self.transport, self.logger, window, refreshInterval)
+        for box in self.settop_boxes.values():
+            box.epg = self.epg
+        self.epg.start(lambda: self.channels)
+
+    def close(self):
+        """Stops background work, disconnects from mqtt and closes the transport unless it was passed in"""
+        if self._tokenRefreshTimer is not None:
+            self._tokenRefreshTimer.cancel()
+            self._tokenRefreshTimer = None
+        if self._snapshotTimer is not None:
+            self._snapshotTimer.cancel()
+            self._snapshotTimer = None
+        self.save_snapshot()
+        if self.artwork is not None:
+            self.artwork.flush()
+        if self.epg is not None:
+            self.epg.stop()
+        for box in self.settop_boxes.values():
+            box.close()
+        if self.mqttClient is not None:
+            self.mqttClient.disconnect()
+        if self._ownsExecutor:
+            self._enrichmentExecutor.shutdown(wait=False)
+        if self._ownsCommandExecutor:
+            self._commandExecutor.shutdown(wait=False)
+        if self._ownsTransport:
+            self.transport.close()
+
+    def add_listener(self, callback):
+        """Calls callback(ZiggoNextBoxChange) on every real change of any box, returns a function to remove it"""
+        return self._listeners.add(callback)
+
+    def changes(self):
+        """Async iterator of ZiggoNextBoxChange events of all boxes"""
+        return self._listeners.changes()
+
+    def run_commands(self, box_id, commands) -> Future:
+        """Queue a command or macro for the settop box, the future resolves once the box acknowledged it"""
+        return self.settop_boxes[box_id].commands.submit(commands)
+
+    def _box_with_status(self, box_id):
+        """The box, waiting for its first status only when this call opened the deferred mqtt connection"""
+        box = self.settop_boxes[box_id]
+        if not box.wait_for_status(0) and self.mqttClient.ensure_connected():
+            if not box.wait_for_status(BOX_STATUS_TIMEOUT):
+                self.logger.warning("Box %s did not report its status within %s seconds", box.name, BOX_STATUS_TIMEOUT)
+        return box
 
     def _send_key_to_box(self, box_id: str, key: str):
         self.settop_boxes[box_id].send_key_to_box(key)
 
     def select_source(self, source, box_id):
         """Changes te channel from the settopbox"""
-        channel = [src for src in self.channels.values() if src.title == source][0]
+        self._select_channel(self.channelIndex.by_title(source), source, box_id)
+
+    def select_source_by_number(self, channelNumber, box_id):
+        """Changes the channel from the settopbox by channel number"""
+        self._select_channel(self.channelIndex.by_number(channelNumber), channelNumber, box_id)
+
+    def select_source_by_service_id(self, serviceId, box_id):
+        """Changes the channel from the settopbox by serviceId"""
+        self._select_channel(self.channelIndex.by_service_id(serviceId), serviceId, box_id)
+
+    def _select_channel(self, channel, key, box_id):
+        if channel is None:
+            raise ZiggoNextChannelNotFoundError("Channel not found: " + str(key))
         self.settop_boxes[box_id].set_channel(channel.serviceId)
 
+    def search_channels(self, query: str, limit: int = 10):
+        """Channels matching the query by title prefix or fuzzy match, for pickers"""
+        return self.channelIndex.search(query, limit)
+
     def pause(self, box_id):
         """Pauses the given settopbox"""
-        box = self.settop_boxes[box_id]
+        box = self._box_with_status(box_id)
         if box.state == ONLINE_RUNNING and not box.info.paused:
             self._send_key_to_box(box_id, MEDIA_KEY_PLAY_PAUSE)
 
     def play(self, box_id):
         """Resumes the settopbox"""
-        box = self.settop_boxes[box_id]
+        box = self._box_with_status(box_id)
         if box.state == ONLINE_RUNNING and box.info.paused:
             self._send_key_to_box(box_id, MEDIA_KEY_PLAY_PAUSE)
 
     def next_channel(self, box_id):
         """Select the next channel for given settop box."""
-        box = self.settop_boxes[box_id]
+        box = self._box_with_status(box_id)
         if box.state == ONLINE_RUNNING:
             self._send_key_to_box(box_id, MEDIA_KEY_CHANNEL_UP)
 
     def previous_channel(self, box_id):
         """Select the previous channel for given settop box."""
-        box = self.settop_boxes[box_id]
+        box = self._box_with_status(box_id)
         if box.state == ONLINE_RUNNING:
             self._send_key_to_box(box_id, MEDIA_KEY_CHANNEL_DOWN)
 
+    def zap(self, box_id, offset: int = 1):
+        """Tunes offset channels up, or down when negative, in channel number order
+
+        The target channel is worked out locally and tuned directly, box info
+        shows it right away and the listings of its neighbors are prefetched.
+        Without a known current channel a single step falls back to a key press.
+        """
+        box = self._box_with_status(box_id)
+        if box.state != ONLINE_RUNNING:
+            return
+        channel = self.channelIndex.neighbor(box.info.channelId, offset)
+        if channel is None:
+            if offset not in (1, -1):
+                raise ZiggoNextChannelNotFoundError("Current channel of box {box} is unknown".format(box=box_id))
+            self._send_key_to_box(box_id, MEDIA_KEY_CHANNEL_UP if offset > 0 else MEDIA_KEY_CHANNEL_DOWN)
+            return
+        box.tune(channel, self._now_listing(channel.serviceId))
+        self._enrichmentExecutor.submit(self.prefetch_neighbors, channel.serviceId)
+
+    def _now_listing(self, serviceId: str):
+        """Listing airing on a channel from the epg or the neighbor prefetch, without network access"""
+        if self.epg is not None:
+            listing = self.epg.now(serviceId)
+            if listing is not None:
+                return listing
+        listing = self._nowListings.get(serviceId)
+        if listing is not None and _airing(listing, time.time()):
+            return listing
+        return None
+
+    def prefetch_neighbors(self, serviceId: str, distance: int = ZAP_PREFETCH_NEIGHBORS):
+        """Fetches what airs now on a channel and the channels next to it, so zapping there needs no lookup"""
+        stations = {}
+        for offset in range(-distance, distance + 1):
+            channel = self.channelIndex.neighbor(serviceId, offset)
+            if channel is not None and channel.stationId and self._now_listing(channel.serviceId) is None:
+                stations[channel.stationId] = channel.serviceId
+        if not stations:
+            return
+        now = time.time()
+        for listing in _fetch_listings(self.transport, self._api_url_listings, self.logger, list(stations), stations, now, now):
+            if _airing(listing, now):
+                self._nowListings[listing.channelId] = listing
+                self.listings.put(listing)
+
     def turn_on(self, box_id):
         """Turn the settop box on."""
-        box = self.settop_boxes[box_id]
+        box = self._box_with_status(box_id)
         if box.state == ONLINE_STANDBY:
             self._send_key_to_box(box_id, MEDIA_KEY_POWER)
 
     def turn_off(self, box_id):
         """Turn the settop box off."""
-        box = self.settop_boxes[box_id]
+        box = self._box_with_status(box_id)
         if box.state == ONLINE_RUNNING:
            self._send_key_to_box(box_id, MEDIA_KEY_POWER)
            box.turn_off()
@@ -167,45 +535,170 @@ class ZiggoNext:
 
     def load_channels(self):
         """Refresh channels list for now-playing data."""
-        response = requests.get(self._api_url_channels)
-        if response.status_code == 200:
-            content = response.json()
-
-            for channel in content["channels"]:
-                station = channel["stationSchedules"][0]["station"]
-                serviceId = station["serviceId"]
-                streamImage = None
-                channelImage = None
-                for image in station["images"]:
-                    if image["assetType"] == "imageStream":
-                        streamImage = image["url"]
-                    if image["assetType"] == "station-logo-small":
-                        channelImage =  image["url"]
-
-                self.channels[serviceId] = ZiggoChannel(
-                    serviceId,
-                    channel["title"],
-                    streamImage,
-                    channelImage,
-                    channel["channelNumber"],
-                )
-            self.channels["NL_000073_019506"] = ZiggoChannel(
-                "NL_000073_019506",
-                "Netflix",
-                None,
-                None,
-                "150"
-            )
-
-            self.channels["NL_000074_019507"] = ZiggoChannel(
-                "NL_000074_019507",
-                "Videoland",
-                None,
-                None,
-                "151"
-            )
+        try:
+            response = self.transport.get(self._api_url_channels, headers=self._channel_validators())
+        except ZiggoNextConnectionError as ex:
+            self.logger.error("Can't retrieve channels: %s", ex)
+            return
+        if response.status_code == 304:
+            self.logger.debug("Channels unchanged.")
+        elif response.status_code == 200:
+            self._channelsEtag = response.headers.get("ETag")
+            self._channelsLastModified = response.headers.get("Last-Modified")
+            self._set_channels(_parse_channels(response.json()))
             self.logger.debug("Updated channels.")
-            for box in self.settop_boxes.values():
-                box.channels = self.channels
+            if self.channelCache is not None:
+                try:
+                    self.channelCache.store(self._country_code, self.channels, self._channelsEtag, self._channelsLastModified)
+                except OSError as ex:
+                    self.logger.error("Could not cache channels: %s", ex)
         else:
             self.logger.error("Can't retrieve channels...")
+
+    def _restore_channels(self) -> bool:
+        """Loads the lineup from the channel cache, if there is one"""
+        if self.channelCache is None:
+            return False
+        cached = self.channelCache.load(self._country_code)
+        if cached is None:
+            return False
+        channels, self._channelsEtag, self._channelsLastModified = cached
+        self._set_channels(channels)
+        self.logger.debug("Restored channels from cache.")
+        return True
+
+    def _channel_validators(self) -> dict:
+        """Conditional request headers for refreshing the current lineup"""
+        headers = {}
+        if not self.channels:
+            return headers
+        if self._channelsEtag:
+            headers["If-None-Match"] = self._channelsEtag
+        if self._channelsLastModified:
+            headers["If-Modified-Since"] = self._channelsLastModified
+        return headers
+
+    def use_lineup(self, channels: dict, channelIndex: ZiggoChannelIndex):
+        """Uses a lineup loaded elsewhere, e.g. by another account in the same country
+
+        The channels and index must not change afterwards, a refresh hands over a new pair.
+        """
+        self._sharedLineup = True
+        with self._boxesLock:
+            for box in self.settop_boxes.values():
+                box.channels = channels
+            self.channels = channels
+            self.channelIndex = channelIndex
+
+    def _set_channels(self, channels):
+        if self.artwork is not None:
+            channels = _with_local_images(channels, self.artwork)
+        self._apply_channels(channels)
+        if self.artwork is not None:
+            self._enrichmentExecutor.submit(self.prefetch_artwork)
+
+    def _apply_channels(self, channels):
+        """Swaps in the lineup with a new index, the previous pair may be shared and stays as it is"""
+        channelIndex = ZiggoChannelIndex(channels)
+        with self._boxesLock:
+            for box in self.settop_boxes.values():
+                box.channels = channels
+            self.channels = channels
+            self.channelIndex = channelIndex
+        if self._lineupListener is not None:
+            self._lineupListener(channels, channelIndex)
+
+    def prefetch_artwork(self) -> int:
+        """Downloads the stream images and logos of all channels into the artwork cache, then adds their local paths to the channels"""
+        channels = self.channels
+        fetched = self.artwork.prefetch(_channel_images(channels))
+        if fetched and self.channels is channels:
+            self._apply_channels(_with_local_images(channels, self.artwork))
+        return fetched
+
+
+def _airing(listing, timestamp: float) -> bool:
+    """Whether the listing airs at the timestamp"""
+    return listing.startTime is not None and listing.endTime is not None and listing.startTime <= timestamp < listing.endTime
+
+
+def _token_refresh_delay(token: str) -> float:
+    """Seconds until a token should be refreshed, or None when its expiry is unknown"""
+    expiry = _jwt_expiry(token) if token else None
+    if expiry is None:
+        return None
+    lifetime = expiry - time.time()
+    return max(lifetime - TOKEN_REFRESH_MARGIN, lifetime / 2, 1)
+
+
+class _SessionRejectedError(ZiggoNextConnectionError):
+    """The api refused the session or token, they were revoked or expired early"""
+
+
+def _raise_api_error(statusCode: int):
+    """Raises the exception matching a failed api call"""
+    if statusCode in (401, 403):
+        raise _SessionRejectedError("API call failed: " + str(statusCode))
+    raise ZiggoNextConnectionError("API call failed: " + str(statusCode))
+
+
+def _raise_session_error(status):
+    """Raises the exception matching a failed /session response"""
+    if status[0]['code'] == 'invalidCredentials':
+        raise ZiggoNextAuthenticationError("Invalid credentials")
+    raise ZiggoNextConnectionError("Connection failed: " + str(status))
+
+
+def _parse_session(session) -> ZiggoNextSession:
+    """Creates a session from a /session response"""
+    return ZiggoNextSession(
+        session["customer"]["householdId"], session["oespToken"]
+    )
+
+
+def _parse_settop_boxes(jsonResult):
+    """Yields id and friendly name of the EOS settop boxes in a devices response"""
+    for box in jsonResult:
+        if not box["platformType"] == "EOS":
+            continue
+        yield box["deviceId"], box["settings"]["deviceFriendlyName"]
+
+
+def _parse_channels(content) -> dict:
+    """Creates the channel map from a /channels response"""
+    channels = {}
+    for channel in content["channels"]:
+        station = channel["stationSchedules"][0]["station"]
+        serviceId = station["serviceId"]
+        streamImage = None
+        channelImage = None
+        for image in station["images"]:
+            if image["assetType"] == "imageStream":
+                streamImage = image["url"]
+            if image["assetType"] == "station-logo-small":
+                channelImage =  image["url"]
+
+        channels[serviceId] = ZiggoChannel(
+            serviceId,
+            channel["title"],
+            streamImage,
+            channelImage,
+            channel["channelNumber"],
+            station.get("id"),
+        )
+    channels["NL_000073_019506"] = ZiggoChannel(
+        "NL_000073_019506",
+        "Netflix",
+        None,
+        None,
+        "150"
+    )
+
+    channels["NL_000074_019507"] = ZiggoChannel(
+        "NL_000074_019507",
+        "Videoland",
+        None,
+        None,
+        "151"
+    )
+    return channels
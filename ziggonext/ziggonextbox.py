@@ -1,14 +1,16 @@
 """ZiggoNextBox"""
-import paho.mqtt.client as mqtt
-import urllib.parse
-from paho.mqtt.client import Client
 import json
-import requests
+import threading
+from collections import deque
+from concurrent.futures import Executor
 from logging import Logger
-import random
-import time
-import sys, traceback
-from .models import ZiggoNextSession, ZiggoNextBoxPlayingInfo, ZiggoChannel
+from .mqttclient import ZiggoNextMqttClient, _makeId
+from .listings import ZiggoNextListingCache
+from .coalescer import ZiggoNextStatusCoalescer
+from .commands import ZiggoNextCommandQueue
+from .metrics import ZiggoNextMetrics, NULL_METRICS
+from .events import ZiggoNextListeners, _info_changes, CHANGE_STATE
+from .models import ZiggoNextSession, ZiggoNextBoxPlayingInfo, ZiggoChannel, ZiggoListing, ZiggoNextBoxChange
 from .const import (
     BOX_PLAY_STATE_BUFFER,
     BOX_PLAY_STATE_CHANNEL,
@@ -22,14 +24,7 @@ from .const import (
     MEDIA_KEY_CHANNEL_DOWN,
     MEDIA_KEY_CHANNEL_UP,
     MEDIA_KEY_POWER,
-    COUNTRY_URLS_HTTP,
-    COUNTRY_URLS_MQTT
 )
-DEFAULT_PORT = 443
-
-def _makeId(stringLength=10):
-    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
-    return "".join(random.choice(letters) for i in range(stringLength))
 
 class ZiggoNextBox:
     
@@ -38,98 +33,118 @@ class ZiggoNextBox:
     state: str = UNKNOWN
     info: ZiggoNextBoxPlayingInfo
     available: bool = False
+    stale: bool = False
     channels: ZiggoChannel = {}
 
-    def __init__(self, box_id:str, name:str, householdId:str, token:str, country_code:str, logger:Logger):
+    def __init__(self, box_id:str, name:str, householdId:str, mqttClient:ZiggoNextMqttClient, listings:ZiggoNextListingCache, logger:Logger, executor:Executor = None, metrics:ZiggoNextMetrics = NULL_METRICS, commandExecutor:Executor = None):
         self.box_id = box_id
         self.name = name
         self._householdId = householdId
-        self._token = token
         self.info = ZiggoNextBoxPlayingInfo()
         self.logger = logger
-        self._mqttClientConnected = False
-        self._createUrls(country_code)
-        self.mqttClientId = _makeId(30)
-        self.mqttClient = mqtt.Client(self.mqttClientId, transport="websockets")
-        self.mqttClient.username_pw_set(householdId, token)
-        self.mqttClient.tls_set()
-        self.mqttClient.on_connect = self._on_mqtt_client_connect
-        self.mqttClient.on_disconnect = self._on_mqtt_client_disconnect
-        self.mqttClient.connect(self._mqtt_broker, DEFAULT_PORT)
-        self.mqttClient.loop_start()
+        self.listings = listings
+        self.metrics = metrics
+        self.epg = None
+        self.artwork = None
+        self.statusRequests = ZiggoNextStatusCoalescer(self._publish_status_request, timer=mqttClient.call_later)
+        self.updateCount = 0
+        self.statusCount = 0
+        self._commands = None
+        self._listeners = ZiggoNextListeners(logger)
+        self._executor = executor
+        self._commandExecutor = commandExecutor
+        self._statusLock = threading.RLock()
+        self._statusVersion = 0
+        self._statusReported = threading.Event()
+        self._pendingChanges = deque()
+        self._notifying = False
+        self.mqttClient = mqttClient
+        self.mqttClientId = mqttClient.mqttClientId
+        self.mqttClient.register_box(self)
         self.channels = {}
         
 
-    def _createUrls(self, country_code: str):
-        baseUrl = COUNTRY_URLS_HTTP[country_code]
-        self._api_url_listing_format =  baseUrl + "/listings/{id}"
-        self._api_url_recording_format =  baseUrl + "/listings/{id}"
-        self._mqtt_broker = COUNTRY_URLS_MQTT[country_code]
-    
-    def _on_mqtt_client_connect(self, client, userdata, flags, resultCode):
-        """Handling mqtt connect result"""
-        if resultCode == 0:
-            client.on_message = self._on_mqtt_client_message
-            self.logger.debug("Connected to mqtt client.")
-            self.mqttClientConnected = True
-            payload = {
-                "source": self.mqttClientId,
-                "state": "ONLINE_RUNNING",
-                "deviceType": "HGO",
-            }
-            topic = self._householdId + "/" + self.mqttClientId + "/status"
-            self.mqttClient.publish(topic, json.dumps(payload))
-            self._do_subscribe(self._householdId)
-            self._do_subscribe(self._householdId + "/+/status")
-
-        elif resultCode == 5:
-            self.logger.debug("Not authorized mqtt client. Retry to connect")
-            client.username_pw_set(self._householdId, self._token)
-            client.connect(self._mqtt_broker, DEFAULT_PORT)
-            client.loop_start()
-        else:
-            raise Exception("Could not connect to Mqtt server")
-    
-    def _on_mqtt_client_disconnect(self, client, userdata, resultCode):
-        """Set state to diconnect"""
-        self.logger.debug("Disconnected from mqtt client: " + resultCode)
-        self.mqttClientConnected = False
-
-    def _on_mqtt_client_message(self, client, userdata, message):
-        """Handles messages received by mqtt client"""
-        jsonPayload = json.loads(message.payload)
-        self.logger.debug(jsonPayload)
+    def _on_mqtt_message(self, jsonPayload):
+        """Handles messages routed to this box by the household mqtt client"""
         if "deviceType" in jsonPayload and jsonPayload["deviceType"] == "STB":
             self._update_settopbox_state(jsonPayload)
         if "status" in jsonPayload:
             self._update_settop_box(jsonPayload)
+
+    @property
+    def commands(self) -> ZiggoNextCommandQueue:
+        """Command queue of this box, started on first use"""
+        if self._commands is None:
+            self._commands = ZiggoNextCommandQueue(self, self.logger, self._commandExecutor)
+        return self._commands
+
+    def close(self):
+        """Stops the command queue"""
+        if self._commands is not None:
+            self._commands.stop()
+
+    def add_listener(self, callback):
+        """Calls callback(ZiggoNextBoxChange) on every real change, returns a function to remove it
+
+        Callbacks run in order on the mqtt or worker thread that applied the change and must not block.
+        """
+        return self._listeners.add(callback)
+
+    def changes(self):
+        """Async iterator of ZiggoNextBoxChange events of this box"""
+        return self._listeners.changes()
+
+    def _notify_state_changed(self):
+        """Reports queued changes to listeners and lets commands waiting for a box state re-check it"""
+        self._flush_changes()
+        self.updateCount += 1
+        if self._commands is not None:
+            self._commands.notify()
     
-    def _do_subscribe(self, topic):
-        """Subscribes to mqtt topic"""
-        self.mqttClient.subscribe(topic)
-        self.logger.debug("subscribed to topic: {topic}".format(topic=topic))
-    
+    def wait_for_status(self, timeout: float) -> bool:
+        """Waits until the box reported standby or what it plays, returns whether it did"""
+        return self._statusReported.wait(timeout)
+
+    def _restore(self, state: str, info: ZiggoNextBoxPlayingInfo):
+        """Shows the state and info of a snapshot, marked stale until the box confirms them"""
+        with self._statusLock:
+            self.state = state
+            self.info = info
+            self.stale = True
+
     def _update_settopbox_state(self, payload):
         """Registers a new settop box"""
-        deviceId = payload["source"]
-        if deviceId != self.box_id:
-            return
         state = payload["state"]
+        if state == ONLINE_STANDBY:
+            self.stale = False
         
         if self.state == UNKNOWN:
             self._request_settop_box_state() 
-            self._do_subscribe(self._householdId + "/" + self.mqttClientId)
-            baseTopic = self._householdId + "/" + self.box_id
-            self._do_subscribe(baseTopic)
-            self._do_subscribe(baseTopic + "/status")
         if state == ONLINE_STANDBY :
-            self.info = ZiggoNextBoxPlayingInfo()
+            self._reset_info()
         else:
             self._request_settop_box_state()
+        previous = self.state
         self.state = state
+        if state == ONLINE_STANDBY:
+            self._statusReported.set()
+        if previous != state:
+            with self._statusLock:
+                self._pendingChanges.append(ZiggoNextBoxChange(self.box_id, CHANGE_STATE, previous, state))
+        self.statusCount += 1
+        self._notify_state_changed()
         
     
-    def _request_settop_box_state(self):
+    def _request_settop_box_state(self, force: bool = False):
+        """Requests the state from the settop box, coalescing bursts of requests"""
+        self.statusRequests.request(force)
+
+    def _resync(self):
+        """Requests the state once after the mqtt connection was restored, dropping requests lost with it"""
+        self.statusRequests.cancel()
+        self._request_settop_box_state(force=True)
+
+    def _publish_status_request(self):
         """Sends mqtt message to receive state from settop box"""
         self.logger.debug("Request box state for box " + self.name)
         topic = self._householdId + "/" + self.box_id
@@ -141,125 +156,223 @@ class ZiggoNextBox:
         self.mqttClient.publish(topic, json.dumps(payload))
     
     def _update_settop_box(self, payload):
-        """Updates settopbox state"""
-        deviceId = payload["source"]
-        if deviceId != self.box_id:
-            return
+        """Applies the raw settopbox state and schedules listing enrichment when not cached"""
         self.logger.debug(payload)
+        self.statusRequests.status_received()
         statusPayload = payload["status"]
+        listingId = _status_listing_id(statusPayload)
+        listing = None
+        with self.metrics.span("ziggonext_state_apply"), self._statusLock:
+            self.stale = False
+            self._statusVersion += 1
+            version = self._statusVersion
+            if listingId is not None:
+                listing = self._cached_listing(listingId)
+            self._apply_settop_box_status(statusPayload, listing)
+        self._statusReported.set()
+        self.statusCount += 1
+        self._notify_state_changed()
+        if listingId is not None and listing is None:
+            self._schedule_enrichment(statusPayload, listingId, version)
+
+    def _cached_listing(self, listingId):
+        """Listing from the prefetched epg or the listing cache, without network access"""
+        if self.epg is not None:
+            listing = self.epg.by_event_id(listingId)
+            if listing is not None:
+                return listing
+        return self.listings.peek(listingId)
+
+    def _schedule_enrichment(self, statusPayload, listingId, version):
+        """Fetches listing metadata on the worker pool, or inline without one"""
+        if self._executor is None:
+            self._enrich_settop_box(statusPayload, listingId, version)
+        else:
+            future = self._executor.submit(self._enrich_settop_box, statusPayload, listingId, version)
+            future.add_done_callback(self._on_enrichment_done)
+
+    def _on_enrichment_done(self, future):
+        """Logs failures of enrichment running on the worker pool"""
+        if future.exception() is not None:
+            self.logger.error("Listing enrichment failed: %s", future.exception())
+
+    def _enrich_settop_box(self, statusPayload, listingId, version):
+        """Fetches listing metadata for a status, unless a newer status arrived"""
+        if version != self._statusVersion:
+            return
+        listing = self.listings.get(listingId)
+        self._apply_enrichment(statusPayload, listing, version)
+
+    def _apply_enrichment(self, statusPayload, listing, version):
+        """Stamps listing metadata into the box info if the status is still current"""
+        if listing is None:
+            return
+        with self._statusLock:
+            if version != self._statusVersion:
+                self.logger.debug("Dropped outdated listing %s", listing.listingId)
+                return
+            self._apply_settop_box_status(statusPayload, listing)
+        self._notify_state_changed()
+
+    def _reset_info(self):
+        """Clears the playing info and invalidates pending enrichment"""
+        with self._statusLock:
+            self._statusVersion += 1
+            self._set_info(ZiggoNextBoxPlayingInfo())
+        self._flush_changes()
+
+    def _set_info(self, info: ZiggoNextBoxPlayingInfo):
+        """Swaps in a new playing info snapshot with the next version number and queues its changes, under _statusLock"""
+        previous = self.info
+        self.info = info.replace(version=previous.version + 1)
+        self._pendingChanges.extend(_info_changes(self.box_id, previous, self.info))
+
+    def _flush_changes(self):
+        """Hands queued changes to listeners in order, outside _statusLock so slow callbacks don't hold up status handling"""
+        with self._statusLock:
+            if self._notifying:
+                return
+            self._notifying = True
+        while True:
+            with self._statusLock:
+                if not self._pendingChanges:
+                    self._notifying = False
+                    return
+                change = self._pendingChanges.popleft()
+            self._listeners.notify(change)
+
+    def _apply_settop_box_status(self, statusPayload, listing):
+        """Builds a new playing info snapshot from a uiStatus payload and its listing metadata"""
         uiStatus = statusPayload["uiStatus"]
         if uiStatus == "mainUI":
             playerState = statusPayload["playerState"]
             sourceType = playerState["sourceType"]
             stateSource = playerState["source"]
             speed = playerState["speed"]
-            if self.info is None:
-                self.info = ZiggoNextBoxPlayingInfo()
             if sourceType == BOX_PLAY_STATE_REPLAY:
-                self.info.setSourceType(BOX_PLAY_STATE_REPLAY)
-                eventId = stateSource["eventId"]
-                self.info.setChannel(None)
-                self.info.setChannelTitle(None)
-                self.info.setTitle(
-                    "ReplayTV: " + self._get_recording_title(eventId)
+                info = ZiggoNextBoxPlayingInfo(
+                    sourceType=BOX_PLAY_STATE_REPLAY,
+                    title="ReplayTV: " + _listing_title(listing),
+                    image=_listing_image(listing),
+                    paused=speed == 0,
                 )
-                self.info.setImage(self._get_recording_image(eventId))
-                self.info.setPaused(speed == 0)
             elif sourceType == BOX_PLAY_STATE_DVR:
-                self.info.setSourceType(BOX_PLAY_STATE_DVR)
-                recordingId = stateSource["recordingId"]
-                self.info.setChannel(None)
-                self.info.setChannelTitle(None)
-                self.info.setTitle(
-                    "Recording: " + self._get_recording_title(recordingId)
+                info = ZiggoNextBoxPlayingInfo(
+                    sourceType=BOX_PLAY_STATE_DVR,
+                    title="Recording: " + _listing_title(listing),
+                    image=_listing_image(listing),
+                    paused=speed == 0,
                 )
-                self.info.setImage(
-                    self._get_recording_image(recordingId)
-                )
-                self.info.setPaused(speed == 0)
             elif sourceType == BOX_PLAY_STATE_BUFFER:
-                self.info.setSourceType(BOX_PLAY_STATE_BUFFER)
                 channelId = stateSource["channelId"]
                 channel = self.channels[channelId]
-                eventId = stateSource["eventId"]
-                self.info.setChannel(channelId)
-                self.info.setChannelTitle(channel.title)
-                self.info.setTitle(
-                    "Delayed: " + self._get_recording_title(eventId)
+                info = ZiggoNextBoxPlayingInfo(
+                    sourceType=BOX_PLAY_STATE_BUFFER,
+                    channelId=channelId,
+                    channelTitle=channel.title,
+                    title="Delayed: " + _listing_title(listing),
+                    image=channel.streamImage,
+                    paused=speed == 0,
                 )
-                self.info.setImage(channel.streamImage)
-                self.info.setPaused(speed == 0)
             elif playerState["sourceType"] == BOX_PLAY_STATE_CHANNEL:
-                self.info.setSourceType(BOX_PLAY_STATE_CHANNEL)
-                channelId = stateSource["channelId"]
-                eventId = stateSource["eventId"]
-                channel = self.channels[channelId]
-                self.info.setChannel(channelId)
-                self.info.setChannelTitle(channel.title)
-                self.info.setTitle(
-                    self._get_channel_title(channelId, eventId)
-                )
-                self.info.setImage(channel.streamImage)
-                self.info.setPaused(False)
+                info = self._channel_info(self.channels[stateSource["channelId"]], listing)
             else:
-                self.info.setSourceType(BOX_PLAY_STATE_CHANNEL)
-                eventId = stateSource["eventId"]
-                self.info.setChannel(None)
-                self.info.setTitle("Playing something...")
-                self.info.setImage(None)
-                self.info.setPaused(speed == 0)
+                info = ZiggoNextBoxPlayingInfo(
+                    sourceType=BOX_PLAY_STATE_CHANNEL,
+                    channelTitle=self.info.channelTitle,
+                    title="Playing something...",
+                    paused=speed == 0,
+                )
         elif uiStatus == "apps":
             appsState = statusPayload["appsState"]
             logoPath = appsState["logoPath"]
             if not logoPath.startswith("http:"):
                 logoPath = "https:" + logoPath
-            self.info.setSourceType(BOX_PLAY_STATE_APP)
-            self.info.setChannel(None)
-            self.info.setChannelTitle(appsState["appName"])
-            self.info.setTitle(appsState["appName"])
-            self.info.setImage(logoPath)
-            self.info.setPaused(False)
-    
-    def _get_recording_title(self, scCridImi):
-        """Get recording title."""
-        self.logger.debug("retrieving recording title")
-        response = requests.get(self._api_url_recording_format.format(id=scCridImi))
-        if response.status_code == 200:
-            content = response.json()
-            return content["program"]["title"]
-        return None
-    
-    def _get_recording_image(self, scCridImi):
-        """Get recording image."""
-        response = requests.get(self._api_url_recording_format.format(id=scCridImi))
-        if response.status_code == 200:
-            content = response.json()
-            return content["program"]["images"][0]["url"]
-        return None
+            info = ZiggoNextBoxPlayingInfo(
+                sourceType=BOX_PLAY_STATE_APP,
+                channelTitle=appsState["appName"],
+                title=appsState["appName"],
+                image=logoPath,
+                paused=False,
+            )
+        else:
+            return
+        self._set_info(self._with_local_image(info))
 
-    def _get_channel_title(self, channelId, scCridImi):
-        """Get channel title"""
-        response = requests.get(
-            self._api_url_listing_format.format(id=scCridImi)
+    def _channel_info(self, channel: ZiggoChannel, listing: ZiggoListing) -> ZiggoNextBoxPlayingInfo:
+        """Playing info of live tv on a channel"""
+        nextTitle = None
+        if self.epg is not None:
+            upcoming = self.epg.next(channel.serviceId, listing.startTime if listing else None)
+            nextTitle = upcoming.title if upcoming else None
+        return ZiggoNextBoxPlayingInfo(
+            sourceType=BOX_PLAY_STATE_CHANNEL,
+            channelId=channel.serviceId,
+            channelTitle=channel.title,
+            title=listing.title if listing else None,
+            image=channel.streamImage,
+            paused=False,
+            startTime=listing.startTime if listing else None,
+            endTime=listing.endTime if listing else None,
+            nextTitle=nextTitle,
         )
-        self.logger.debug("response completed")
-        if response.status_code == 200:
-            content = response.json()
-            if "program" in content:
-                return content["program"]["title"]
-        return None
+
+    def _with_local_image(self, info: ZiggoNextBoxPlayingInfo) -> ZiggoNextBoxPlayingInfo:
+        """Adds the cached copy of the image, fetching it in the background when it is not cached yet"""
+        if self.artwork is None or info.image is None:
+            return info
+        localImage = self.artwork.peek(info.image)
+        if localImage is None:
+            self._schedule_artwork(info.image, self._statusVersion)
+        return info.replace(localImage=localImage)
+
+    def _schedule_artwork(self, image, version):
+        """Fetches an image into the artwork cache on the worker pool, or inline without one"""
+        if self._executor is None:
+            self._fetch_artwork(image, version)
+        else:
+            self._executor.submit(self._fetch_artwork, image, version)
+
+    def _fetch_artwork(self, image, version):
+        localImage = self.artwork.path(image)
+        if localImage is not None:
+            self._apply_artwork(image, localImage, version)
+
+    def _apply_artwork(self, image, localImage, version):
+        """Stamps the local image into the box info if it still shows that image"""
+        with self._statusLock:
+            if version != self._statusVersion or self.info.image != image:
+                return
+            self._set_info(self.info.replace(localImage=localImage))
+        self._notify_state_changed()
     
     def send_key_to_box(self,key: str):
         """Sends emulated (remote) key press to settopbox"""
+        self._press_key(key)
+
+    def _press_key(self, key: str):
+        """Publishes a key press and asks for the resulting status"""
         payload = (
             '{"type":"CPE.KeyEvent","status":{"w3cKey":"'
             + key
             + '","eventType":"keyDownUp"}}'
         )
         self.mqttClient.publish(self._householdId+ "/" + self.box_id, payload)
-        self._request_settop_box_state()
+        self._request_settop_box_state(force=True)
     
     def set_channel(self, serviceId):
+        self._push_channel(serviceId)
+
+    def tune(self, channel: ZiggoChannel, listing: ZiggoListing = None):
+        """Tunes directly to the channel and shows it in info right away, the box status confirms it later"""
+        self._push_channel(channel.serviceId)
+        with self._statusLock:
+            self._statusVersion += 1
+            self._set_info(self._with_local_image(self._channel_info(channel, listing)))
+        self._notify_state_changed()
+
+    def _push_channel(self, serviceId):
+        """Sends CPE.pushToTV for a channel and asks for the resulting status"""
         payload = (
             '{"id":"'
             + _makeId(8)
@@ -271,8 +384,36 @@ class ZiggoNextBox:
         )
 
         self.mqttClient.publish(self._householdId + "/" + self.box_id, payload)
-        self._request_settop_box_state()
+        self._request_settop_box_state(force=True)
 
     
     def turn_off(self):
-        self.info = ZiggoNextBoxPlayingInfo()
\ No newline at end of file
+        self._reset_info()
+
+
+def _status_listing_id(statusPayload) -> str:
+    """Listing (eventId or recordingId) needed to describe a uiStatus payload"""
+    if statusPayload["uiStatus"] != "mainUI":
+        return None
+    playerState = statusPayload["playerState"]
+    sourceType = playerState["sourceType"]
+    stateSource = playerState["source"]
+    if sourceType == BOX_PLAY_STATE_DVR:
+        return stateSource["recordingId"]
+    if sourceType in (BOX_PLAY_STATE_REPLAY, BOX_PLAY_STATE_BUFFER, BOX_PLAY_STATE_CHANNEL):
+        return stateSource["eventId"]
+    return None
+
+
+def _listing_title(listing) -> str:
+    """Title of a listing, empty when unknown"""
+    if listing is None or listing.title is None:
+        return ""
+    return listing.title
+
+
+def _listing_image(listing) -> str:
+    """Image of a listing, if any"""
+    if listing is None:
+        return None
+    return listing.image